@@ -5,6 +5,7 @@ import signal
 import sys
 import time
 
+from bot.persistent_session_manager import flush_all_sessions
 from channel import channel_factory
 from common import const
 from config import load_config
@@ -17,7 +18,7 @@ def sigterm_handler_wrap(_signo):
 
     def func(_signo, _stack_frame):
         logger.info("signal {} received, exiting...".format(_signo))
-        conf().save_user_datas()
+        flush_all_sessions()
         if callable(old_handler):  #  check old_handler
             return old_handler(_signo, _stack_frame)
         sys.exit(0)
@@ -14,6 +14,7 @@ from bot.ali.ali_qwen_session import AliQwenSession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation
 from common.log import logger
 from common import const
 from config import conf, load_config
@@ -119,17 +120,17 @@ class AliQwenBot(Bot):
                 logger.warn("[QWEN] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
                 if need_retry:
-                    time.sleep(20)
+                    cancellation.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[QWEN] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
                 if need_retry:
-                    time.sleep(5)
+                    cancellation.sleep(5)
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[QWEN] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
                 if need_retry:
-                    time.sleep(10)
+                    cancellation.sleep(10)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[QWEN] APIConnectionError: {}".format(e))
                 need_retry = False
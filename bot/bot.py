@@ -4,7 +4,7 @@ Auto-replay chat robot abstract class
 
 
 from bridge.context import Context
-from bridge.reply import Reply
+from bridge.reply import Reply, ReplyType
 
 
 class Bot(object):
@@ -13,5 +13,24 @@ class Bot(object):
         bot auto-reply content
         :param req: received message
         :return: reply content
+        会话重置时context["cancel_token"]被触发，重试等待应使用cancellation.sleep，HTTP请求使用common.http_client，取消时连接被中断
         """
         raise NotImplementedError
+
+    def close(self):
+        """
+        release resources held by the bot when the instance is replaced
+        """
+        pass
+
+    def reply_stream(self, query, context: Context = None):
+        """
+        流式回复，逐段yield文本增量，生成器结束时才把回复写入会话历史
+        失败或回复不是文本时不yield，完整的Reply（如ReplyType.ERROR）作为生成器的返回值
+        不支持流式的bot一次返回完整回复
+        """
+        reply = self.reply(query, context)
+        if reply and reply.type == ReplyType.TEXT and isinstance(reply.content, str) and reply.content:
+            yield reply.content
+            return None
+        return reply
@@ -0,0 +1,121 @@
+"""
+OpenAI兼容接口的流式对话，bot继承ChatStreamBot并提供请求参数即可支持reply_stream
+"""
+
+from bot.bot import Bot
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common import cancellation, http_client, sse
+from common.log import logger
+from config import conf
+
+RETRY_TIMES = 2
+
+
+class ChatStreamBot(Bot):
+    stream_log_tag = "[BOT]"
+    model_context_key = None  # context中指定模型的参数名
+
+    def reply_stream(self, query, context: Context = None):
+        if context is None or context.type != ContextType.TEXT or _is_bot_command(query):
+            return (yield from super().reply_stream(query, context))
+        logger.info("{} stream query={}".format(self.stream_log_tag, query))
+        session_id = context["session_id"]
+        session = self.sessions.session_query(query, session_id)
+        result = {}
+        yield from self._chat_stream(session, self._stream_args(context), result)
+        if result["completion_tokens"] == 0:
+            return Reply(ReplyType.ERROR, result["content"])
+        # 流结束后才写入会话历史
+        self.sessions.session_reply(result["content"], session_id, result.get("total_tokens"))
+
+    def _stream_args(self, context: Context) -> dict:
+        args = dict(self.args)
+        if self.model_context_key and context.get(self.model_context_key):
+            args["model"] = context.get(self.model_context_key)
+        return args
+
+    def _stream_request(self, session, args):
+        """
+        返回流式请求的(url, headers, body)，session为_chat_stream收到的会话，args为请求参数
+        """
+        raise NotImplementedError
+
+    def _stream_delta(self, event: dict):
+        """
+        从一个SSE事件中取出文本增量
+        """
+        choices = event.get("choices") or [{}]
+        return (choices[0].get("delta") or {}).get("content")
+
+    def _chat_stream(self, session, args, result: dict, retry_count=0):
+        """
+        逐段yield流式回复的文本增量，结束后result中为完整回复，失败时completion_tokens为0且不yield
+        已输出部分内容后出错不再重试，保留已收到的部分
+        """
+        tag = self.stream_log_tag
+        res = None
+        content = ""
+        try:
+            url, headers, body = self._stream_request(session, args)
+            body["stream"] = True
+            res = http_client.post(url, headers=headers, json=body, stream=True)
+            if res.status_code == 200:
+                usage = {}
+                for event in sse.iter_events(res):
+                    usage = event.get("usage") or usage
+                    delta = self._stream_delta(event)
+                    if delta:
+                        content += delta
+                        yield delta
+                if content:
+                    result.update({
+                        "total_tokens": usage.get("total_tokens"),  # 部分接口的流式响应不返回token用量
+                        "completion_tokens": usage.get("completion_tokens") or 1,
+                        "content": content,
+                    })
+                else:
+                    result.update({"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"})
+                return
+
+            error = _error_of(res)
+            logger.error(f"{tag} stream chat failed, status_code={res.status_code}, "
+                         f"msg={error.get('message')}, type={error.get('type')}")
+            result.update({"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"})
+            need_retry = False
+            if res.status_code >= 500:
+                # server error, need retry
+                need_retry = retry_count < RETRY_TIMES
+            elif res.status_code == 401:
+                result["content"] = "授权失败，请检查API Key是否正确"
+            elif res.status_code == 429:
+                result["content"] = "请求过于频繁，请稍后再试"
+                need_retry = retry_count < RETRY_TIMES
+        except Exception as e:
+            logger.exception(e)
+            if content:
+                result.update({"total_tokens": None, "completion_tokens": 1, "content": content})
+                return
+            result.update({"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"})
+            need_retry = retry_count < RETRY_TIMES
+        finally:
+            if res is not None:
+                res.close()
+        if need_retry:
+            logger.warn(f"{tag} do retry, times={retry_count}")
+            cancellation.sleep(3)
+            yield from self._chat_stream(session, args, result, retry_count + 1)
+
+
+def _is_bot_command(query):
+    # bot内置的管理命令不走流式，直接返回处理结果
+    return query in conf().get("clear_memory_commands", ["#清除记忆"]) or query in ("#清除所有", "#更新配置")
+
+
+def _error_of(res) -> dict:
+    try:
+        response = res.json()
+    except ValueError:
+        return {"message": res.text}
+    error = response.get("error") or response.get("errors") or response.get("base_resp") or {}
+    return error if isinstance(error, dict) else {"message": str(error)}
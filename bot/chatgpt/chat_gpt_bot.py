@@ -1,24 +1,27 @@
 # encoding:utf-8
 
-import time
 
 import openai
 import openai.error
 import requests
-from common import const
-from bot.bot import Bot
+from common import const, http_client
+from bot.chat_stream_bot import ChatStreamBot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation
 from common.log import logger
 from common.token_bucket import TokenBucket
 from config import conf, load_config
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
 # OpenAI对话模型API (可用)
-class ChatGPTBot(Bot, OpenAIImage):
+class ChatGPTBot(ChatStreamBot, OpenAIImage):
+    stream_log_tag = "[CHATGPT]"
+    model_context_key = "gpt_model"
+
     def __init__(self):
         super().__init__()
         # set the default api_key
@@ -28,6 +31,8 @@ class ChatGPTBot(Bot, OpenAIImage):
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
+        # sdk会直接使用预设的Session并只传入session.proxies，代理需设置在该Session上
+        openai.requestssession = http_client.get_sdk_session(proxy)
         if conf().get("rate_limit_chatgpt"):
             self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
         conf_model = conf().get("model") or "gpt-3.5-turbo"
@@ -114,6 +119,12 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    def close(self):
+        if getattr(self, "tb4chatgpt", None):
+            self.tb4chatgpt.close()
+        if getattr(self, "tb4dalle", None):
+            self.tb4dalle.close()
+
     def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -128,6 +139,7 @@ class ChatGPTBot(Bot, OpenAIImage):
             # if api_key == None, the default openai.api_key will be used
             if args is None:
                 args = self.args
+            # 请求走全局连接池，会话被重置时连接被中断
             response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
@@ -137,39 +149,82 @@ class ChatGPTBot(Bot, OpenAIImage):
                 "content": response.choices[0]["message"]["content"],
             }
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
+            result, need_retry = self._on_request_error(e, session, retry_count)
             if need_retry:
                 logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
                 return self.reply_text(session, api_key, args, retry_count + 1)
             else:
                 return result
 
+    def _stream_args(self, context):
+        args = super()._stream_args(context)
+        if context.get("openai_api_key"):
+            args["api_key"] = context.get("openai_api_key")
+        return args
+
+    def _chat_stream(self, session: ChatGPTSession, args, result: dict, retry_count=0):
+        content = ""
+        try:
+            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            response = openai.ChatCompletion.create(messages=session.messages, stream=True, **args)
+            for chunk in response:
+                cancellation.check()
+                choices = chunk.get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    content += delta
+                    yield delta
+            if content:
+                result.update({"total_tokens": None, "completion_tokens": 1, "content": content})
+            else:
+                result.update({"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"})
+        except Exception as e:
+            if content:
+                # 已经输出了部分内容，不再重试
+                logger.warn("[CHATGPT] stream interrupted: {}".format(e))
+                result.update({"total_tokens": None, "completion_tokens": 1, "content": content})
+                return
+            error_result, need_retry = self._on_request_error(e, session, retry_count)
+            result.update(error_result)
+            if need_retry:
+                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+                yield from self._chat_stream(session, args, result, retry_count + 1)
+
+    def _on_request_error(self, e, session, retry_count):
+        """
+        处理请求异常，返回(失败时的回复, 是否重试)，需要重试时已等待完毕
+        """
+        # 连接因会话重置被中断时sdk抛出的是连接错误，不应重试
+        cancellation.check()
+        need_retry = retry_count < 2
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            if need_retry:
+                cancellation.sleep(20)
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            if need_retry:
+                cancellation.sleep(5)
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            if need_retry:
+                cancellation.sleep(10)
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            if need_retry:
+                cancellation.sleep(5)
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+        return result, need_retry
+
 
 class AzureChatGPTBot(ChatGPTBot):
     def __init__(self):
@@ -191,13 +246,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -216,7 +271,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                response = requests.post(url, headers=headers, json=body)
+                response = http_client.post(url, headers=headers, json=body)
                 response.raise_for_status()  # 检查请求是否成功
                 data = response.json()
 
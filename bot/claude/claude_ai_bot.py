@@ -1,5 +1,4 @@
 import re
-import time
 import json
 import uuid
 from curl_cffi import requests
@@ -9,6 +8,7 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation
 from common.log import logger
 from config import conf
 
@@ -209,7 +209,7 @@ class ClaudeAIBot(Bot, OpenAIImage):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
+                    cancellation.sleep(2)
                     logger.warn(f"[CLAUDE] do retry, times={retry_count}")
                     return self._chat(query, context, retry_count + 1)
                 return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
@@ -217,6 +217,6 @@ class ClaudeAIBot(Bot, OpenAIImage):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            cancellation.sleep(2)
             logger.warn(f"[CLAUDE] do retry, times={retry_count}")
             return self._chat(query, context, retry_count + 1)
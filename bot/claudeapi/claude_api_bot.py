@@ -1,6 +1,5 @@
 # encoding:utf-8
 
-import time
 
 import openai
 import openai.error
@@ -12,6 +11,7 @@ from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation
 from common.log import logger
 from common import const
 from config import conf
@@ -99,12 +99,12 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
                 if need_retry:
-                    time.sleep(20)
+                    cancellation.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CLAUDE_API] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
                 if need_retry:
-                    time.sleep(5)
+                    cancellation.sleep(5)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -3,13 +3,14 @@
 
 import re
 import time
-import requests
+from common import http_client
 import config
-from bot.bot import Bot
+from bot.chat_stream_bot import ChatStreamBot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-from bot.session_manager import SessionManager
+from bot.session_manager import Session, SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation
 from common.log import logger
 from config import conf, pconf
 import threading
@@ -17,7 +18,9 @@ from common import memory, utils
 import base64
 import os
 
-class LinkAIBot(Bot):
+class LinkAIBot(ChatStreamBot):
+    stream_log_tag = "[LINKAI]"
+
     # authentication failed
     AUTH_FAILED_CODE = 401
     NO_QUOTA_CODE = 406
@@ -58,72 +61,11 @@ class LinkAIBot(Bot):
             return Reply(ReplyType.TEXT, "请再问我一次吧")
 
         try:
-            # load config
-            if context.get("generate_breaked_by"):
-                logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
-                app_code = None
-            else:
-                plugin_app_code = self._find_group_mapping_code(context)
-                app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
-            linkai_api_key = conf().get("linkai_api_key")
-
-            session_id = context["session_id"]
-            session_message = self.sessions.session_msg_query(query, session_id)
-            logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
-
-            # image process
-            img_cache = memory.USER_IMAGE_CACHE.get(session_id)
-            if img_cache:
-                messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
-                if messages:
-                    session_message = messages
-
-            model = conf().get("model")
-            # remove system message
-            if session_message[0].get("role") == "system":
-                if app_code or model == "wenxin":
-                    session_message.pop(0)
-            body = {
-                "app_code": app_code,
-                "messages": session_message,
-                "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
-                "temperature": conf().get("temperature"),
-                "top_p": conf().get("top_p", 1),
-                "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "session_id": session_id,
-                "sender_id": session_id,
-                "channel_type": conf().get("channel_type", "wx")
-            }
-            try:
-                from linkai import LinkAIClient
-                client_id = LinkAIClient.fetch_client_id()
-                if client_id:
-                    body["client_id"] = client_id
-                    # start: client info deliver
-                    if context.kwargs.get("msg"):
-                        body["session_id"] = context.kwargs.get("msg").from_user_id
-                        if context.kwargs.get("msg").is_group:
-                            body["is_group"] = True
-                            body["group_name"] = context.kwargs.get("msg").from_user_nickname
-                            body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
-                        else:
-                            if body.get("channel_type") in ["wechatcom_app"]:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_id
-                            else:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_nickname
-
-            except Exception as e:
-                pass
-            file_id = context.kwargs.get("file_id")
-            if file_id:
-                body["file_id"] = file_id
-            logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
-            headers = {"Authorization": "Bearer " + linkai_api_key}
+            session_id, body, headers = self._chat_request(query, context)
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
             if res.status_code == 200:
                 # execute success
@@ -160,7 +102,7 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
+                    cancellation.sleep(2)
                     logger.warn(f"[LINKAI] do retry, times={retry_count}")
                     return self._chat(query, context, retry_count + 1)
 
@@ -172,10 +114,100 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            cancellation.sleep(2)
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
             return self._chat(query, context, retry_count + 1)
 
+    def _chat_request(self, query, context):
+        """
+        构建对话请求，返回(session_id, 请求体, 请求头)
+        """
+        # load config
+        if context.get("generate_breaked_by"):
+            logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
+            app_code = None
+        else:
+            plugin_app_code = self._find_group_mapping_code(context)
+            app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
+        linkai_api_key = conf().get("linkai_api_key")
+
+        session_id = context["session_id"]
+        session_message = self.sessions.session_msg_query(query, session_id)
+        logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
+
+        # image process
+        img_cache = memory.USER_IMAGE_CACHE.get(session_id)
+        if img_cache:
+            messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
+            if messages:
+                session_message = messages
+
+        model = conf().get("model")
+        # remove system message
+        if session_message[0].get("role") == "system":
+            if app_code or model == "wenxin":
+                session_message.pop(0)
+        body = {
+            "app_code": app_code,
+            "messages": session_message,
+            "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
+            "temperature": conf().get("temperature"),
+            "top_p": conf().get("top_p", 1),
+            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "session_id": session_id,
+            "sender_id": session_id,
+            "channel_type": conf().get("channel_type", "wx")
+        }
+        try:
+            from linkai import LinkAIClient
+            client_id = LinkAIClient.fetch_client_id()
+            if client_id:
+                body["client_id"] = client_id
+                # start: client info deliver
+                if context.kwargs.get("msg"):
+                    body["session_id"] = context.kwargs.get("msg").from_user_id
+                    if context.kwargs.get("msg").is_group:
+                        body["is_group"] = True
+                        body["group_name"] = context.kwargs.get("msg").from_user_nickname
+                        body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
+                    else:
+                        if body.get("channel_type") in ["wechatcom_app"]:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_id
+                        else:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_nickname
+
+        except Exception as e:
+            pass
+        file_id = context.kwargs.get("file_id")
+        if file_id:
+            body["file_id"] = file_id
+        logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
+        headers = {"Authorization": "Bearer " + linkai_api_key}
+        return session_id, body, headers
+
+    def reply_stream(self, query, context: Context = None):
+        if context is None or context.type != ContextType.TEXT:
+            return (yield from super().reply_stream(query, context))
+        try:
+            session_id, body, _ = self._chat_request(query, context)
+        except Exception as e:
+            logger.exception(e)
+            return Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+        result = {}
+        messages = body.pop("messages")
+        yield from self._chat_stream(messages, body, result)
+        if result["completion_tokens"] == 0:
+            return Reply(ReplyType.ERROR, result["content"])
+        # 流结束后才写入会话历史，流式回复不附加智能体和知识库的来源信息
+        self.sessions.session_reply(result["content"], session_id, result.get("total_tokens"), query=query)
+
+    def _stream_request(self, messages, args):
+        # messages为本次请求的消息列表，args为_chat_request构建的其余请求参数
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+        headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
+        return base_url + "/v1/chat/completions", headers, dict(args, messages=messages)
+
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
             enable_image_input = False
@@ -262,7 +294,7 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
             if res.status_code == 200:
                 # execute success
@@ -284,7 +316,7 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
+                    cancellation.sleep(2)
                     logger.warn(f"[LINKAI] do retry, times={retry_count}")
                     return self.reply_text(session, app_code, retry_count + 1)
 
@@ -297,7 +329,7 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            cancellation.sleep(2)
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
             return self.reply_text(session, app_code, retry_count + 1)
 
@@ -306,7 +338,7 @@ class LinkAIBot(Bot):
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +359,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -430,7 +462,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = http_client.get(url)
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -445,31 +477,34 @@ class LinkAISessionManager(SessionManager):
         return messages
 
     def session_reply(self, reply, session_id, total_tokens=None, query=None):
-        session = self.build_session(session_id)
-        if query:
-            session.add_query(query)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 2500)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        with self.history_lock(session_id):
+            session = self.build_session(session_id)
+            if query:
+                session.add_query(query)
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 2500)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
         return session
 
 
 class LinkAISession(ChatGPTSession):
+    def count_message_tokens(self, message):
+        # 按消息列表序列化后的长度估算，每条消息额外计入分隔符", "或首尾括号
+        return len(str(message)) + 2
+
     def calc_tokens(self):
-        if not self.messages:
-            return 0
-        return len(str(self.messages))
+        return Session.calc_tokens(self)
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         cur_tokens = self.calc_tokens()
         if cur_tokens > max_tokens:
             for i in range(0, len(self.messages)):
                 if i > 0 and self.messages[i].get("role") == "assistant" and self.messages[i - 1].get("role") == "user":
-                    self.messages.pop(i)
-                    self.messages.pop(i - 1)
+                    self.pop_message(i)
+                    self.pop_message(i - 1)
                     return self.calc_tokens()
         return cur_tokens
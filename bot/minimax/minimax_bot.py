@@ -1,23 +1,26 @@
 # encoding:utf-8
 
-import time
 
 import openai
 import openai.error
-from bot.bot import Bot
+from bot.chat_stream_bot import ChatStreamBot
 from bot.minimax.minimax_session import MinimaxSession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation
 from common.log import logger
 from config import conf, load_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-import requests
+from common import http_client
 from common import const
 
 
 # ZhipuAI对话模型API
-class MinimaxBot(Bot):
+class MinimaxBot(ChatStreamBot):
+    stream_log_tag = "[Minimax_AI]"
+    model_context_key = "Minimax_model"
+
     def __init__(self):
         super().__init__()
         self.args = {
@@ -107,7 +110,7 @@ class MinimaxBot(Bot):
             self.request_body["messages"].extend(session.messages)
             logger.info("[Minimax_AI] request_body={}".format(self.request_body))
             # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
+            res = http_client.post(self.base_url, headers=headers, json=self.request_body)
 
             # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
             if res.status_code == 200:
@@ -137,7 +140,7 @@ class MinimaxBot(Bot):
                     need_retry = False
 
                 if need_retry:
-                    time.sleep(3)
+                    cancellation.sleep(3)
                     return self.reply_text(session, args, retry_count + 1)
                 else:
                     return result
@@ -149,3 +152,18 @@ class MinimaxBot(Bot):
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
+
+    def _stream_request(self, session: MinimaxSession, args):
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
+        body = dict(self.request_body)
+        body["model"] = args["model"]
+        body["messages"] = list(session.messages)
+        return self.base_url, headers, body
+
+    def _stream_delta(self, event: dict):
+        # 最后一个事件的reply和messages是完整回复，不是增量
+        if event.get("reply"):
+            return None
+        choices = event.get("choices") or [{}]
+        messages = choices[0].get("messages") or [{}]
+        return messages[0].get("text")
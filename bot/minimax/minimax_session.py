@@ -20,11 +20,11 @@ class MinimaxSession(Session):
 
     def add_query(self, query):
         user_item = {"sender_type": "USER", "sender_name": self.session_id, "text": query}
-        self.messages.append(user_item)
+        self.append_message(user_item)
 
     def add_reply(self, reply):
         assistant_item = {"sender_type": "BOT", "sender_name": "MM智能助理", "text": reply}
-        self.messages.append(assistant_item)
+        self.append_message(assistant_item)
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
@@ -37,9 +37,9 @@ class MinimaxSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self.pop_message(1)
             elif len(self.messages) == 2 and self.messages[1]["sender_type"] == "BOT":
-                self.messages.pop(1)
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -57,8 +57,8 @@ class MinimaxSession(Session):
                 cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
-    def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+    def count_message_tokens(self, message):
+        return num_tokens_from_messages([message], self.model)
 
 
 def num_tokens_from_messages(messages, model):
@@ -1,21 +1,24 @@
 # encoding:utf-8
 
-import time
 import json
 import openai
 import openai.error
-from bot.bot import Bot
+from bot.chat_stream_bot import ChatStreamBot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation
 from common.log import logger
 from config import conf, load_config
 from .modelscope_session import ModelScopeSession
-import requests
+from common import http_client
 
 
 # ModelScope对话模型API
-class ModelScopeBot(Bot):
+class ModelScopeBot(ChatStreamBot):
+    stream_log_tag = "[MODELSCOPE_AI]"
+    model_context_key = "modelscope_model"
+
     def __init__(self):
         super().__init__()
         self.sessions = SessionManager(ModelScopeSession, model=conf().get("model") or "Qwen/Qwen2.5-7B-Instruct")
@@ -115,7 +118,7 @@ class ModelScopeBot(Bot):
             
             body = args
             body["messages"] = session.messages
-            res = requests.post(
+            res = http_client.post(
                 self.base_url,
                 headers=headers,
                 data=json.dumps(body)
@@ -154,7 +157,7 @@ class ModelScopeBot(Bot):
                     need_retry = False
 
                 if need_retry:
-                    time.sleep(3)
+                    cancellation.sleep(3)
                     return self.reply_text(session, args, retry_count + 1)
                 else:
                     return result
@@ -171,82 +174,23 @@ class ModelScopeBot(Bot):
         """
         call ModelScope's ChatCompletion to get the answer with stream response
         :param session: a conversation session
-        :param session_id: session id
         :param retry_count: retry count
         :return: {}
         """
-        try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
-            
-            body = args
-            body["messages"] = session.messages
-            body["stream"] = True  # 启用流式响应
-
-            res = requests.post(
-                self.base_url,
-                headers=headers,
-                data=json.dumps(body),
-                stream=True
-            )
-            if res.status_code == 200:
-                content = ""
-                for line in res.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith("data: "):
-                            try:
-                                json_data = json.loads(decoded_line[6:])
-                                delta_content = json_data.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                                if delta_content:
-                                    content += delta_content
-                            except json.JSONDecodeError as e:
-                                pass
-                return {
-                    "total_tokens": 1,  # 流式响应通常不返回token使用情况
-                    "completion_tokens": 1,
-                    "content": content
-                }
-            else:
-                response = res.json()
-                if "errors" in response:
-                    error = response.get("errors")
-                elif "error" in response:
-                    error = response.get("error")
-                else:
-                    error = "Unknown error"
-                logger.error(f"[MODELSCOPE_AI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MODELSCOPE_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
+        result = {}
+        for _ in self._chat_stream(session, args, result, retry_count):
+            pass
+        return result
+
+    def _stream_request(self, session: ModelScopeSession, args):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + self.api_key
+        }
+        body = dict(args)
+        body["messages"] = session.messages
+        return self.base_url, headers, body
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text_stream(session, args, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text_stream(session, args, retry_count + 1)
-            else:
-                return result
     def create_img(self, query, retry_count=0):
         try:
             logger.info("[ModelScopeImage] image_query={}".format(query))
@@ -265,7 +209,7 @@ class ModelScopeBot(Bot):
             json_payload = json.dumps(payload, ensure_ascii=False).encode('utf-8')
             
             # 使用 data 参数发送原始字符串（requests 会自动处理编码）
-            res = requests.post(url, headers=headers, data=json_payload)
+            res = http_client.post(url, headers=headers, data=json_payload)
             
             response_data = res.json()
             image_url = response_data['images'][0]['url']
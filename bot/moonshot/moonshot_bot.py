@@ -1,21 +1,24 @@
 # encoding:utf-8
 
-import time
 
 import openai
 import openai.error
-from bot.bot import Bot
+from bot.chat_stream_bot import ChatStreamBot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation
 from common.log import logger
 from config import conf, load_config
 from .moonshot_session import MoonshotSession
-import requests
+from common import http_client
 
 
 # ZhipuAI对话模型API
-class MoonshotBot(Bot):
+class MoonshotBot(ChatStreamBot):
+    stream_log_tag = "[MOONSHOT_AI]"
+    model_context_key = "moonshot_model"
+
     def __init__(self):
         super().__init__()
         self.sessions = SessionManager(MoonshotSession, model=conf().get("model") or "moonshot-v1-128k")
@@ -99,7 +102,7 @@ class MoonshotBot(Bot):
             body["messages"] = session.messages
             # logger.debug("[MOONSHOT_AI] response={}".format(response))
             # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
+            res = http_client.post(
                 self.base_url,
                 headers=headers,
                 json=body
@@ -132,7 +135,7 @@ class MoonshotBot(Bot):
                     need_retry = False
 
                 if need_retry:
-                    time.sleep(3)
+                    cancellation.sleep(3)
                     return self.reply_text(session, args, retry_count + 1)
                 else:
                     return result
@@ -144,3 +147,12 @@ class MoonshotBot(Bot):
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
+
+    def _stream_request(self, session: MoonshotSession, args):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + self.api_key
+        }
+        body = dict(args)
+        body["messages"] = session.messages
+        return self.base_url, headers, body
@@ -19,9 +19,9 @@ class MoonshotSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self.pop_message(1)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -40,8 +40,8 @@ class MoonshotSession(Session):
                 cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
-    def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+    def count_message_tokens(self, message):
+        return num_tokens_from_messages([message], self.model)
 
 
 def num_tokens_from_messages(messages, model):
@@ -1,6 +1,5 @@
 # encoding:utf-8
 
-import time
 
 import openai
 import openai.error
@@ -11,6 +10,7 @@ from bot.openai.open_ai_session import OpenAISession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation, http_client
 from common.log import logger
 from config import conf
 
@@ -27,6 +27,8 @@ class OpenAIBot(Bot, OpenAIImage):
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
+        # sdk会直接使用预设的Session并只传入session.proxies，代理需设置在该Session上
+        openai.requestssession = http_client.get_sdk_session(proxy)
 
         self.sessions = SessionManager(OpenAISession, model=conf().get("model") or "text-davinci-003")
         self.args = {
@@ -94,18 +96,20 @@ class OpenAIBot(Bot, OpenAIImage):
                 "content": res_content,
             }
         except Exception as e:
+            # 连接因会话重置被中断时不再重试
+            cancellation.check()
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[OPEN_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
                 if need_retry:
-                    time.sleep(20)
+                    cancellation.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[OPEN_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
                 if need_retry:
-                    time.sleep(5)
+                    cancellation.sleep(5)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[OPEN_AI] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -1,372 +1,931 @@
+import threading
+import time
 import uuid
+import weakref
 import json
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from typing import List, Dict, Optional
+from bot.chatgpt.chat_gpt_session import num_tokens_from_message
 from bot.session_manager import Session, SessionManager
+from common import const
+from common.db_pool import get_mysql_pool, get_sqlite_database
+from common.expired_dict import ExpiredDict
 from common.log import logger
 from config import conf
 
+SHORT_ID_LENGTH = 8  # 会话短ID长度，#sessions activate可以只输入ID前缀
+
+
 class PersistentSession(Session):
-    def __init__(self, session_id, system_prompt=None, title=None, db_manager=None):
+    def __init__(self, session_id, system_prompt=None, title=None, db_manager=None, model=None):
         super().__init__(session_id, system_prompt)
         self.title = title or "新对话"
         self.db_manager = db_manager
+        self.model = model
         self.is_loaded = False
-        
+        # 增量持久化：message_seqs与messages一一对应，记录每条消息在库中的序号
+        self.message_seqs = []
+        self.next_seq = 1
+        self.pending_rows = []  # 待入库的新消息 [seq, message, token_count]
+        self.trimmed_seqs = []  # 已移出上下文、待在库中标记为trimmed的消息序号
+        self.lock = threading.RLock()  # 保护消息与待入库变更，后台刷盘线程会并发读取
+
     def load_from_db(self):
         """从数据库加载会话历史"""
         if self.db_manager and not self.is_loaded:
-            messages = self.db_manager.get_session_messages(self.session_id)
-            self.messages = messages
-            self.is_loaded = True
-            
+            # 只加载token预算内的最近消息，避免激活长会话时读取和计算全部历史
+            messages, seqs, token_counts, max_seq = self.db_manager.load_session(
+                self.session_id, max_tokens=conf().get("conversation_max_tokens", 1000), count_tokens=self._estimate_tokens)
+            with self.lock:
+                self.messages = messages
+                self.message_seqs = seqs
+                self.next_seq = max_seq + 1
+                self.pending_rows = []
+                self.trimmed_seqs = []
+                if all(token_counts):
+                    # 复用库中记录的token数，避免重新计算
+                    self.message_tokens = token_counts
+                    self.tokens_total = sum(token_counts)
+                    self._tracked_messages = self.messages
+                self.is_loaded = True
+
     def save_to_db(self):
         """保存会话到数据库"""
         if self.db_manager:
             self.db_manager.save_session(self)
-            
+
     def add_query(self, query):
         super().add_query(query)
         self.save_to_db()
-        
+
     def add_reply(self, reply):
         super().add_reply(reply)
         self.save_to_db()
-        
+
+    def reset(self):
+        with self.lock:
+            self.trimmed_seqs.extend(self.message_seqs)
+            super().reset()
+            self.message_seqs = []
+            self._journal(self.messages[0])
+
+    def append_message(self, item):
+        with self.lock:
+            super().append_message(item)
+            self._journal(item, self.message_tokens[-1] if self._tokens_synced() else None)
+
+    def pop_message(self, index=-1):
+        with self.lock:
+            item = super().pop_message(index)
+            self.trimmed_seqs.append(self.message_seqs.pop(index))
+            return item
+
+    def _journal(self, item, token_count=None):
+        # 新消息入队时即分配序号，刷盘期间发生的裁剪也能对应到库中的记录
+        self.message_seqs.append(self.next_seq)
+        self.pending_rows.append([self.next_seq, item, token_count])
+        self.next_seq += 1
+
+    def count_message_tokens(self, message):
+        return num_tokens_from_message(message, self.model or conf().get("model") or const.GPT35)
+
+    def _estimate_tokens(self, message):
+        try:
+            return self.count_message_tokens(message)
+        except Exception:
+            return len(message["content"])
+
+    def discard_exceeding(self, max_tokens, cur_tokens=None):
+        precise = True
+        try:
+            cur_tokens = self.calc_tokens()
+        except Exception as e:
+            precise = False
+            if cur_tokens is None:
+                raise e
+            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+        # 保留system消息和最新的一条消息
+        first = 1 if self.messages and self.messages[0]["role"] == "system" else 0
+        while cur_tokens > max_tokens and len(self.messages) - first > 1:
+            self.pop_message(first)
+            if precise:
+                cur_tokens = self.calc_tokens()
+            else:
+                cur_tokens = cur_tokens - max_tokens
+        return cur_tokens
+
+    def has_changes(self):
+        return bool(self.pending_rows or self.trimmed_seqs)
+
+    def collect_changes(self):
+        """
+        取出待入库的变更，入库失败时需调用restore_changes放回
+        :return: ([(seq, role, content, token_count)], 待标记trimmed的seq列表)
+        """
+        with self.lock:
+            if len(self.message_seqs) != len(self.messages):
+                # messages被外部直接替换过，已入库的消息全部标记为trimmed，当前消息作为新消息重新写入
+                logger.warning(f"[PersistentSession] 会话 {self.session_id} 消息与入库记录不一致，重新写入")
+                self.trimmed_seqs.extend(self.message_seqs)
+                self.message_seqs = []
+                self.pending_rows = []
+                for msg in self.messages:
+                    self._journal(msg)
+            rows = []
+            for seq, msg, token_count in self.pending_rows:
+                if token_count is None:
+                    try:
+                        token_count = self.count_message_tokens(msg)
+                    except Exception as e:
+                        logger.debug("[PersistentSession] 计算token数失败: {}".format(e))
+                        token_count = 0
+                rows.append((seq, msg["role"], msg["content"], token_count))
+            trimmed_seqs = self.trimmed_seqs
+            self.pending_rows = []
+            self.trimmed_seqs = []
+            return rows, trimmed_seqs
+
+    def restore_changes(self, rows, trimmed_seqs):
+        with self.lock:
+            restored = [[seq, {"role": role, "content": content}, token_count] for seq, role, content, token_count in rows]
+            self.pending_rows = restored + self.pending_rows
+            self.trimmed_seqs = trimmed_seqs + self.trimmed_seqs
+
     def update_title(self, title):
         """更新会话标题"""
         self.title = title
         if self.db_manager:
             self.db_manager.update_session_title(self.session_id, title)
 
+
 class DatabaseManager:
     def __init__(self, db_config: Dict):
         self.db_config = db_config
-        self.db_type = 'mysql'  # 固定为MySQL
-        
-        import pymysql
-        self.conn = pymysql.connect(**self.db_config.get('mysql', {}))
-        self._create_tables_mysql()
+        # 兼容只配置了mysql连接参数的旧配置
+        self.db_type = db_config.get('type') or ('mysql' if 'mysql' in db_config else 'sqlite')
+
+        if self.db_type == 'sqlite':
+            self.sqlite_db = get_sqlite_database(db_config.get('sqlite_path') or 'data/chatbotx.db', paramstyle='format')
+            self._create_tables_sqlite()
+        elif self.db_type == 'mysql':
+            self.pool = get_mysql_pool(self._mysql_params())
+            self._create_tables_mysql()
+        else:
+            raise ValueError(f"[DatabaseManager] 不支持的数据库类型: {self.db_type}")
         self.placeholder = '%s'
-        
+
+        persistence_config = conf().get("session_persistence", {})
+        self.write_behind = None
+        if persistence_config.get("write_mode", "async") == "async":
+            self.write_behind = SessionWriteBehind(
+                self,
+                interval=persistence_config.get("auto_save_interval", 60),
+                batch_size=persistence_config.get("flush_batch_size", 50),
+                max_pending=persistence_config.get("max_pending_writes", 1000),
+            )
+        _db_managers.add(self)
+
         # 添加连接状态检查
+        if self.check_connection():
+            logger.info(f"[DatabaseManager] {self.db_type}数据库连接成功")
+
+    def _mysql_params(self) -> Dict:
+        if self.db_config.get('mysql'):
+            return self.db_config['mysql']
+        return {
+            'host': self.db_config.get('host', 'localhost'),
+            'port': self.db_config.get('port', 3306),
+            'user': self.db_config.get('username', ''),
+            'password': self.db_config.get('password', ''),
+            'database': self.db_config.get('database_name', ''),
+        }
+
+    def _read(self):
+        """获取读连接，用with语句使用"""
+        if self.db_type == 'sqlite':
+            return self.sqlite_db.read()
+        return self.pool.connection()
+
+    @contextmanager
+    def _write(self):
+        """获取写连接，with语句块正常结束时提交事务，异常时回滚"""
+        if self.db_type == 'sqlite':
+            with self.sqlite_db.write() as conn:
+                yield conn
+            return
+        with self.pool.connection() as conn:
+            yield conn
+            conn.commit()
+
+    def check_connection(self):
+        """检查数据库连接状态"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT 1')
-            logger.info(f"[DatabaseManager] MySQL数据库连接成功")
+            with self._read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1')
+            return True
         except Exception as e:
-            logger.error(f"[DatabaseManager] MySQL数据库连接测试失败: {e}")
-    
-    def get_user_sessions(self, user_id: str, limit: int = 50) -> List[Dict]:
-        """获取用户的会话列表"""
-        cursor = self.conn.cursor()
-        query = f'''
-            SELECT id, title, created_at, updated_at, 
-                   (SELECT COUNT(*) FROM chat_messages WHERE session_id = chat_sessions.id) as message_count
-            FROM chat_sessions 
-            WHERE user_id = {self.placeholder} AND is_active = TRUE
-            ORDER BY updated_at DESC
-            LIMIT {self.placeholder}
-        '''
-        
-        # 添加详细的调试日志
-        logger.info(f"[DatabaseManager] 查询用户会话 - user_id: {user_id}, limit: {limit}")
-        logger.info(f"[DatabaseManager] 使用数据库类型: {self.db_type}, 占位符: {self.placeholder}")
-        logger.debug(f"[DatabaseManager] 执行SQL: {query}")
-        logger.debug(f"[DatabaseManager] 参数: ({user_id}, {limit})")
-        
+            logger.error(f"[DatabaseManager] 数据库连接检查失败: {e}")
+            return False
+
+    def get_user_sessions(self, user_id: str, limit: int = 50, before=None) -> List[Dict]:
+        """
+        获取用户的会话列表，按更新时间倒序
+        :param before: 上一页最后一个会话的(updated_at, id)，用于翻页
+        """
         try:
-            cursor.execute(query, (user_id, limit))
-            rows = cursor.fetchall()
-            logger.info(f"[DatabaseManager] SQL执行成功，返回 {len(rows)} 行数据")
-            
-            sessions = []
-            for i, row in enumerate(rows):
-                session_data = {
-                    'id': row[0],
-                    'title': row[1],
-                    'created_at': row[2],
-                    'updated_at': row[3],
-                    'message_count': row[4]
-                }
-                sessions.append(session_data)
-                logger.debug(f"[DatabaseManager] 会话 {i+1}: {session_data}")
-            
-            logger.info(f"[DatabaseManager] 为用户 {user_id} 找到 {len(sessions)} 个会话")
-            return sessions
-            
+            with self._read() as conn:
+                cursor = conn.cursor()
+                if before is None:
+                    cursor.execute('''
+                        SELECT id, title, created_at, updated_at, message_count, last_message_at
+                        FROM chat_sessions
+                        WHERE user_id = %s AND is_active = TRUE
+                        ORDER BY updated_at DESC, id DESC
+                        LIMIT %s
+                    ''', (user_id, limit))
+                else:
+                    updated_at, last_id = before
+                    cursor.execute('''
+                        SELECT id, title, created_at, updated_at, message_count, last_message_at
+                        FROM chat_sessions
+                        WHERE user_id = %s AND is_active = TRUE
+                          AND (updated_at < %s OR (updated_at = %s AND id < %s))
+                        ORDER BY updated_at DESC, id DESC
+                        LIMIT %s
+                    ''', (user_id, updated_at, updated_at, last_id, limit))
+                rows = cursor.fetchall()
         except Exception as e:
-            logger.error(f"[DatabaseManager] 查询会话失败: {e}")
-            logger.error(f"[DatabaseManager] SQL: {query}")
-            logger.error(f"[DatabaseManager] 参数: ({user_id}, {limit})")
+            logger.error(f"[DatabaseManager] 查询用户 {user_id} 的会话失败: {e}")
             return []
-              
+
+        return [{
+            'id': row[0],
+            'title': row[1],
+            'created_at': row[2],
+            'updated_at': row[3],
+            'message_count': row[4] or 0,
+            'last_message_at': row[5],
+        } for row in rows]
+
     def _create_tables_mysql(self):
         """创建MySQL表结构"""
-        cursor = self.conn.cursor()
-        
-        # 创建会话表
+        with self._write() as conn:
+            cursor = conn.cursor()
+
+            # 创建会话表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_sessions (
+                    id VARCHAR(36) PRIMARY KEY,
+                    user_id VARCHAR(255) NOT NULL,
+                    title VARCHAR(500) NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    is_active BOOLEAN DEFAULT TRUE,
+                    system_prompt TEXT,
+                    model VARCHAR(100),
+                    short_id CHAR(8) NOT NULL DEFAULT '',
+                    message_count INT NOT NULL DEFAULT 0,
+                    last_message_at TIMESTAMP NULL,
+                    INDEX idx_user_id (user_id),
+                    INDEX idx_updated_at (updated_at),
+                    INDEX idx_user_updated (user_id, is_active, updated_at, id),
+                    INDEX idx_user_short_id (user_id, short_id, is_active, id)
+                )
+            ''')
+
+            # 创建消息表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_messages (
+                    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    session_id VARCHAR(36) NOT NULL,
+                    role ENUM('user', 'assistant', 'system') NOT NULL,
+                    seq BIGINT NOT NULL DEFAULT 0,
+                    content TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    token_count INT DEFAULT 0,
+                    is_trimmed BOOLEAN NOT NULL DEFAULT FALSE,
+                    INDEX idx_session_id (session_id),
+                    INDEX idx_session_seq (session_id, seq),
+                    INDEX idx_created_at (created_at),
+                    FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
+                )
+            ''')
+
+            self._migrate_tables_mysql(cursor)
+        logger.info("[PersistentSessionManager] MySQL tables created successfully")
+
+    def _create_tables_sqlite(self):
+        """创建SQLite表结构"""
+        with self._write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_sessions (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    is_active BOOLEAN DEFAULT 1,
+                    system_prompt TEXT,
+                    model TEXT,
+                    short_id TEXT NOT NULL DEFAULT '',
+                    message_count INTEGER NOT NULL DEFAULT 0,
+                    last_message_at TIMESTAMP
+                )
+            ''')
+            self._migrate_sessions_sqlite(cursor)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_id ON chat_sessions(user_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at ON chat_sessions(updated_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_updated ON chat_sessions(user_id, is_active, updated_at, id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_short_id ON chat_sessions(user_id, short_id, is_active, id)')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL REFERENCES chat_sessions(id) ON DELETE CASCADE,
+                    role TEXT NOT NULL CHECK (role IN ('user', 'assistant', 'system')),
+                    seq INTEGER NOT NULL DEFAULT 0,
+                    content TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    token_count INTEGER DEFAULT 0,
+                    is_trimmed BOOLEAN NOT NULL DEFAULT 0
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_messages_session_seq ON chat_messages(session_id, seq)')
+        logger.info("[PersistentSessionManager] SQLite tables created successfully")
+
+    def _migrate_tables_mysql(self, cursor):
+        self._migrate_messages_mysql(cursor)
+        self._migrate_sessions_mysql(cursor)
+
+    def _mysql_column_exists(self, cursor, table, column):
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_sessions (
-                id VARCHAR(36) PRIMARY KEY,
-                user_id VARCHAR(255) NOT NULL,
-                title VARCHAR(500) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT TRUE,
-                system_prompt TEXT,
-                model VARCHAR(100),
-                INDEX idx_user_id (user_id),
-                INDEX idx_updated_at (updated_at)
-            )
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+        ''', (table, column))
+        return cursor.fetchone()[0] > 0
+
+    def _migrate_messages_mysql(self, cursor):
+        """为旧版本的消息表补充增量持久化所需的列"""
+        if self._mysql_column_exists(cursor, 'chat_messages', 'seq'):
+            return
+        cursor.execute('''
+            ALTER TABLE chat_messages
+                ADD COLUMN seq BIGINT NOT NULL DEFAULT 0 AFTER role,
+                ADD COLUMN is_trimmed BOOLEAN NOT NULL DEFAULT FALSE,
+                ADD INDEX idx_session_seq (session_id, seq)
         ''')
-        
-        # 创建消息表
+        # 旧数据按自增id保持原有顺序
+        cursor.execute('UPDATE chat_messages SET seq = id')
+        logger.info("[PersistentSessionManager] chat_messages migrated for incremental persistence")
+
+    def _migrate_sessions_mysql(self, cursor):
+        """为旧版本的会话表补充短ID和消息计数列"""
+        if self._mysql_column_exists(cursor, 'chat_sessions', 'message_count'):
+            return
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_messages (
-                id BIGINT AUTO_INCREMENT PRIMARY KEY,
-                session_id VARCHAR(36) NOT NULL,
-                role ENUM('user', 'assistant', 'system') NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                token_count INT DEFAULT 0,
-                INDEX idx_session_id (session_id),
-                INDEX idx_created_at (created_at),
-                FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
-            )
+            ALTER TABLE chat_sessions
+                ADD COLUMN short_id CHAR(8) NOT NULL DEFAULT '',
+                ADD COLUMN message_count INT NOT NULL DEFAULT 0,
+                ADD COLUMN last_message_at TIMESTAMP NULL,
+                ADD INDEX idx_user_updated (user_id, is_active, updated_at, id),
+                ADD INDEX idx_user_short_id (user_id, short_id, is_active, id)
         ''')
-        
-        self.conn.commit()
-        logger.info("[PersistentSessionManager] MySQL tables created successfully")
-        
+        # 回填时保持updated_at不变，避免会话列表顺序被打乱
+        cursor.execute('''
+            UPDATE chat_sessions s
+            LEFT JOIN (
+                SELECT session_id, COUNT(*) AS cnt, MAX(created_at) AS last_at
+                FROM chat_messages GROUP BY session_id
+            ) m ON m.session_id = s.id
+            SET s.short_id = LEFT(s.id, %s),
+                s.message_count = COALESCE(m.cnt, 0),
+                s.last_message_at = m.last_at,
+                s.updated_at = s.updated_at
+        ''', (SHORT_ID_LENGTH,))
+        logger.info("[PersistentSessionManager] chat_sessions migrated with message counters")
+
+    def _migrate_sessions_sqlite(self, cursor):
+        """为旧版本的会话表补充短ID和消息计数列"""
+        cursor.execute('PRAGMA table_info(chat_sessions)')
+        if any(row[1] == 'message_count' for row in cursor.fetchall()):
+            return
+        cursor.execute("ALTER TABLE chat_sessions ADD COLUMN short_id TEXT NOT NULL DEFAULT ''")
+        cursor.execute('ALTER TABLE chat_sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('ALTER TABLE chat_sessions ADD COLUMN last_message_at TIMESTAMP')
+        cursor.execute('''
+            UPDATE chat_sessions SET
+                short_id = substr(id, 1, %s),
+                message_count = (SELECT COUNT(*) FROM chat_messages WHERE session_id = chat_sessions.id),
+                last_message_at = (SELECT MAX(created_at) FROM chat_messages WHERE session_id = chat_sessions.id)
+        ''', (SHORT_ID_LENGTH,))
+        logger.info("[PersistentSessionManager] chat_sessions migrated with message counters")
+
     def create_session(self, user_id: str, title: str = None, system_prompt: str = None, model: str = None) -> str:
         """创建新会话"""
         session_id = str(uuid.uuid4())
-        
+
         # 如果没有提供system_prompt，使用默认配置
         if system_prompt is None:
             from config import conf
             system_prompt = conf().get("character_desc", "你是一个有用的AI助手")
-        
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO chat_sessions (id, user_id, title, system_prompt, model)
-            VALUES (%s, %s, %s, %s, %s)
-        ''', (session_id, user_id, title or "新对话", system_prompt, model))
-        self.conn.commit()
-        
+
+        with self._write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO chat_sessions (id, short_id, user_id, title, system_prompt, model)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            ''', (session_id, session_id[:SHORT_ID_LENGTH], user_id, title or "新对话", system_prompt, model))
+
         logger.info(f"[DatabaseManager] 创建新会话 {session_id}，system_prompt: {system_prompt[:50]}...")
         return session_id
-        
+
     def get_session_messages(self, session_id: str) -> List[Dict]:
         """获取会话的消息历史"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT role, content FROM chat_messages 
-            WHERE session_id = %s 
-            ORDER BY created_at ASC
-        ''', (session_id,))
-        
+        return self.load_session(session_id)[0]
+
+    def load_session(self, session_id: str, max_tokens: int = None, count_tokens=None, page_size: int = 50):
+        """
+        加载会话当前上下文中的消息
+        指定max_tokens时从最新的消息开始分页倒序读取，直到token数达到预算，system消息始终保留
+        :param count_tokens: token_count缺失时用于计算单条消息token数的函数
+        :return: (messages, seq列表, token_count列表, 最大seq)
+        """
+        rows = []
+        system_row = None
+        with self._read() as conn:
+            cursor = conn.cursor()
+            if max_tokens is None:
+                cursor.execute('''
+                    SELECT seq, role, content, token_count FROM chat_messages
+                    WHERE session_id = %s AND is_trimmed = FALSE
+                    ORDER BY seq ASC
+                ''', (session_id,))
+                rows = list(cursor.fetchall())
+            else:
+                total_tokens = 0
+                before_seq = None
+                full = False
+                while not full:
+                    if before_seq is None:
+                        cursor.execute('''
+                            SELECT seq, role, content, token_count FROM chat_messages
+                            WHERE session_id = %s AND is_trimmed = FALSE
+                            ORDER BY seq DESC LIMIT %s
+                        ''', (session_id, page_size))
+                    else:
+                        cursor.execute('''
+                            SELECT seq, role, content, token_count FROM chat_messages
+                            WHERE session_id = %s AND is_trimmed = FALSE AND seq < %s
+                            ORDER BY seq DESC LIMIT %s
+                        ''', (session_id, before_seq, page_size))
+                    page = cursor.fetchall()
+                    for row in page:
+                        if row[1] == 'system':
+                            if system_row is None:
+                                system_row = row
+                            continue
+                        row = _with_token_count(row, count_tokens)
+                        # 至少保留最新的一条消息
+                        if rows and total_tokens + row[3] > max_tokens:
+                            full = True
+                            break
+                        total_tokens += row[3]
+                        rows.append(row)
+                    if len(page) < page_size:
+                        break
+                    before_seq = page[-1][0]
+                if system_row is None:
+                    cursor.execute('''
+                        SELECT seq, role, content, token_count FROM chat_messages
+                        WHERE session_id = %s AND is_trimmed = FALSE AND role = 'system'
+                        ORDER BY seq DESC LIMIT 1
+                    ''', (session_id,))
+                    system_row = cursor.fetchone()
+                rows.reverse()
+                if system_row is not None:
+                    rows.insert(0, _with_token_count(system_row, count_tokens))
+
+            cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM chat_messages WHERE session_id = %s', (session_id,))
+            max_seq = cursor.fetchone()[0]
+
         messages = []
-        for row in cursor.fetchall():
+        seqs = []
+        token_counts = []
+        for row in rows:
+            seqs.append(row[0])
             messages.append({
-                'role': row[0],
-                'content': row[1]
+                'role': row[1],
+                'content': row[2]
             })
-        
-        return messages
-        
+            token_counts.append(row[3] or 0)
+        return messages, seqs, token_counts, max_seq
+
     def save_session(self, session: PersistentSession):
-        """保存会话消息"""
+        """保存会话变更，异步模式下只登记到刷盘队列"""
+        if self.write_behind:
+            self.write_behind.mark_dirty(session)
+        else:
+            self.save_sessions([session])
+
+    def save_sessions(self, sessions: List[PersistentSession]):
+        """增量保存会话：只追加新消息，被裁剪的消息标记为trimmed，多个会话在一个事务中提交"""
+        changes = []
+        for session in sessions:
+            rows, trimmed_seqs = session.collect_changes()
+            if rows or trimmed_seqs:
+                changes.append((session, rows, trimmed_seqs))
+        if not changes:
+            return
         try:
-            cursor = self.conn.cursor()
-            
-            # 更新会话的最后修改时间
-            cursor.execute('''
-                UPDATE chat_sessions 
-                SET updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (session.session_id,))
-            
-            # 删除现有消息（简单实现，可优化为增量保存）
-            cursor.execute('DELETE FROM chat_messages WHERE session_id = %s', (session.session_id,))
-            
-            # 保存所有消息
-            message_count = 0
-            for msg in session.messages:
-                cursor.execute('''
-                    INSERT INTO chat_messages (session_id, role, content)
-                    VALUES (%s, %s, %s)
-                ''', (session.session_id, msg['role'], msg['content']))
-                message_count += 1
-                
-            self.conn.commit()
-            logger.info(f"[DatabaseManager] 成功保存会话 {session.session_id}，共 {message_count} 条消息")
-            
+            with self._write() as conn:
+                cursor = conn.cursor()
+
+                # 更新会话的最后修改时间和消息计数，会话列表不需要再统计消息表
+                appended = {}
+                for session, rows, _ in changes:
+                    appended[session.session_id] = appended.get(session.session_id, 0) + len(rows)
+                counted = [(count, session_id) for session_id, count in appended.items() if count]
+                if counted:
+                    cursor.executemany('''
+                        UPDATE chat_sessions
+                        SET message_count = message_count + %s,
+                            last_message_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = %s
+                    ''', counted)
+                touched = [session_id for session_id, count in appended.items() if not count]
+                if touched:
+                    placeholders = ", ".join(["%s"] * len(touched))
+                    cursor.execute(f'''
+                        UPDATE chat_sessions
+                        SET updated_at = CURRENT_TIMESTAMP
+                        WHERE id IN ({placeholders})
+                    ''', touched)
+
+                message_rows = [(session.session_id,) + row for session, rows, _ in changes for row in rows]
+                if message_rows:
+                    cursor.executemany('''
+                        INSERT INTO chat_messages (session_id, seq, role, content, token_count)
+                        VALUES (%s, %s, %s, %s, %s)
+                    ''', message_rows)
+
+                for session, _, trimmed_seqs in changes:
+                    if not trimmed_seqs:
+                        continue
+                    placeholders = ", ".join(["%s"] * len(trimmed_seqs))
+                    cursor.execute(f'''
+                        UPDATE chat_messages SET is_trimmed = TRUE
+                        WHERE session_id = %s AND seq IN ({placeholders})
+                    ''', [session.session_id] + trimmed_seqs)
+
+            logger.debug(f"[DatabaseManager] 保存 {len(changes)} 个会话，新增 {len(message_rows)} 条消息")
+
         except Exception as e:
-            logger.error(f"[DatabaseManager] 保存会话失败 {session.session_id}: {e}")
-            self.conn.rollback()
+            logger.error(f"[DatabaseManager] 保存会话失败: {e}")
+            for session, rows, trimmed_seqs in changes:
+                session.restore_changes(rows, trimmed_seqs)
             raise
-        
+
+    def flush(self):
+        """把异步队列中的会话变更立即写入数据库"""
+        if self.write_behind:
+            self.write_behind.flush()
+
+    def flush_session(self, session: PersistentSession):
+        """立即写入单个会话的变更，异步模式下与后台刷盘串行执行，保证同一会话的写入顺序"""
+        if self.write_behind:
+            self.write_behind.flush_session(session)
+        else:
+            self.save_sessions([session])
+
+    def close(self):
+        # 连接池由相同配置的组件共享，这里只需写入未刷盘的变更
+        if self.write_behind:
+            self.write_behind.stop()
+
+    def session_exists(self, session_id: str) -> bool:
+        """检查会话是否存在于数据库中"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM chat_sessions WHERE id = %s AND is_active = TRUE', (session_id,))
+            return cursor.fetchone() is not None
+
+    def find_session(self, session_id: str, user_id: str = None):
+        """
+        一次查询找到会话，找不到时返回该用户最新的会话
+        :return: (会话ID, 标题)，都找不到时返回None
+        """
+        with self._read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, title FROM (
+                    SELECT id, title, 0 AS priority FROM chat_sessions
+                    WHERE id = %s AND is_active = TRUE
+                    UNION ALL
+                    SELECT id, title, 1 AS priority FROM (
+                        SELECT id, title FROM chat_sessions
+                        WHERE user_id = %s AND is_active = TRUE
+                        ORDER BY updated_at DESC LIMIT 1
+                    ) latest
+                ) found
+                ORDER BY priority LIMIT 1
+            ''', (session_id, user_id))
+            row = cursor.fetchone()
+            return (row[0], row[1]) if row else None
+
+    def find_user_session_id(self, session_id: str, user_id: str) -> Optional[str]:
+        """查找属于该用户的会话，session_id可以是完整ID或ID前缀"""
+        with self._read() as conn:
+            cursor = conn.cursor()
+            # 如果session_id长度小于完整UUID，按前缀查询，短ID列上的索引覆盖了查询所需的全部列
+            if len(session_id) < SHORT_ID_LENGTH:
+                cursor.execute('''
+                    SELECT id FROM chat_sessions
+                    WHERE user_id = %s AND short_id LIKE %s AND is_active = TRUE
+                    ORDER BY short_id, id LIMIT 1
+                ''', (user_id, session_id.replace('%', '').replace('_', '') + '%'))
+            elif len(session_id) < 36:  # 完整UUID长度为36
+                cursor.execute('''
+                    SELECT id FROM chat_sessions
+                    WHERE user_id = %s AND short_id = %s AND is_active = TRUE AND id LIKE %s
+                    ORDER BY id LIMIT 1
+                ''', (user_id, session_id[:SHORT_ID_LENGTH], session_id.replace('%', '').replace('_', '') + '%'))
+            else:
+                cursor.execute('SELECT id FROM chat_sessions WHERE id = %s AND user_id = %s AND is_active = TRUE',
+                              (session_id, user_id))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
     def update_session_title(self, session_id: str, title: str):
         """更新会话标题"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE chat_sessions 
-            SET title = %s, updated_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-        ''', (title, session_id))
-        self.conn.commit()
-        
+        with self._write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE chat_sessions
+                SET title = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            ''', (title, session_id))
+
     def delete_session(self, session_id: str, user_id: str):
         """删除会话（软删除）"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE chat_sessions 
-            SET is_active = FALSE
-            WHERE id = %s AND user_id = %s
-        ''', (session_id, user_id))
-        self.conn.commit()
+        with self._write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE chat_sessions
+                SET is_active = FALSE
+                WHERE id = %s AND user_id = %s
+            ''', (session_id, user_id))
+
+
+def _with_token_count(row, count_tokens):
+    # 旧数据没有记录token数时现场计算
+    if row[3] or count_tokens is None:
+        return row
+    return (row[0], row[1], row[2], count_tokens({'role': row[1], 'content': row[2]}))
+
+
+class SessionWriteBehind:
+    """
+    会话持久化的写后队列：会话变更先登记为脏会话，由后台线程按时间间隔或变更数量批量写入数据库
+    待写变更超过max_pending时在调用线程上同步刷盘，限制内存中积压的数据量
+    """
+
+    def __init__(self, db_manager: DatabaseManager, interval=60, batch_size=50, max_pending=1000):
+        self.db_manager = db_manager
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.dirty_sessions = OrderedDict()  # id(session) -> session
+        self.pending = 0  # 上次刷盘后的变更次数
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="session-write-behind", daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self, session: PersistentSession):
+        with self.cond:
+            self.dirty_sessions[id(session)] = session
+            self.pending += 1
+            pending = self.pending
+            if pending >= self.batch_size:
+                self.cond.notify()
+        if pending >= self.max_pending:
+            logger.warning(f"[SessionWriteBehind] 待写变更积压 {pending} 条，同步刷盘")
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.cond:
+                sessions = list(self.dirty_sessions.values())
+                self.dirty_sessions.clear()
+                self.pending = 0
+            if not sessions:
+                return
+            start = time.time()
+            try:
+                self.db_manager.save_sessions(sessions)
+                logger.debug(f"[SessionWriteBehind] 刷盘 {len(sessions)} 个会话，耗时 {(time.time() - start) * 1000:.1f}ms")
+            except Exception as e:
+                logger.error(f"[SessionWriteBehind] 刷盘失败，等待下次重试: {e}")
+                with self.cond:
+                    for session in sessions:
+                        if session.has_changes():
+                            self.dirty_sessions[id(session)] = session
+
+    def flush_session(self, session: PersistentSession):
+        with self.flush_lock:
+            with self.cond:
+                self.dirty_sessions.pop(id(session), None)
+            if not session.has_changes():
+                return
+            try:
+                self.db_manager.save_sessions([session])
+            except Exception:
+                with self.cond:
+                    self.dirty_sessions[id(session)] = session
+                raise
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join(timeout=5)
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.stopped and self.pending < self.batch_size:
+                    self.cond.wait(self.interval)
+                if self.stopped:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"[SessionWriteBehind] 刷盘线程异常: {e}")
+
+
+_db_managers = weakref.WeakSet()
+
+
+def flush_all_sessions():
+    """把所有会话持久化队列中的变更写入数据库，进程退出前调用"""
+    for db_manager in list(_db_managers):
+        try:
+            db_manager.flush()
+        except Exception as e:
+            logger.error(f"[DatabaseManager] 退出前刷盘失败: {e}")
+
 
 class PersistentSessionManager(SessionManager):
     def __init__(self, sessioncls, db_config=None, **session_args):
         # 不调用父类的__init__，因为我们要用数据库存储
+        self._init_history_locks()
         self.sessioncls = sessioncls
         self.session_args = session_args
-        self.active_sessions = {}  # 内存中的活跃会话
         self.db_manager = DatabaseManager(db_config or {})
-        
+        # 内存中的活跃会话，超过容量或长时间未访问的会话写入未刷盘的变更后移出内存，再次访问时从数据库加载
+        persistence_config = conf().get("session_persistence", {})
+        self.active_sessions = ExpiredDict(
+            conf().get("expires_in_seconds") or 3600,
+            max_entries=persistence_config.get("max_active_sessions", 10000),
+            on_evict=self._on_session_evicted,
+        )
+        # 仍被处理线程引用的会话对象，移出内存后再次访问时复用同一个对象，避免从数据库再加载出一份副本
+        self.live_sessions = weakref.WeakValueDictionary()
+        self.evictions = 0
+
     def create_new_session(self, user_id: str, title: str = None, system_prompt: str = None) -> str:
         """创建新会话"""
         session_id = self.db_manager.create_session(user_id, title, system_prompt)
         return session_id
-        
+
     def session_query(self, query, session_id):
         """重写父类方法，支持自动创建session"""
         # 对于普通用户消息，session_id通常就是user_id
         user_id = session_id
-        session = self.build_session(session_id, user_id=user_id)
-        session.add_query(query)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        with self.history_lock(session_id):
+            session = self.build_session(session_id, user_id=user_id)
+            session.add_query(query)
+            self._remember_query(session, session_id)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                total_tokens = session.discard_exceeding(max_tokens, None)
+                logger.debug("prompt tokens used={}".format(total_tokens))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
         """重写父类方法，支持自动创建session"""
         # 对于普通用户消息，session_id通常就是user_id
         user_id = session_id
-        session = self.build_session(session_id, user_id=user_id)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        with self.history_lock(session_id):
+            session = self.build_session(session_id, user_id=user_id)
+            self._pair_with_query(session, session_id)
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
         return session
-        
+
     def build_session(self, session_id, system_prompt=None, user_id=None):
         """构建会话，支持从数据库加载，如果用户没有会话则自动创建"""
-        if session_id in self.active_sessions:
-            return self.active_sessions[session_id]
-            
-        # 创建新的持久化会话
-        session = PersistentSession(session_id, system_prompt, db_manager=self.db_manager)
-        
-        # 如果是已存在的会话，从数据库加载
-        if session_id and self._session_exists(session_id):
+        session = self.active_sessions.get(session_id)
+        if session is not None:
+            return session
+        session = self.live_sessions.get(session_id)
+        if session is not None:
+            self.active_sessions[session_id] = session
+            return session
+
+        # 一次查询找到会话本身，或者session_id为用户ID时该用户最新的会话
+        found = self.db_manager.find_session(session_id, user_id if user_id and session_id == user_id else None) if session_id else None
+        if found:
+            actual_session_id, title = found
+            session = PersistentSession(actual_session_id, system_prompt, title, self.db_manager, self.session_args.get("model"))
             session.load_from_db()
+            if actual_session_id != session_id:
+                logger.info(f"[PersistentSessionManager] 为用户 {user_id} 使用最新会话: {actual_session_id}")
+        elif user_id and session_id == user_id:
+            # 用户没有任何会话，创建默认会话
+            default_title = f"对话 {datetime.now().strftime('%m-%d %H:%M')}"
+            actual_session_id = self.create_new_session(user_id, default_title, system_prompt)
+            logger.info(f"[PersistentSessionManager] 为用户 {user_id} 自动创建默认会话: {actual_session_id}")
+            # 使用实际的session_id创建session对象，以原始的session_id作为key存储在active_sessions中
+            session = PersistentSession(actual_session_id, system_prompt, default_title, self.db_manager, self.session_args.get("model"))
         else:
-            # 检查是否是用户ID，如果是则为该用户自动创建默认会话
-            if user_id and session_id == user_id:
-                # 检查用户是否已有会话
-                user_sessions = self.db_manager.get_user_sessions(user_id, limit=1)
-                if not user_sessions:
-                    # 用户没有任何会话，创建默认会话
-                    from datetime import datetime
-                    default_title = f"对话 {datetime.now().strftime('%m-%d %H:%M')}"
-                    actual_session_id = self.create_new_session(user_id, default_title, system_prompt)
-                    logger.info(f"[PersistentSessionManager] 为用户 {user_id} 自动创建默认会话: {actual_session_id}")
-                    
-                    # 重新创建session对象，使用实际的session_id
-                    session = PersistentSession(actual_session_id, system_prompt, default_title, self.db_manager)
-                    # 将新创建的session也存储在active_sessions中，使用原始的session_id作为key
-                    self.active_sessions[session_id] = session
-                    return session
-                else:
-                    # 用户已有会话，使用最新的会话
-                    latest_session = user_sessions[0]
-                    actual_session_id = latest_session['id']
-                    session = PersistentSession(actual_session_id, system_prompt, latest_session.get('title'), self.db_manager)
-                    session.load_from_db()
-                    logger.info(f"[PersistentSessionManager] 为用户 {user_id} 使用最新会话: {actual_session_id}")
-            else:
-                # 新会话，初始化系统提示
-                if system_prompt:
-                    session.reset()
-                
+            session = PersistentSession(session_id, system_prompt, db_manager=self.db_manager, model=self.session_args.get("model"))
+            # 新会话，初始化系统提示
+            if system_prompt:
+                session.reset()
+
         self.active_sessions[session_id] = session
+        self.live_sessions[session_id] = session
         return session
-        
+
+    def _on_session_evicted(self, key, session):
+        """会话移出内存前写入未刷盘的变更，避免再次加载时读到旧数据"""
+        if session.has_changes():
+            try:
+                self.db_manager.flush_session(session)
+            except Exception as e:
+                logger.error(f"[PersistentSessionManager] 移出会话 {key} 时保存失败: {e}")
+        self.evictions += 1
+        if self.evictions % 1000 == 0:
+            logger.info(f"[PersistentSessionManager] 活跃会话缓存: {self.active_sessions.stats()}")
+
+    def cache_stats(self) -> Dict:
+        """活跃会话缓存的命中、未命中和淘汰统计"""
+        return self.active_sessions.stats()
+
     def _session_exists(self, session_id: str) -> bool:
         """检查会话是否存在于数据库中"""
-        cursor = self.db_manager.conn.cursor()
-        cursor.execute('SELECT 1 FROM chat_sessions WHERE id = %s AND is_active = TRUE', (session_id,))
-        return cursor.fetchone() is not None
-        
-    def get_user_sessions(self, user_id: str) -> List[Dict]:
+        return self.db_manager.session_exists(session_id)
+
+    def get_user_sessions(self, user_id: str, limit: int = 50, before=None) -> List[Dict]:
         """获取用户的历史会话列表"""
-        return self.db_manager.get_user_sessions(user_id)
-        
+        return self.db_manager.get_user_sessions(user_id, limit=limit, before=before)
+
     def activate_session(self, session_id: str, user_id: str):
         """激活历史会话"""
         # 验证会话属于该用户
-        cursor = self.db_manager.conn.cursor()
-        
-        # 如果session_id长度小于完整UUID，使用LIKE查询
-        if len(session_id) < 36:  # 完整UUID长度为36
-            cursor.execute('SELECT id FROM chat_sessions WHERE id LIKE %s AND user_id = %s AND is_active = TRUE', 
-                          (f'{session_id}%', user_id))
-            result = cursor.fetchone()
-            if not result:
-                return None
-            # 使用找到的完整ID
-            full_session_id = result[0]
-        else:
-            cursor.execute('SELECT 1 FROM chat_sessions WHERE id = %s AND user_id = %s AND is_active = TRUE', 
-                          (session_id, user_id))
-            if not cursor.fetchone():
-                return None
-            full_session_id = session_id
-            
+        full_session_id = self.db_manager.find_user_session_id(session_id, user_id)
+        if not full_session_id:
+            return None
+
         return self.build_session(full_session_id, user_id=user_id)
-        
+
     def clear_session(self, session_id):
         """清理会话"""
-        if session_id in self.active_sessions:
-            del self.active_sessions[session_id]
-            
+        self.active_sessions.pop(session_id, None)
+        self.live_sessions.pop(session_id, None)
+
     def clear_all_session(self):
         """清理所有会话"""
         self.active_sessions.clear()
-        
+        self.live_sessions.clear()
+
+    def adopt_sessions(self, other) -> bool:
+        """接管旧会话管理器中的活跃会话"""
+        if not isinstance(other, PersistentSessionManager) or other.sessioncls is not self.sessioncls:
+            return False
+        for key, session in other.active_sessions.items():
+            session.db_manager = self.db_manager
+            self.active_sessions[key] = session
+            self.live_sessions[key] = session
+        return True
+
+    def close(self):
+        """会话管理器被替换时写入未刷盘的变更"""
+        self.db_manager.close()
+
     def check_connection(self):
         """检查数据库连接状态"""
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT 1')
-            return True
-        except Exception as e:
-            logger.error(f"[DatabaseManager] 数据库连接检查失败: {e}")
-            return False
-            
-    def reconnect_if_needed(self):
-        """如果连接断开则重新连接"""
-        if not self.check_connection():
-            logger.info("[DatabaseManager] 尝试重新连接MySQL数据库")
-            import pymysql
-            self.conn = pymysql.connect(**self.db_config.get('mysql', {}))
\ No newline at end of file
+        return self.db_manager.check_connection()
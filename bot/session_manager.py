@@ -1,3 +1,4 @@
+import threading
 from datetime import datetime
 from common.expired_dict import ExpiredDict
 from common.log import logger
@@ -10,6 +11,10 @@ class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
+        # 增量token统计：message_tokens与messages一一对应，tokens_total为其总和
+        self.message_tokens = []
+        self.tokens_total = 0
+        self._tracked_messages = self.messages
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
         else:
@@ -26,23 +31,73 @@ class Session(object):
 
     def add_query(self, query):
         user_item = {"role": "user", "content": query}
-        self.messages.append(user_item)
+        self.append_message(user_item)
 
     def add_reply(self, reply):
         assistant_item = {"role": "assistant", "content": reply}
-        self.messages.append(assistant_item)
+        self.append_message(assistant_item)
+
+    def append_message(self, item):
+        """
+        追加消息并累加该消息的token数
+        """
+        synced = self._tokens_synced()
+        self.messages.append(item)
+        if not synced:
+            return
+        try:
+            tokens = self.count_message_tokens(item)
+        except Exception:
+            # 计数失败时放弃增量统计，下次calc_tokens时全量重算
+            self._tracked_messages = None
+            return
+        self.message_tokens.append(tokens)
+        self.tokens_total += tokens
+
+    def pop_message(self, index=-1):
+        """
+        移除消息并扣减该消息的token数
+        """
+        synced = self._tokens_synced()
+        item = self.messages.pop(index)
+        if synced:
+            self.tokens_total -= self.message_tokens.pop(index)
+        return item
+
+    def _tokens_synced(self):
+        # messages被整体替换或被外部直接增删时，统计视为失效
+        return self._tracked_messages is self.messages and len(self.message_tokens) == len(self.messages)
+
+    def _sync_tokens(self):
+        if self._tokens_synced():
+            return
+        message_tokens = [self.count_message_tokens(msg) for msg in self.messages]
+        self.message_tokens = message_tokens
+        self.tokens_total = sum(message_tokens)
+        self._tracked_messages = self.messages
 
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
 
-    def calc_tokens(self):
+    def count_message_tokens(self, message):
+        """
+        计算单条消息的token数，子类按各自模型的计数规则实现
+        """
         raise NotImplementedError
 
+    def calc_tokens(self):
+        self._sync_tokens()
+        return self.tokens_total
+
+
+SESSION_LOCK_STRIPES = 32  # 会话锁的分段数
+
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
+        self._init_history_locks()
         if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
+            sessions = ExpiredDict(conf().get("expires_in_seconds"), max_entries=conf().get("max_sessions"))
         else:
             sessions = dict()
         self.sessions = sessions
@@ -65,27 +120,62 @@ class SessionManager(object):
         return session
 
     def session_query(self, query, session_id):
-        session = self.build_session(session_id)
-        session.add_query(query)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        with self.history_lock(session_id):
+            session = self.build_session(session_id)
+            session.add_query(query)
+            self._remember_query(session, session_id)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                total_tokens = session.discard_exceeding(max_tokens, None)
+                logger.debug("prompt tokens used={}".format(total_tokens))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
-        session = self.build_session(session_id)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        with self.history_lock(session_id):
+            session = self.build_session(session_id)
+            self._pair_with_query(session, session_id)
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
         return session
 
+    def _init_history_locks(self):
+        self.history_locks = [threading.RLock() for _ in range(SESSION_LOCK_STRIPES)]
+        self.pending_query = threading.local()  # 当前线程最近一次提问：(session_id, 消息)
+
+    def history_lock(self, session_id):
+        """
+        同一会话的多条消息并发处理时，修改会话历史需持有该锁
+        """
+        return self.history_locks[hash(session_id) % SESSION_LOCK_STRIPES]
+
+    def _remember_query(self, session, session_id):
+        self.pending_query.item = (session_id, session.messages[-1])
+
+    def _pair_with_query(self, session, session_id):
+        """
+        并发处理同一会话时，其他消息的提问可能已追加在本线程的提问之后
+        回复前把本线程的提问移到末尾，使历史中的提问和回复始终相邻
+        """
+        pending = getattr(self.pending_query, "item", None)
+        self.pending_query.item = None
+        if pending is None or pending[0] != session_id:
+            return
+        item = pending[1]
+        messages = session.messages
+        if messages and messages[-1] is item:
+            return
+        for index in range(len(messages) - 2, -1, -1):
+            if messages[index] is item:
+                session.append_message(session.pop_message(index))
+                return
+
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
@@ -93,6 +183,15 @@ class SessionManager(object):
     def clear_all_session(self):
         self.sessions.clear()
 
+    def adopt_sessions(self, other) -> bool:
+        """
+        接管另一个会话管理器中的会话，bot实例重建时用于保留上下文
+        """
+        if type(other) is not type(self) or other.sessioncls is not self.sessioncls:
+            return False
+        self.sessions = other.sessions
+        return True
+
     def on_handle_context(self, e_context: EventContext):
         context = e_context['context']
         content = context.content
@@ -121,7 +220,7 @@ class SessionManager(object):
     def _ensure_user_has_session(self, user_id: str):
         """确保用户至少有一个会话记录"""
         try:
-            sessions = self.persistent_manager.get_user_sessions(user_id)
+            sessions = self.persistent_manager.get_user_sessions(user_id, limit=1)
             if not sessions:
                 # 自动创建默认会话
                 session_id = self.persistent_manager.create_new_session(
@@ -1,22 +1,25 @@
 # encoding:utf-8
 
-import time
 
 import openai
 import openai.error
-from bot.bot import Bot
+from bot.chat_stream_bot import ChatStreamBot
 from bot.zhipuai.zhipu_ai_session import ZhipuAISession
 from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import cancellation
 from common.log import logger
 from config import conf, load_config
 from zhipuai import ZhipuAI
 
 
 # ZhipuAI对话模型API
-class ZHIPUAIBot(Bot, ZhipuAIImage):
+class ZHIPUAIBot(ChatStreamBot, ZhipuAIImage):
+    stream_log_tag = "[ZHIPU_AI]"
+    model_context_key = "gpt_model"
+
     def __init__(self):
         super().__init__()
         self.sessions = SessionManager(ZhipuAISession, model=conf().get("model") or "ZHIPU_AI")
@@ -115,35 +118,67 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 "content": response.choices[0].message.content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
+            result, need_retry = self._on_request_error(e, session, retry_count)
             if need_retry:
                 logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
                 return self.reply_text(session, api_key, args, retry_count + 1)
             else:
                 return result
+
+    def _chat_stream(self, session: ZhipuAISession, args, result: dict, retry_count=0):
+        content = ""
+        try:
+            response = self.client.chat.completions.create(messages=session.messages, stream=True, **args)
+            for chunk in response:
+                cancellation.check()
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    content += delta
+                    yield delta
+            if content:
+                result.update({"total_tokens": None, "completion_tokens": 1, "content": content})
+            else:
+                result.update({"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"})
+        except Exception as e:
+            if content:
+                # 已经输出了部分内容，不再重试
+                logger.warn("[ZHIPU_AI] stream interrupted: {}".format(e))
+                result.update({"total_tokens": None, "completion_tokens": 1, "content": content})
+                return
+            error_result, need_retry = self._on_request_error(e, session, retry_count)
+            result.update(error_result)
+            if need_retry:
+                logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
+                yield from self._chat_stream(session, args, result, retry_count + 1)
+
+    def _on_request_error(self, e, session, retry_count):
+        """
+        处理请求异常，返回(失败时的回复, 是否重试)，需要重试时已等待完毕
+        """
+        need_retry = retry_count < 2
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            if need_retry:
+                cancellation.sleep(20)
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            if need_retry:
+                cancellation.sleep(5)
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            if need_retry:
+                cancellation.sleep(10)
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            if need_retry:
+                cancellation.sleep(5)
+        else:
+            logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+        return result, need_retry
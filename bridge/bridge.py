@@ -1,3 +1,6 @@
+import json
+import threading
+
 from bot.bot_factory import create_bot
 from bridge.context import Context
 from bridge.reply import Reply
@@ -8,10 +11,68 @@ from config import conf
 from translate.factory import create_translator
 from voice.factory import create_voice
 
+# bot实例依赖的配置项，这些配置变化时才重建bot实例
+BOT_CONFIG_KEYS = (
+    "model",
+    "bot_type",
+    "open_ai_api_key",
+    "open_ai_api_base",
+    "proxy",
+    "use_azure_chatgpt",
+    "azure_deployment_id",
+    "azure_api_version",
+    "rate_limit_chatgpt",
+    "rate_limit_dalle",
+    "temperature",
+    "top_p",
+    "frequency_penalty",
+    "presence_penalty",
+    "request_timeout",
+    "baidu_wenxin_model",
+    "baidu_wenxin_api_key",
+    "baidu_wenxin_secret_key",
+    "baidu_wenxin_prompt_enabled",
+    "xunfei_app_id",
+    "xunfei_api_key",
+    "xunfei_api_secret",
+    "xunfei_domain",
+    "xunfei_spark_url",
+    "claude_api_cookie",
+    "claude_api_key",
+    "qwen_access_key_id",
+    "qwen_access_key_secret",
+    "qwen_agent_key",
+    "qwen_app_id",
+    "dashscope_api_key",
+    "gemini_api_key",
+    "zhipu_ai_api_key",
+    "zhipu_ai_api_base",
+    "moonshot_api_key",
+    "moonshot_base_url",
+    "modelscope_api_key",
+    "modelscope_base_url",
+    "linkai_api_key",
+    "linkai_api_base",
+    "Minimax_api_key",
+    "Minimax_group_id",
+    "Minimax_base_url",
+    "database",
+    "session_persistence",
+)
+
 
 @singleton
 class Bridge(object):
     def __init__(self):
+        self.bots = {}
+        self.chat_bots = {}
+        self.bot_fingerprints = {}  # 每个bot实例创建时的配置指纹
+        self.chat_bot_fingerprints = {}
+        self.fingerprint_cache = {}  # bot_type -> (配置版本, 指纹)
+        self.bot_lock = threading.Lock()
+        self._init_btype()
+
+    def _init_btype(self):
         self.btype = {
             "chat": const.CHATGPT,
             "voice_to_text": conf().get("voice_to_text", "openai"),
@@ -62,19 +123,79 @@ class Bridge(object):
                 if not conf().get("text_to_voice") or conf().get("text_to_voice") in ["openai", const.TTS_1, const.TTS_1_HD]:
                     self.btype["text_to_voice"] = const.LINKAI
 
-        self.bots = {}
-        self.chat_bots = {}
-
     # 模型对应的接口
     def get_bot(self, typename):
-        if typename not in self.bots:
-            logger.info("create bot {} for {}".format(self.btype[typename], typename))
-            self.bots[typename] = create_bot(self.btype[typename])
-        else:
-            # 临时添加：强制重新创建Bot以应用新配置
-            logger.info(f"[Bridge] 强制重新创建Bot: {typename}")
-            self.bots[typename] = create_bot(self.btype[typename])
-        return self.bots[typename]
+        return self._get_pooled_bot(self.bots, self.bot_fingerprints, typename, self.btype[typename])
+
+    def _get_pooled_bot(self, pool, fingerprints, key, bot_type):
+        """
+        从实例池获取bot，只有配置指纹变化时才重建实例并迁移会话
+        """
+        fingerprint = self._bot_fingerprint(bot_type)
+        bot = pool.get(key)
+        if bot is not None and fingerprints.get(key) == fingerprint:
+            return bot
+        with self.bot_lock:
+            bot = pool.get(key)
+            if bot is not None and fingerprints.get(key) == fingerprint:
+                return bot
+            new_bot = self._create(key, bot_type)
+            if bot is not None:
+                logger.info("[Bridge] config changed, rebuild bot {} for {}".format(bot_type, key))
+                self._migrate_bot(bot, new_bot)
+            else:
+                logger.info("create bot {} for {}".format(bot_type, key))
+            pool[key] = new_bot
+            fingerprints[key] = fingerprint
+            logger.info("[Bridge] bot pool size={}".format(self.bot_pool_size()))
+        return new_bot
+
+    def _create(self, typename, bot_type):
+        if typename in ["voice_to_text", "text_to_voice"]:
+            return create_voice(bot_type)
+        elif typename == "translate":
+            return create_translator(bot_type)
+        return create_bot(bot_type)
+
+    def _bot_fingerprint(self, bot_type):
+        # 配置版本不变时直接复用上次计算的指纹
+        config = conf()
+        version = config.version
+        cached = self.fingerprint_cache.get(bot_type)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        values = [bot_type]
+        for key in BOT_CONFIG_KEYS:
+            value = config.get(key)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, sort_keys=True, default=str)
+            values.append(value)
+        fingerprint = tuple(values)
+        self.fingerprint_cache[bot_type] = (version, fingerprint)
+        return fingerprint
+
+    def _migrate_bot(self, old_bot, new_bot):
+        """
+        把旧bot实例的会话迁移到新实例，并释放旧实例的资源
+        """
+        old_sessions = getattr(old_bot, "sessions", None)
+        new_sessions = getattr(new_bot, "sessions", None)
+        if old_sessions is not None and new_sessions is not None and hasattr(new_sessions, "adopt_sessions"):
+            if new_sessions.adopt_sessions(old_sessions):
+                logger.info("[Bridge] sessions migrated to the new bot instance")
+        if old_sessions is not None and old_sessions is not new_sessions and hasattr(old_sessions, "close"):
+            try:
+                old_sessions.close()
+            except Exception as e:
+                logger.warning("[Bridge] close old session manager failed: {}".format(e))
+        if hasattr(old_bot, "close"):
+            try:
+                old_bot.close()
+            except Exception as e:
+                logger.warning("[Bridge] close old bot failed: {}".format(e))
+
+    def bot_pool_size(self):
+        return len(self.bots) + len(self.chat_bots)
 
     def get_bot_type(self, typename):
         return self.btype[typename]
@@ -82,6 +203,12 @@ class Bridge(object):
     def fetch_reply_content(self, query, context: Context) -> Reply:
         return self.get_bot("chat").reply(query, context)
 
+    def fetch_reply_stream(self, query, context: Context):
+        """
+        流式获取回复，返回逐段yield文本增量的生成器
+        """
+        return self.get_bot("chat").reply_stream(query, context)
+
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
@@ -92,12 +219,10 @@ class Bridge(object):
         return self.get_bot("translate").translate(text, from_lang, to_lang)
 
     def find_chat_bot(self, bot_type: str):
-        if self.chat_bots.get(bot_type) is None:
-            self.chat_bots[bot_type] = create_bot(bot_type)
-        return self.chat_bots.get(bot_type)
+        return self._get_pooled_bot(self.chat_bots, self.chat_bot_fingerprints, bot_type, bot_type)
 
     def reset_bot(self):
         """
-        重置bot路由
+        重置bot路由，已创建的bot实例保留在池中，配置指纹变化时才会重建
         """
-        self.__init__()
+        self._init_btype()
@@ -1,14 +1,19 @@
+import heapq
 import os
-import re
 import threading
 import time
-from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.reply_sequencer import ReplySequencer
+from channel.trigger_matcher import get_matcher, strip_mention
+from common import cancellation
+from common.cancellation import CancellationToken, RequestCancelled
 from common.dequeue import Dequeue
+from common.expired_dict import ExpiredDict
+from common.fair_scheduler import DeficitRoundRobin
 from common import memory
 from plugins import *
 
@@ -17,16 +22,27 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+HANDLER_POOL_WORKERS = 8
+handler_pool = ThreadPoolExecutor(max_workers=HANDLER_POOL_WORKERS)  # 处理消息的线程池
+DEFAULT_PRIORITY_CLASSES = {"admin": 8, "vip": 4, "normal": 1}
+SESSION_LOCK_STRIPES = 64  # session锁的分段数
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
 class ChatChannel(Channel):
     name = None  # 登录的用户名
     user_id = None  # 登录的用户id
-    futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
+    futures = {}  # session_id -> {future: context}，重置会话时取消未执行的future，正在执行的通过context中的取消令牌中止
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    session_locks = [threading.RLock() for _ in range(SESSION_LOCK_STRIPES)]  # 按session_id分段加锁，代替全局锁
+    ready_cond = threading.Condition()  # 就绪队列的条件变量，produce和任务结束时通知消费者
+    ready = DeficitRoundRobin()  # 有待处理消息的session_id，按租户和优先级加权轮询，避免个别群或租户占满线程池
+    inflight = 0  # 已提交线程池还未结束的任务数，不超过线程数，排队顺序由ready决定
+    delayed_ready = []  # (到期时间, session_id)小顶堆，合并窗口未结束的session到期后再就绪
+    queued_total = 0  # 所有session排队中的消息数
+    queue_stats = {"admitted": 0, "shed": 0, "expired": 0}  # 准入、拒绝和排队超时丢弃的消息数
+    queue_stats_lock = threading.Lock()
+    busy_replied = ExpiredDict(60)  # 最近回复过繁忙提示的session，避免高峰期刷屏
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
@@ -38,54 +54,22 @@ class ChatChannel(Channel):
     def _compose_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content)
         context.kwargs = kwargs
+        config = conf().snapshot()
         
         if "origin_ctype" not in context:
             context["origin_ctype"] = ctype
             
+        matcher = get_matcher(config)
         first_in = "receiver" not in context
-        
         if first_in:
-            config = conf()
-            cmsg = context["msg"]
-            
-            # 检查是否有目标会话ID（来自会话管理插件）
+            # 检查是否有目标会话ID（来自会话管理插件），指定了会话时不再做群白名单匹配
             target_session_id = context.kwargs.get('target_session_id')
-            
             if target_session_id:
-                # 使用指定的会话ID
-                session_id = target_session_id
-                context["session_id"] = session_id
-                context["receiver"] = cmsg.other_user_id
-            else:
-                # 原有的session_id设置逻辑
-                if context.get("isgroup", False):
-                    group_name = cmsg.other_user_nickname
-                    group_id = cmsg.other_user_id
-                    
-                    group_name_white_list = config.get("group_name_white_list", [])
-                    group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                    
-                    if (
-                        "ALL_GROUP" in group_name_white_list
-                        or group_name in group_name_white_list
-                        or any([keyword in group_name for keyword in group_name_keyword_white_list])
-                    ):
-                        group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
-                        session_id = cmsg.actual_user_id
-                        if any([keyword in group_name for keyword in group_chat_in_one_session]):
-                            session_id = group_id
-                    else:
-                        return None
-                        
-                    context["session_id"] = session_id
-                else:
-                    context["session_id"] = cmsg.other_user_id
-                    
-        # context首次传入时，receiver是None，根据类型设置receiver
-        first_in = "receiver" not in context
+                context["session_id"] = target_session_id
+                context["receiver"] = context["msg"].other_user_id
+                first_in = False
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
-            config = conf()
             cmsg = context["msg"]
             user_data = conf().get_user_data(cmsg.from_user_id)
             logger.info(f"FIRST in, cmsg={cmsg}, user_data={user_data},  context={context}")
@@ -96,23 +80,9 @@ class ChatChannel(Channel):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if matcher.is_group_allowed(group_name):
                     session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if matcher.is_group_in_one_session(group_name):
                         session_id = group_id
                 else:
                     logger.debug(f"No need reply, groupName not in whitelist, group_name={group_name}")
@@ -137,38 +107,33 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel]reference query skipped")
                 return None
 
-            nick_name_black_list = conf().get("nick_name_black_list", [])
             if context.get("isgroup", False):  # 群聊
-                # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
-                    if match_prefix is not None or match_contain is not None:
+                    # 校验关键字
+                    match_prefix = matcher.group_chat_prefix.match_prefix(content)
+                    if match_prefix is not None or matcher.group_chat_keyword.contains(content):
                         flag = True
                         if match_prefix:
                             content = content.replace(match_prefix, "", 1).strip()
                     if context["msg"].is_at:
                         nick_name = context["msg"].actual_user_nickname
-                        if nick_name and nick_name in nick_name_black_list:
+                        if matcher.is_blacklisted(nick_name):
                             # 黑名单过滤
                             logger.warning(f"[chat_channel] Nickname {nick_name} in In BlackList, ignore")
                             return None
 
                         logger.info("[chat_channel]receive group at")
-                        if not conf().get("group_at_off", False):
+                        if not config.group_at_off:
                             flag = True
                         self.name = self.name if self.name is not None else ""  # 部分渠道self.name可能没有赋值
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = strip_mention(content, self.name)
                         if isinstance(context["msg"].at_list, list):
                             for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                                subtract_res = strip_mention(subtract_res, at)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = strip_mention(content, context["msg"].self_display_name)
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
@@ -176,12 +141,12 @@ class ChatChannel(Channel):
                     return None
             else:  # 单聊
                 nick_name = context["msg"].from_user_nickname
-                if nick_name and nick_name in nick_name_black_list:
+                if matcher.is_blacklisted(nick_name):
                     # 黑名单过滤
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = matcher.single_chat_prefix.match_prefix(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -190,35 +155,40 @@ class ChatChannel(Channel):
                     logger.info("[chat_channel]receive single chat msg, but checkprefix didn't match")
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""]))
+            img_match_prefix = matcher.image_create_prefix.match_prefix(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
             else:
                 context.type = ContextType.TEXT
             context.content = content.strip()
-            if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.always_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         elif context.type == ContextType.VOICE:
-            if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.voice_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         return context
 
     def _handle(self, context: Context):
         if context is None or not context.content:
             return
-        logger.debug("[chat_channel] ready to handle context: {}".format(context))
-        # reply的构建步骤
-        reply = self._generate_reply(context)
+        token = context.get("cancel_token")
+        # 绑定取消令牌，bot的重试等待和HTTP请求在会话重置后立即中止
+        with cancellation.bind(token):
+            cancellation.check()
+            logger.debug("[chat_channel] ready to handle context: {}".format(context))
+            # reply的构建步骤
+            reply = self._generate_reply(context)
 
-        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+            logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
-        # reply的包装步骤
-        if reply and reply.content:
-            reply = self._decorate_reply(context, reply)
+            # reply的包装步骤
+            if reply and reply.content:
+                reply = self._decorate_reply(context, reply)
 
-            # reply的发送步骤
-            self._send_reply(context, reply)
+                # reply的发送步骤，已取消的消息不再回复
+                cancellation.check()
+                self._send_reply(context, reply)
 
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         e_context = PluginManager().emit_event(
@@ -232,7 +202,7 @@ class ChatChannel(Channel):
             logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
                 context["channel"] = e_context["channel"]
-                reply = super().build_reply_content(context.content, context)
+                reply = self.build_reply_content(context.content, context)
             elif context.type == ContextType.VOICE:  # 语音消息
                 cmsg = context["msg"]
                 cmsg.prepare()
@@ -291,6 +261,7 @@ class ChatChannel(Channel):
                     reply.content = "不支持发送的消息类型: " + str(reply.type)
 
                 if reply.type == ReplyType.TEXT:
+                    config = conf().snapshot()
                     reply_text = reply.content
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                         reply = super().build_text_to_voice(reply.content)
@@ -298,9 +269,9 @@ class ChatChannel(Channel):
                     if context.get("isgroup", False):
                         if not context.get("no_need_at", False):
                             reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
+                        reply_text = (config.group_chat_reply_prefix or "") + reply_text + (config.group_chat_reply_suffix or "")
                     else:
-                        reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
+                        reply_text = (config.single_chat_reply_prefix or "") + reply_text + (config.single_chat_reply_suffix or "")
                     reply.content = reply_text
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
@@ -324,8 +295,19 @@ class ChatChannel(Channel):
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
+                self._wait_reply_turn(context)
                 self._send(reply, context)
 
+    def _wait_reply_turn(self, context: Context):
+        # 同一会话并发处理时，等前面的消息回复完再发送，保证回复顺序与消息顺序一致
+        seq = context.get("reply_seq")
+        session = self.sessions.get(context.get("session_id"))
+        if seq is None or session is None:
+            return
+        timeout = conf().get("reply_order_timeout_seconds", 60)
+        if not session[2].wait_turn(seq, timeout):
+            logger.warning("[chat_channel] wait for previous replies timeout, session_id={}".format(context["session_id"]))
+
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
             self.send(reply, context)
@@ -348,7 +330,9 @@ class ChatChannel(Channel):
         def func(worker: Future):
             try:
                 worker_exception = worker.exception()
-                if worker_exception:
+                if isinstance(worker_exception, RequestCancelled):
+                    logger.info("Worker cancelled while running, session_id = {}".format(session_id))
+                elif worker_exception:
                     self._fail_callback(session_id, exception=worker_exception, **kwargs)
                 else:
                     self._success_callback(session_id, **kwargs)
@@ -356,71 +340,254 @@ class ChatChannel(Channel):
                 logger.info("Worker cancelled, session_id = {}".format(session_id))
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
-            with self.lock:
-                self.sessions[session_id][1].release()
+            with self.ready_cond:
+                ChatChannel.inflight -= 1
+                self.ready_cond.notify()
+            with self._session_lock(session_id):
+                session = self.sessions.get(session_id)
+                if session is None:
+                    return
+                context_queue, semaphore, sequencer = session
+                context = kwargs.get("context")
+                if context is not None and context.get("reply_seq") is not None:
+                    sequencer.finish(context["reply_seq"])
+                semaphore.release()
+                futures = self.futures.get(session_id)
+                if futures:
+                    futures.pop(worker, None)
+                if not context_queue.empty():
+                    self._mark_ready(session_id)
+                elif semaphore._initial_value == semaphore._value:  # 没有排队的消息，也没有正在处理的任务，回收session
+                    del self.sessions[session_id]
+                    self.futures.pop(session_id, None)
 
         return func
 
+    def _session_lock(self, session_id):
+        return self.session_locks[hash(session_id) % SESSION_LOCK_STRIPES]
+
+    def _mark_ready(self, session_id):
+        flow, weight = self._schedule_flow(session_id)
+        with self.ready_cond:
+            if self.ready.push(session_id, flow, weight):
+                self.ready_cond.notify()
+
+    def _schedule_flow(self, session_id):
+        # 按队首消息确定调度的flow和权重：同一租户的session共享一个flow，没有租户的session各自一个flow
+        session = self.sessions.get(session_id)
+        try:
+            context = session[0].queue[0]
+        except (TypeError, IndexError):
+            return ("session", session_id), 1
+        priority_classes = (conf().snapshot().fair_scheduling or {}).get("priority_classes") or DEFAULT_PRIORITY_CLASSES
+        priority = context.get("priority")
+        if priority not in priority_classes:
+            if context.type == ContextType.TEXT and context.content.startswith("#"):
+                priority = "admin"
+            elif context.get("vip_code"):
+                priority = "vip"
+            else:
+                priority = "normal"
+        weight = priority_classes.get(priority, 1)
+        tenant = context.get("tenant_id") or context.get("vip_code")
+        return (("tenant", tenant) if tenant else ("session", session_id)), weight
+
+    def _mark_ready_at(self, session_id, deadline):
+        with self.ready_cond:
+            heapq.heappush(self.delayed_ready, (deadline, session_id))
+            self.ready_cond.notify()
+
+    def _pop_due_sessions(self):
+        # 持有ready_cond时调用，把合并窗口已结束的session移入就绪队列，返回距下一个到期时间的秒数
+        now = time.monotonic()
+        while self.delayed_ready and self.delayed_ready[0][0] <= now:
+            _, session_id = heapq.heappop(self.delayed_ready)
+            self._mark_ready(session_id)
+        return self.delayed_ready[0][0] - now if self.delayed_ready else None
+
     def produce(self, context: Context):
         session_id = context["session_id"]
-        with self.lock:
-            if session_id not in self.sessions:
-                self.sessions[session_id] = [
-                    Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
-                ]
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+        config = conf().snapshot()
+        coalesce_window = (config.coalesce_window_ms or 0) / 1000
+        is_command = context.type == ContextType.TEXT and context.content.startswith("#")
+        with self._session_lock(session_id):
+            session = self.sessions.get(session_id)
+            context_queue = session[0] if session else None
+            if coalesce_window > 0 and context_queue and _is_coalescible(context) and self._coalesce(context_queue, context):
+                return
+            # 管理命令总是准入，其余消息超过排队上限时拒绝
+            if not is_command and not self._admit(context_queue, config):
+                shed = True
             else:
-                self.sessions[session_id][0].put(context)
+                shed = False
+                if session is None:
+                    context_queue = Dequeue()
+                    self.sessions[session_id] = [
+                        context_queue,
+                        threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+                        ReplySequencer(),
+                    ]
+                context["enqueue_time"] = time.monotonic()
+                if context.get("cancel_token") is None:
+                    context["cancel_token"] = CancellationToken()
+                if "max_queue_age" not in context:
+                    context["max_queue_age"] = config.get("max_queue_age_seconds", 300) or 0
+                if is_command:
+                    context_queue.putleft(context)  # 优先处理管理命令
+                else:
+                    if coalesce_window > 0 and _is_coalescible(context):
+                        context["coalesce_deadline"] = time.monotonic() + coalesce_window
+                    context_queue.put(context)
+                self._count_queue("admitted", 1)
+        if shed:
+            self._shed(context, config)
+            return
+        self._mark_ready(session_id)
+
+    def _admit(self, context_queue, config):
+        max_per_session = config.get("max_queued_per_session", 20) or 0
+        if max_per_session and context_queue is not None and context_queue.qsize() >= max_per_session:
+            return False
+        max_total = config.get("max_queued_total", 2000) or 0
+        return not max_total or ChatChannel.queued_total < max_total
+
+    def _shed(self, context, config):
+        with self.queue_stats_lock:
+            self.queue_stats["shed"] += 1
+        session_id = context["session_id"]
+        logger.warning("[chat_channel] queue full, message shed, session_id={}".format(session_id))
+        if config.overload_policy == "drop" or session_id in self.busy_replied:
+            return
+        self.busy_replied[session_id] = True
+        # 过载时生产者线程不能等待发送和重试，繁忙提示交给处理线程池发送一次
+        reply = Reply(ReplyType.TEXT, config.overload_reply or "当前消息较多，请稍后再试")
+        handler_pool.submit(self._send_busy_reply, reply, context)
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    def _send_busy_reply(self, reply: Reply, context: Context):
+        try:
+            self.send(reply, context)
+        except Exception as e:
+            logger.warning("[chat_channel] send busy reply failed, session_id={}: {}".format(context["session_id"], e))
+
+    def _count_queue(self, stat, queued_delta):
+        with self.queue_stats_lock:
+            if stat:
+                self.queue_stats[stat] += 1
+            ChatChannel.queued_total += queued_delta
+
+    def get_queue_stats(self) -> dict:
+        """
+        获取排队情况：准入、拒绝、排队超时丢弃的消息数，以及当前排队消息数和session数
+        """
+        with self.queue_stats_lock:
+            stats = dict(self.queue_stats)
+            stats["queued"] = ChatChannel.queued_total
+        stats["sessions"] = len(self.sessions)
+        return stats
+
+    def _coalesce(self, context_queue, context):
+        """
+        把同一发送者在合并窗口内的文本消息追加到队尾尚未处理的消息中，持有session锁时调用
+        """
+        if not context_queue.queue:
+            return False
+        last = context_queue.queue[-1]
+        deadline = last.get("coalesce_deadline")
+        if deadline is None or deadline <= time.monotonic() or not _same_sender(last, context):
+            return False
+        last.content = last.content + "\n" + context.content
+        # 回复最后一条消息
+        last["msg"] = context["msg"]
+        logger.debug("[chat_channel] coalesce message into pending context, session_id={}".format(context["session_id"]))
+        return True
+
+    # 消费者函数，单独线程，等待就绪队列中的session并把消息提交到线程池处理
     def consume(self):
         while True:
-            with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                    else:
-                        semaphore.release()
-            time.sleep(0.2)
+            with self.ready_cond:
+                timeout = self._pop_due_sessions()
+                # 线程池有空闲线程时才取出下一个session，由调度器而不是线程池的FIFO队列决定处理顺序
+                while not self.ready or ChatChannel.inflight >= HANDLER_POOL_WORKERS:
+                    self.ready_cond.wait(timeout)
+                    timeout = self._pop_due_sessions()
+                session_id = self.ready.pop()
+            self._dispatch(session_id)
+
+    def _dispatch(self, session_id):
+        with self._session_lock(session_id):
+            session = self.sessions.get(session_id)
+            if session is None:
+                return
+            context_queue, semaphore, sequencer = session
+            self._discard_stale(session_id, context_queue)
+            if context_queue.empty():
+                if semaphore._initial_value == semaphore._value:  # 消息全部超时丢弃，回收session
+                    del self.sessions[session_id]
+                    self.futures.pop(session_id, None)
+                return
+            deadline = context_queue.queue[0].get("coalesce_deadline")
+            if deadline is not None and deadline > time.monotonic():  # 合并窗口未结束，到期后再处理
+                self._mark_ready_at(session_id, deadline)
+                return
+            if not semaphore.acquire(blocking=False):  # 并发已满，等任务结束时再重新就绪
+                return
+            context = context_queue.get()
+            self._count_queue(None, -1)
+            context.kwargs.pop("coalesce_deadline", None)
+            # 按开始处理的顺序编号，插队的管理命令也不会等待排在它后面的消息
+            context["reply_seq"] = sequencer.assign()
+            logger.debug("[chat_channel] consume context: {}".format(context))
+            with self.ready_cond:
+                ChatChannel.inflight += 1
+            future: Future = handler_pool.submit(self._handle, context)
+            self.futures.setdefault(session_id, {})[future] = context
+            if not context_queue.empty():
+                self._mark_ready(session_id)
+        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+
+    def _discard_stale(self, session_id, context_queue):
+        # 持有session锁时调用，丢弃队首排队超时的消息，避免处理已经没有意义的旧消息
+        now = time.monotonic()
+        while not context_queue.empty():
+            context = context_queue.queue[0]
+            max_queue_age = context.get("max_queue_age")
+            if not max_queue_age or now - context.get("enqueue_time", now) <= max_queue_age:
+                return
+            context_queue.get()
+            self._count_queue("expired", -1)
+            logger.warning("[chat_channel] message expired in queue, session_id={}, content={}".format(session_id, context.content))
 
-    # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
+    # 取消session_id对应的所有任务：丢弃排队的消息，取消未执行的任务，并通知正在执行的任务中止
     def cancel_session(self, session_id):
-        with self.lock:
+        with self._session_lock(session_id):
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+                    self._count_queue(None, -cnt)
                 self.sessions[session_id][0] = Dequeue()
+                for future, context in list(self.futures.get(session_id, {}).items()):
+                    # 取消成功时回调会同步执行，可能回收该session
+                    if not future.cancel() and context.get("cancel_token") is not None:
+                        context["cancel_token"].cancel("session {} cancelled".format(session_id))
 
     def cancel_all_session(self):
-        with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+        for session_id in list(self.sessions.keys()):
+            self.cancel_session(session_id)
+
+
+def _is_coalescible(context):
+    # 只合并普通文本消息，#和$开头的命令单独处理
+    return context.type == ContextType.TEXT and not context.content.startswith(("#", "$"))
+
+
+def _same_sender(context, other):
+    msg, other_msg = context["msg"], other["msg"]
+    return (
+        getattr(msg, "from_user_id", None) == getattr(other_msg, "from_user_id", None)
+        and getattr(msg, "actual_user_id", None) == getattr(other_msg, "actual_user_id", None)
+        and context.get("desire_rtype") == other.get("desire_rtype")
+    )
 
 
 def check_prefix(content, prefix_list):
@@ -6,11 +6,16 @@
 """
 
 # -*- coding=utf-8 -*-
+import queue
+import threading
+import time
 import uuid
 
-import requests
+from common import cancellation, http_client
 import web
 from channel.feishu.feishu_message import FeishuMessage
+from channel.feishu.feishu_token import INVALID_TOKEN_CODES, get_token_manager
+from channel.feishu.feishu_user_cache import FeishuUserCache
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
 from common.log import logger
@@ -27,6 +32,8 @@ from plugins.event import Event, EventContext
 from plugins.plugin_manager import PluginManager
 
 URL_VERIFICATION = "url_verification"
+DEFAULT_EVENT_WORKERS = 4
+DEFAULT_EVENT_QUEUE_SIZE = 1000
 
 
 @singleton
@@ -38,14 +45,19 @@ class FeiShuChanel(ChatChannel):
     def __init__(self):
         super().__init__()
         # 历史消息id暂存，用于幂等控制
-        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1)
+        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1, max_entries=conf().get("received_msgs_max_entries"))
         logger.info("[FeiShu] app_id={}, app_secret={} verification_token={}".format(
             self.feishu_app_id, self.feishu_app_secret, self.feishu_token))
         # 无需群校验和前缀
         conf()["group_name_white_list"] = ["ALL_GROUP"]
         conf()["single_chat_prefix"] = [""]
+        # 回调只校验、去重后入队，消息解析和上下文构建由后台线程完成，同一会话的事件由同一线程按顺序处理
+        self.event_queues = []
 
     def startup(self):
+        # 启动时建好用户缓存表，之后每条消息复用同一个缓存实例
+        FeishuUserCache()
+        self._start_event_workers()
         urls = (
             '/', 'channel.feishu.feishu_channel.FeishuController'
         )
@@ -54,16 +66,14 @@ class FeiShuChanel(ChatChannel):
         web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
 
     def send(self, reply: Reply, context: Context):
-        msg = context.get("msg")
-        is_group = context["isgroup"]
-        if msg:
-            access_token = msg.access_token
-        else:
-            access_token = self.fetch_access_token()
-        headers = {
-            "Authorization": "Bearer " + access_token,
-            "Content-Type": "application/json",
-        }
+        card_message_id = context.get("feishu_card_message_id")
+        if card_message_id and reply.type in (ReplyType.TEXT, ReplyType.ERROR, ReplyType.INFO):
+            # 流式回复已发出卡片，最终内容更新到卡片中
+            if self._update_card(card_message_id, reply.content):
+                context["feishu_card_finalized"] = True
+                logger.info(f"[FeiShu] stream reply finished, message_id={card_message_id}")
+                return
+        access_token = self.fetch_access_token()
         msg_type = "text"
         logger.info(f"[FeiShu] start send reply message, type={context.type}, content={reply.content}")
         reply_content = reply.content
@@ -76,55 +86,231 @@ class FeiShuChanel(ChatChannel):
                 return
             msg_type = "image"
             content_key = "image_key"
-        if is_group:
+        res = self._post_message(context, msg_type, json.dumps({content_key: reply_content}), access_token)
+        if res.get("code") == 0:
+            logger.info(f"[FeiShu] send message success")
+
+    def _post_message(self, context: Context, msg_type, content, access_token) -> dict:
+        """
+        群聊中回复原消息，私聊中发送新消息，返回接口响应
+        """
+        headers = {
+            "Authorization": "Bearer " + access_token,
+            "Content-Type": "application/json",
+        }
+        data = {
+            "msg_type": msg_type,
+            "content": content
+        }
+        if context["isgroup"]:
             # 群聊中直接回复
-            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{msg.msg_id}/reply"
-            data = {
-                "msg_type": msg_type,
-                "content": json.dumps({content_key: reply_content})
-            }
-            res = requests.post(url=url, headers=headers, json=data, timeout=(5, 10))
+            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{context.get('msg').msg_id}/reply"
+            res = http_client.post(url=url, headers=headers, json=data, timeout=(5, 10))
         else:
             url = "https://open.feishu.cn/open-apis/im/v1/messages"
             params = {"receive_id_type": context.get("receive_id_type") or "open_id"}
-            data = {
-                "receive_id": context.get("receiver"),
-                "msg_type": msg_type,
-                "content": json.dumps({content_key: reply_content})
-            }
-            res = requests.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
+            data["receive_id"] = context.get("receiver")
+            res = http_client.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
         res = res.json()
-        if res.get("code") == 0:
-            logger.info(f"[FeiShu] send message success")
-        else:
+        if res.get("code") != 0:
+            if res.get("code") in INVALID_TOKEN_CODES:
+                get_token_manager().invalidate(access_token)
             logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
+        return res
 
+    def _handle(self, context: Context):
+        try:
+            super()._handle(context)
+        finally:
+            # 卡片中是未经过回复过滤的流式内容，最终回复被插件丢弃、不是文本或处理中断时撤回卡片
+            card_message_id = context.get("feishu_card_message_id") if context else None
+            if card_message_id and not context.get("feishu_card_finalized"):
+                self._recall_card(card_message_id)
 
-    def fetch_access_token(self) -> str:
-        url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
+    def build_reply_content(self, query, context: Context = None) -> Reply:
+        if not conf().get("feishu_stream_reply") or context is None or context.type != ContextType.TEXT:
+            return super().build_reply_content(query, context)
+        return self._stream_reply(query, context)
+
+    def _stream_reply(self, query, context: Context) -> Reply:
+        """
+        先发送卡片，再随着bot流式输出节流更新卡片内容，返回完整回复，最终内容由send更新到卡片
+        """
+        interval = (conf().get("feishu_stream_interval_ms", 500) or 0) / 1000
+        # 卡片也是回复，需要等待同一会话前面的回复发出
+        self._wait_reply_turn(context)
+        card_message_id = self._send_card(context, conf().get("feishu_stream_placeholder", "思考中..."))
+        if card_message_id:
+            context["feishu_card_message_id"] = card_message_id
+        content = ""
+        last_update = time.monotonic()
+        stream = self.build_reply_stream(query, context)
+        try:
+            while True:
+                delta = next(stream)
+                content += delta
+                now = time.monotonic()
+                if card_message_id and now - last_update >= interval:
+                    self._update_card(card_message_id, content)
+                    last_update = now
+        except StopIteration as e:
+            # 失败或非文本回复由生成器返回，经过插件处理后由send更新到卡片
+            if e.value is not None and not content:
+                return e.value
+        except Exception as e:
+            # 返回的回复经过插件过滤后由send更新到卡片，已输出部分内容时保留
+            logger.exception(f"[FeiShu] stream reply failed: {e}")
+        if not content:
+            return Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+        return Reply(ReplyType.TEXT, content)
+
+    def _send_card(self, context: Context, text):
+        res = self._post_message(context, "interactive", _card_content(text), self.fetch_access_token())
+        if res.get("code") != 0:
+            return None
+        return res.get("data", {}).get("message_id")
+
+    def _update_card(self, message_id, text) -> bool:
+        access_token = self.fetch_access_token()
         headers = {
-            "Content-Type": "application/json"
-        }
-        req_body = {
-            "app_id": self.feishu_app_id,
-            "app_secret": self.feishu_app_secret
+            "Authorization": "Bearer " + access_token,
+            "Content-Type": "application/json",
         }
-        data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
-        if response.status_code == 200:
-            res = response.json()
-            if res.get("code") != 0:
-                logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
+        url = f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}"
+        try:
+            res = http_client.request("PATCH", url, headers=headers, json={"content": _card_content(text)}, timeout=(5, 10)).json()
+        except Exception as e:
+            logger.warning(f"[FeiShu] update card failed, message_id={message_id}, {e}")
+            return False
+        if res.get("code") != 0:
+            if res.get("code") in INVALID_TOKEN_CODES:
+                get_token_manager().invalidate(access_token)
+            logger.warning(f"[FeiShu] update card failed, code={res.get('code')}, msg={res.get('msg')}")
+            return False
+        return True
+
+    def _recall_card(self, message_id):
+        access_token = self.fetch_access_token()
+        headers = {"Authorization": "Bearer " + access_token}
+        url = f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}"
+        try:
+            # 会话重置时取消令牌已触发，撤回请求不绑定令牌
+            with cancellation.bind(None):
+                res = http_client.request("DELETE", url, headers=headers, timeout=(5, 10)).json()
+        except Exception as e:
+            logger.warning(f"[FeiShu] recall card failed, message_id={message_id}, {e}")
+            return
+        if res.get("code") != 0:
+            if res.get("code") in INVALID_TOKEN_CODES:
+                get_token_manager().invalidate(access_token)
+            logger.warning(f"[FeiShu] recall card failed, code={res.get('code')}, msg={res.get('msg')}")
+            return
+        logger.info(f"[FeiShu] stream card recalled, message_id={message_id}")
+
+    def fetch_access_token(self) -> str:
+        """
+        获取缓存的tenant_access_token，过期前由后台刷新
+        """
+        return get_token_manager().get()
+
+
+    def _start_event_workers(self):
+        workers = conf().get("feishu_event_workers", DEFAULT_EVENT_WORKERS) or DEFAULT_EVENT_WORKERS
+        queue_size = conf().get("feishu_event_queue_size", DEFAULT_EVENT_QUEUE_SIZE) or 0
+        for i in range(workers):
+            event_queue = queue.Queue(maxsize=queue_size)
+            self.event_queues.append(event_queue)
+            threading.Thread(target=self._event_loop, args=(event_queue,), name=f"feishu-event-{i}", daemon=True).start()
+
+    def enqueue_event(self, event, is_group, receive_id_type) -> bool:
+        """
+        把消息事件交给后台线程处理，按会话分配线程以保持顺序，队列已满时返回False
+        """
+        msg = event.get("message")
+        shard_key = msg.get("chat_id") if is_group else event.get("sender", {}).get("sender_id", {}).get("open_id")
+        event_queue = self.event_queues[hash(shard_key) % len(self.event_queues)]
+        try:
+            event_queue.put_nowait((event, is_group, receive_id_type))
+            return True
+        except queue.Full:
+            return False
+
+    def _event_loop(self, event_queue):
+        while True:
+            event, is_group, receive_id_type = event_queue.get()
+            try:
+                self._process_event(event, is_group, receive_id_type)
+            except Exception as e:
+                logger.exception(f"[FeiShu] process event failed, message_id={event.get('message', {}).get('message_id')}: {e}")
+
+    def _process_event(self, event, is_group, receive_id_type):
+        msg = event.get("message")
+        # 构造飞书消息对象
+        feishu_msg = FeishuMessage(event, is_group=is_group)
+        if not feishu_msg:
+            return
+
+        # 先创建上下文，用于记录所有消息
+        context = self._compose_event_context(
+            feishu_msg.ctype,
+            feishu_msg.content,
+            isgroup=is_group,
+            msg=feishu_msg,
+            receive_id_type=receive_id_type,
+            no_need_at=True
+        )
+
+        # 触发消息记录事件，确保所有消息都被记录
+        if context:
+            # 创建一个事件上下文，仅用于记录消息
+            log_context = EventContext(Event.ON_RECEIVE_MESSAGE, {"context": context})
+            PluginManager().emit_event(log_context)
+
+        # 群聊中未@不响应处理逻辑
+        if is_group:
+            if not msg.get("mentions") and msg.get("message_type") == "text":
+                # 群聊中未@不响应，但消息已记录
+                return
+            if msg.get("mentions") and msg.get("mentions")[0].get("name") != conf().get("feishu_bot_name") and msg.get("message_type") == "text":
+                # 不是@机器人，不响应，但消息已记录
+                return
+
+        # 继续处理需要响应的消息
+        if context:
+            self.produce(context)
+        logger.info(f"[FeiShu] query={feishu_msg.content}, type={feishu_msg.ctype}")
+
+    def _compose_event_context(self, ctype: ContextType, content, **kwargs):
+        context = Context(ctype, content)
+        context.kwargs = kwargs
+        if "origin_ctype" not in context:
+            context["origin_ctype"] = ctype
+
+        cmsg = context["msg"]
+        context["session_id"] = cmsg.from_user_id
+        context["receiver"] = cmsg.other_user_id
+
+        if ctype == ContextType.TEXT:
+            # 1.文本请求
+            # 图片生成处理
+            img_match_prefix = check_prefix(content, conf().get("image_create_prefix"))
+            if img_match_prefix:
+                content = content.replace(img_match_prefix, "", 1)
+                context.type = ContextType.IMAGE_CREATE
             else:
-                return res.get("tenant_access_token")
-        else:
-            logger.error(f"[FeiShu] fetch token error, res={response}")
+                context.type = ContextType.TEXT
+            context.content = content.strip()
 
+        elif context.type == ContextType.VOICE:
+            # 2.语音请求
+            if "desire_rtype" not in context and conf().get("voice_reply_voice"):
+                context["desire_rtype"] = ReplyType.VOICE
+
+        return context
 
     def _upload_image_url(self, img_url, access_token):
         logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
+        response = http_client.get(img_url)
         suffix = utils.get_path_suffix(img_url)
         temp_name = str(uuid.uuid4()) + "." + suffix
         if response.status_code == 200:
@@ -141,13 +327,21 @@ class FeiShuChanel(ChatChannel):
             'Authorization': f'Bearer {access_token}',
         }
         with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
+            upload_response = http_client.post(upload_url, files={"image": file}, data=data, headers=headers)
             logger.info(f"[FeiShu] upload file, res={upload_response.content}")
             os.remove(temp_name)
             return upload_response.json().get("data").get("image_key")
 
 
 
+def _card_content(text):
+    # update_multi为共享卡片，更新后所有人可见
+    return json.dumps({
+        "config": {"wide_screen_mode": True, "update_multi": True},
+        "elements": [{"tag": "markdown", "content": text}],
+    })
+
+
 class FeishuController:
     # 类常量
     FAILED_MSG = '{"success": false}'
@@ -202,70 +396,16 @@ class FeishuController:
                     logger.warning("[FeiShu] message ignore")
                     return self.SUCCESS_MSG
                 
-                # 构造飞书消息对象
-                feishu_msg = FeishuMessage(event, is_group=is_group, access_token=channel.fetch_access_token())
-                if not feishu_msg:
-                    return self.SUCCESS_MSG
-                
-                # 先创建上下文，用于记录所有消息
-                context = self._compose_context(
-                    feishu_msg.ctype,
-                    feishu_msg.content,
-                    isgroup=is_group,
-                    msg=feishu_msg,
-                    receive_id_type=receive_id_type,
-                    no_need_at=True
-                )
-                
-                # 触发消息记录事件，确保所有消息都被记录
-                if context:
-                    # 创建一个事件上下文，仅用于记录消息
-                    log_context = EventContext(Event.ON_RECEIVE_MESSAGE, {"context": context})
-                    PluginManager().emit_event(log_context)
-                
-                # 群聊中未@不响应处理逻辑
-                if is_group:
-                    if not msg.get("mentions") and msg.get("message_type") == "text":
-                        # 群聊中未@不响应，但消息已记录
-                        return self.SUCCESS_MSG
-                    if msg.get("mentions") and msg.get("mentions")[0].get("name") != conf().get("feishu_bot_name") and msg.get("message_type") == "text":
-                        # 不是@机器人，不响应，但消息已记录
-                        return self.SUCCESS_MSG
-                
-                # 继续处理需要响应的消息
-                if context:
-                    channel.produce(context)
-                logger.info(f"[FeiShu] query={feishu_msg.content}, type={feishu_msg.ctype}")
+                # 消息解析、用户信息查询和插件事件在后台处理，回调立即返回，避免飞书超时重推
+                if not channel.enqueue_event(event, is_group, receive_id_type):
+                    logger.warning(f"[FeiShu] event queue full, message_id={msg.get('message_id')}")
+                    # 允许飞书重推时再次接收，飞书只对非2xx响应重推，返回200会被当作已送达
+                    channel.receivedMsgs.pop(msg.get("message_id"), None)
+                    raise web.HTTPError("503 Service Unavailable", {}, self.FAILED_MSG)
             return self.SUCCESS_MSG
     
+        except web.HTTPError:
+            raise
         except Exception as e:
             logger.error(e)
             return self.FAILED_MSG
-
-    def _compose_context(self, ctype: ContextType, content, **kwargs):
-        context = Context(ctype, content)
-        context.kwargs = kwargs
-        if "origin_ctype" not in context:
-            context["origin_ctype"] = ctype
-
-        cmsg = context["msg"]
-        context["session_id"] = cmsg.from_user_id
-        context["receiver"] = cmsg.other_user_id
-
-        if ctype == ContextType.TEXT:
-            # 1.文本请求
-            # 图片生成处理
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix"))
-            if img_match_prefix:
-                content = content.replace(img_match_prefix, "", 1)
-                context.type = ContextType.IMAGE_CREATE
-            else:
-                context.type = ContextType.TEXT
-            context.content = content.strip()
-
-        elif context.type == ContextType.VOICE:
-            # 2.语音请求
-            if "desire_rtype" not in context and conf().get("voice_reply_voice"):
-                context["desire_rtype"] = ReplyType.VOICE
-
-        return context
@@ -2,10 +2,11 @@ from typing import Optional, Dict, Any
 from bridge.context import ContextType
 from channel.chat_message import ChatMessage
 import json
-import requests
+from common import http_client
 from common.log import logger
 from common.tmp_dir import TmpDir
 from common import utils
+from .feishu_token import get_access_token
 from .feishu_user_cache import FeishuUserCache
 
 
@@ -19,12 +20,14 @@ class FeishuMessage(ChatMessage):
         # 调用父类构造函数，传递原始消息对象
         super().__init__(event)
         
-        self.access_token = access_token
+        # 未指定token时使用缓存的token
+        self._access_token = access_token
+        access_token = self.access_token
         self.msg_id = msg.get("message_id")
         self.create_time = msg.get("create_time")
         self.is_group = is_group
         
-        # 初始化用户缓存
+        # 进程内共享的用户缓存
         self.user_cache = FeishuUserCache()
         
         msg_type = msg.get("message_type")
@@ -50,7 +53,7 @@ class FeishuMessage(ChatMessage):
                 params = {
                     "type": "file"
                 }
-                response = requests.get(url=url, headers=headers, params=params)
+                response = http_client.get(url=url, headers=headers, params=params)
                 if response.status_code == 200:
                     with open(self.content, "wb") as f:
                         f.write(response.content)
@@ -95,31 +98,26 @@ class FeishuMessage(ChatMessage):
             self.content = self.content.replace("@_user_1", "").strip()
             
             # 获取群聊信息
-            self._load_group_info(msg.get("chat_id"), access_token)
+            self._load_group_info(msg.get("chat_id"), sender.get("tenant_key", ""))
         else:
             # 私聊
             self.other_user_id = self.from_user_id
             self.actual_user_id = self.from_user_id
     
+    @property
+    def access_token(self):
+        # 文件下载等延后执行的请求在使用时取token，避免使用已过期的token
+        return self._access_token or get_access_token()
+
     def _load_user_info(self, sender, access_token):
         """加载并缓存用户信息"""
         try:
             sender_id = sender.get("sender_id", {}).get("open_id")
             tenant_key = sender.get("tenant_key", "")
             
-            if sender_id and access_token:
-                # 先从缓存获取
-                cached_user = self.user_cache.get_user_info(sender_id, tenant_key)
-                if cached_user:
-                    self.from_user_nickname = cached_user.get('name') or cached_user.get('nickname') or f"用户({sender_id[:8]}...)"
-                    logger.debug(f"[FeiShu] Using cached user info for {sender_id}")
-                else:
-                    # 缓存未命中，调用API获取用户信息
-                    user_info = self._get_user_info_by_open_id(sender_id, access_token, tenant_key)
-                    if user_info:
-                        self.from_user_nickname = user_info
-                    else:
-                        self.from_user_nickname = f"用户({sender_id[:8]}...)"
+            if sender_id:
+                # 内存缓存命中时只需一次字典查找
+                self.from_user_nickname = self.user_cache.get_user_name(sender_id, tenant_key) or f"用户({sender_id[:8]}...)"
             else:
                 self.from_user_nickname = "未知用户"
                 
@@ -127,67 +125,17 @@ class FeishuMessage(ChatMessage):
             logger.error(f"[FeiShu] Failed to load user info: {e}")
             self.from_user_nickname = "未知用户"
     
-    def _load_group_info(self, chat_id, access_token):
+    def _load_group_info(self, chat_id, tenant_key=""):
         """加载群聊信息"""
         try:
-            if chat_id and access_token:
-                # 先从缓存获取群聊信息
-                cached_group = self.user_cache.get_group_info(chat_id)
-                if cached_group:
-                    self.other_user_nickname = cached_group.get('name', f"群聊({chat_id[:8]}...)")
-                    logger.debug(f"[FeiShu] Using cached group info for {chat_id}")
-                else:
-                    # 缓存未命中，调用API获取群聊信息
-                    group_info = self._get_group_info_by_chat_id(chat_id, access_token)
-                    if group_info:
-                        self.other_user_nickname = group_info
-                    else:
-                        self.other_user_nickname = f"群聊({chat_id[:8]}...)"
+            if chat_id:
+                self.other_user_nickname = self.user_cache.get_group_name(chat_id, tenant_key) or f"群聊({chat_id[:8]}...)"
             else:
                 self.other_user_nickname = "未知群聊"
                 
         except Exception as e:
             logger.error(f"[FeiShu] Failed to load group info: {e}")
             self.other_user_nickname = "未知群聊"
-    
-    def _get_group_info_by_chat_id(self, chat_id: str, access_token: str) -> Optional[str]:
-        """通过 chat_id 获取群聊信息"""
-        try:
-            url = f"https://open.feishu.cn/open-apis/im/v1/chats/{chat_id}"
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json; charset=utf-8"
-            }
-            
-            response = requests.get(url=url, headers=headers)
-            logger.debug(f"[FeiShu] Get group info response: {response.status_code} {response.text}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                if result.get('code') == 0:
-                    data = result.get('data', {})
-                    
-                    # 保存群聊信息到缓存
-                    self.user_cache.save_group_info(chat_id, data)
-                    
-                    # 返回群聊名称
-                    name = data.get('name', '')
-                    if name and name.strip():
-                        return name.strip()
-                    
-                    description = data.get('description', '')
-                    if description and description.strip():
-                        return description.strip()
-                        
-                else:
-                    logger.warning(f"[FeiShu] API error when getting group info for {chat_id}: {result.get('msg')}")
-            else:
-                logger.warning(f"[FeiShu] HTTP error when getting group info for {chat_id}: {response.status_code}")
-                
-        except Exception as e:
-            logger.error(f"[FeiShu] Exception when getting group info for {chat_id}: {e}")
-        
-        return None
 
     def _get_message_content(self, message_id: str, access_token: str) -> str:
         """根据飞书官方API获取指定消息的内容"""
@@ -198,7 +146,7 @@ class FeishuMessage(ChatMessage):
                 "Content-Type": "application/json; charset=utf-8"
             }
             
-            response = requests.get(url=url, headers=headers)
+            response = http_client.get(url=url, headers=headers)
             if response.status_code == 200:
                 result = response.json()
                 if result.get('code') == 0:
@@ -254,7 +202,7 @@ class FeishuMessage(ChatMessage):
                 "Content-Type": "application/json; charset=utf-8"
             }
             
-            response = requests.get(url=url, headers=headers)
+            response = http_client.get(url=url, headers=headers)
             logger.debug(f"[FeiShu] Get merge_forward message detail response: {response.status_code} {response.text}")
             
             if response.status_code == 200:
@@ -265,6 +213,13 @@ class FeishuMessage(ChatMessage):
                     # 检查是否有items数组（包含子消息）
                     items = data.get('items', [])
                     if items:
+                        # 子消息的发送者批量加载，避免逐个查询
+                        senders = [item.get('sender', {}) for item in items if item.get('upper_message_id') == message_id]
+                        for tenant_key in {sender.get('tenant_key', '') for sender in senders}:
+                            self.user_cache.prefetch_users(
+                                [sender.get('id') for sender in senders
+                                 if sender.get('id_type') == 'open_id' and sender.get('tenant_key', '') == tenant_key],
+                                tenant_key)
                         # 提取属于当前合并转发消息的子消息
                         sub_messages = []
                         for item in items:
@@ -324,16 +279,9 @@ class FeishuMessage(ChatMessage):
             tenant_key = sender_info.get('tenant_key', '')
             
             if id_type == 'open_id' and sender_id:
-                # 先从缓存获取
-                cached_user = self.user_cache.get_user_info(sender_id, tenant_key)
-                if cached_user:
-                    logger.debug(f"[FeiShu] Using cached user info for {sender_id}")
-                    return cached_user.get('name') or cached_user.get('nickname') or f"用户({sender_id[:8]}...)"
-                
-                # 缓存未命中，调用API - 传递 tenant_key
-                user_info = self._get_user_info_by_open_id(sender_id, access_token, tenant_key)
-                if user_info:
-                    return user_info
+                user_name = self.user_cache.get_user_name(sender_id, tenant_key)
+                if user_name:
+                    return user_name
             
             return f"用户({sender_id[:8]}...)" if sender_id else "未知用户"
             
@@ -341,53 +289,3 @@ class FeishuMessage(ChatMessage):
             logger.error(f"[FeiShu] Exception when getting sender info: {e}")
         
         return "未知用户"
-    
-    def _get_user_info_by_open_id(self, open_id: str, access_token: str, tenant_key: str = None) -> Optional[str]:
-        """通过 open_id 获取用户信息"""
-        try:
-            url = f"https://open.feishu.cn/open-apis/contact/v3/users/{open_id}"
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json; charset=utf-8"
-            }
-            
-            response = requests.get(url=url, headers=headers)
-            logger.debug(f"[FeiShu] Get user info by open_id response: {response.status_code} {response.text}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                if result.get('code') == 0:
-                    data = result.get('data', {})
-                    user = data.get('user', {})
-                    
-                    # 保存到缓存 - 使用传入的 tenant_key
-                    sender_info = {
-                        'tenant_key': tenant_key or '',  # 使用传入的 tenant_key
-                        'sender_type': 'user',
-                        'id_type': 'open_id'
-                    }
-                    self.user_cache.save_user_info(data, sender_info)
-                    
-                    # 返回用户名
-                    name = user.get('name', '')
-                    if name and name.strip():
-                        return name.strip()
-                    
-                    nickname = user.get('nickname', '')
-                    if nickname and nickname.strip():
-                        return nickname.strip()
-                    
-                    en_name = user.get('en_name', '')
-                    if en_name and en_name.strip():
-                        return en_name.strip()
-                        
-                else:
-                    logger.warning(f"[FeiShu] API error when getting user info for {open_id}: {result.get('msg')}")
-            else:
-                logger.warning(f"[FeiShu] HTTP error when getting user info for {open_id}: {response.status_code}")
-                
-        except Exception as e:
-            logger.error(f"[FeiShu] Exception when getting user info for {open_id}: {e}")
-        
-        return None
-    
@@ -0,0 +1,107 @@
+"""
+飞书tenant_access_token管理，缓存到过期前并在后台提前刷新，所有飞书API调用共享同一个token
+"""
+
+import threading
+import time
+
+from common import http_client
+from common.log import logger
+from config import conf
+
+TOKEN_URL = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
+INVALID_TOKEN_CODES = (99991661, 99991663)  # token无效或已过期
+# 飞书在token剩余有效期不足30分钟时才会返回新token，提前刷新的时间需小于30分钟
+DEFAULT_REFRESH_AHEAD = 20 * 60
+RETRY_INTERVAL = 30  # 后台刷新失败后的重试间隔（秒）
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+class FeishuTokenManager(object):
+    def __init__(self, app_id, app_secret, refresh_ahead=DEFAULT_REFRESH_AHEAD):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.refresh_ahead = refresh_ahead
+        self.token = ""
+        self.expires_at = 0
+        self.lock = threading.Lock()  # 同一时间只有一个线程请求新token
+        self.timer = None
+
+    def get(self) -> str:
+        """
+        获取有效的token，缓存有效时不发起请求，已过期时同步刷新，并发刷新只请求一次
+        """
+        token, expires_at = self.token, self.expires_at
+        if token and time.time() < expires_at:
+            return token
+        with self.lock:
+            if self.token and time.time() < self.expires_at:
+                return self.token
+            self._refresh()
+            return self.token
+
+    def invalidate(self, token=None):
+        """
+        API返回token无效时调用，下次get时重新获取
+        """
+        with self.lock:
+            if token is None or token == self.token:
+                self.expires_at = 0
+
+    def _refresh(self):
+        # 持有self.lock时调用，失败时保留旧token，返回是否成功
+        req_body = {"app_id": self.app_id, "app_secret": self.app_secret}
+        try:
+            response = http_client.post(url=TOKEN_URL, json=req_body, timeout=(5, 10))
+        except Exception as e:
+            logger.error(f"[FeiShu] fetch token error, {e}")
+            return False
+        if response.status_code != 200:
+            logger.error(f"[FeiShu] fetch token error, res={response}")
+            return False
+        res = response.json()
+        if res.get("code") != 0:
+            logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
+            return False
+        expire = res.get("expire") or 7200
+        self.token = res.get("tenant_access_token")
+        self.expires_at = time.time() + expire - 60  # 留出时钟误差和请求耗时
+        logger.debug(f"[FeiShu] tenant_access_token refreshed, expire={expire}s")
+        self._schedule(max(expire - self.refresh_ahead, RETRY_INTERVAL))
+        return True
+
+    def _schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(delay, self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _background_refresh(self):
+        with self.lock:
+            if not self._refresh():
+                self._schedule(RETRY_INTERVAL)
+
+
+def get_token_manager() -> FeishuTokenManager:
+    """
+    获取当前应用的token管理器，应用凭证变化后重新创建
+    """
+    global _manager
+    app_id, app_secret = conf().get("feishu_app_id"), conf().get("feishu_app_secret")
+    manager = _manager
+    if manager is not None and manager.app_id == app_id and manager.app_secret == app_secret:
+        return manager
+    with _manager_lock:
+        if _manager is None or _manager.app_id != app_id or _manager.app_secret != app_secret:
+            if _manager is not None and _manager.timer is not None:
+                _manager.timer.cancel()
+            refresh_ahead = conf().get("feishu_token_refresh_ahead", DEFAULT_REFRESH_AHEAD)
+            _manager = FeishuTokenManager(app_id, app_secret, refresh_ahead)
+        return _manager
+
+
+def get_access_token() -> str:
+    return get_token_manager().get()
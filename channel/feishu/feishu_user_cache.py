@@ -1,15 +1,52 @@
+"""
+飞书用户和群信息缓存，进程内只有一个实例：内存LRU在前，MySQL在后，都未命中时才调用飞书API
+"""
+
 import json
 import os
-import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterable
 import pymysql
+from channel.feishu.feishu_token import get_access_token
+from common import http_client
+from common.db_pool import get_mysql_pool
+from common.expired_dict import ExpiredDict
 from common.log import logger
+from common.single_flight import SingleFlight
+from common.singleton import singleton
+from config import conf
+
+USER_URL = "https://open.feishu.cn/open-apis/contact/v3/users/{}"
+USER_BATCH_URL = "https://open.feishu.cn/open-apis/contact/v3/users/batch"
+GROUP_URL = "https://open.feishu.cn/open-apis/im/v1/chats/{}"
+GROUP_MEMBERS_URL = "https://open.feishu.cn/open-apis/im/v1/chats/{}/members"
+USER_BATCH_SIZE = 50  # 批量获取用户接口每次最多50个
+GROUP_MEMBERS_PAGE_SIZE = 100
+WARM_WORKERS = 2  # 后台预取群成员的线程数
+
 
+@singleton
 class FeishuUserCache:
     def __init__(self):
         self.db_config = self._load_db_config()
-        self.init_database()
+        memory_config = conf().get("feishu_profile_cache") or {}
+        expires_in_seconds = memory_config.get("expires_in_seconds", 3600)
+        max_entries = memory_config.get("max_entries", 20000)
+        self.user_names = ExpiredDict(expires_in_seconds, max_entries=max_entries)  # (open_id, tenant_key) -> 显示名
+        self.group_names = ExpiredDict(expires_in_seconds, max_entries=max_entries)  # chat_id -> 群名
+        # 查询失败或名字为空的用户和群（如没有通讯录权限），短时间内不再查MySQL和飞书API
+        negative_expires_in_seconds = memory_config.get("negative_expires_in_seconds", 300)
+        self.missing_users = ExpiredDict(negative_expires_in_seconds, max_entries=max_entries)
+        self.missing_groups = ExpiredDict(negative_expires_in_seconds, max_entries=max_entries)
+        self.warm_executor = ThreadPoolExecutor(max_workers=WARM_WORKERS, thread_name_prefix="feishu-warm")
+        self.flight = SingleFlight()  # 同一用户或群的并发查询只查一次
+        self.db_ready = False
+        try:
+            self.init_database()
+            self.db_ready = True
+        except Exception as e:
+            logger.error(f"[FeishuUserCache] 数据库初始化失败，仅使用内存缓存: {e}")
     
     def _load_db_config(self):
         """从roleX插件配置中加载数据库配置"""
@@ -32,202 +69,198 @@ class FeishuUserCache:
             raise e
     
     def _get_connection(self):
-        """获取MySQL连接"""
-        return pymysql.connect(
-            host=self.db_config["host"],
-            port=self.db_config["port"],
-            user=self.db_config["user"],
-            password=self.db_config["password"],
-            database=self.db_config["database"],
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor
-        )
+        """从连接池获取MySQL连接，close()时归还连接池"""
+        return get_mysql_pool({
+            "host": self.db_config["host"],
+            "port": self.db_config["port"],
+            "user": self.db_config["user"],
+            "password": self.db_config["password"],
+            "database": self.db_config["database"],
+            "charset": "utf8mb4",
+        }).connection()
     
     def get_connection(self):
-        """获取MySQL连接（公有方法）"""
+        """获取MySQL连接（公有方法），查询结果以字典返回"""
         return self._get_connection()
     
     def init_database(self):
         """初始化数据库表"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS feishu_user_cache (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                open_id VARCHAR(255) NOT NULL,
-                union_id VARCHAR(255),
-                user_id VARCHAR(255),
-                tenant_key VARCHAR(255) NOT NULL,
-                sender_type VARCHAR(50) NOT NULL DEFAULT 'user',
-                id_type VARCHAR(50) DEFAULT 'open_id',
-                name VARCHAR(255),
-                en_name VARCHAR(255),
-                nickname VARCHAR(255),
-                email VARCHAR(255),
-                mobile VARCHAR(50),
-                mobile_visible TINYINT(1) DEFAULT 0,
-                gender TINYINT(1),
-                city VARCHAR(255),
-                country VARCHAR(255),
-                work_station VARCHAR(255),
-                job_title VARCHAR(255),
-                employee_no VARCHAR(255),
-                employee_type TINYINT(1),
-                geo VARCHAR(255),
-                avatar_72 TEXT,
-                avatar_240 TEXT,
-                avatar_640 TEXT,
-                avatar_origin TEXT,
-                is_frozen TINYINT(1) DEFAULT 0,
-                is_resigned TINYINT(1) DEFAULT 0,
-                is_activated TINYINT(1) DEFAULT 1,
-                is_exited TINYINT(1) DEFAULT 0,
-                is_unjoin TINYINT(1) DEFAULT 0,
-                is_tenant_manager TINYINT(1) DEFAULT 0,
-                department_ids TEXT,
-                leader_user_id VARCHAR(255),
-                dotted_line_leader_user_ids TEXT,
-                job_level_id VARCHAR(255),
-                job_family_id VARCHAR(255),
-                join_time BIGINT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                last_api_call TIMESTAMP NULL,
-                cache_expire_time TIMESTAMP NULL,
-                UNIQUE KEY unique_user_tenant (open_id, tenant_key)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-        ''')
-        
-        # 同时添加群聊缓存表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS feishu_group_cache (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                chat_id VARCHAR(255) NOT NULL UNIQUE,
-                name VARCHAR(255),
-                description TEXT,
-                owner_id VARCHAR(255),
-                chat_mode VARCHAR(50),
-                chat_type VARCHAR(50),
-                chat_tag VARCHAR(50),
-                member_count INT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                cache_expire_time TIMESTAMP NULL,
-                INDEX idx_chat_id (chat_id),
-                INDEX idx_cache_expire (cache_expire_time)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-        ''')
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with self.get_connection() as conn:
+            cursor = conn.cursor(pymysql.cursors.DictCursor)
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS feishu_user_cache (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    open_id VARCHAR(255) NOT NULL,
+                    union_id VARCHAR(255),
+                    user_id VARCHAR(255),
+                    tenant_key VARCHAR(255) NOT NULL,
+                    sender_type VARCHAR(50) NOT NULL DEFAULT 'user',
+                    id_type VARCHAR(50) DEFAULT 'open_id',
+                    name VARCHAR(255),
+                    en_name VARCHAR(255),
+                    nickname VARCHAR(255),
+                    email VARCHAR(255),
+                    mobile VARCHAR(50),
+                    mobile_visible TINYINT(1) DEFAULT 0,
+                    gender TINYINT(1),
+                    city VARCHAR(255),
+                    country VARCHAR(255),
+                    work_station VARCHAR(255),
+                    job_title VARCHAR(255),
+                    employee_no VARCHAR(255),
+                    employee_type TINYINT(1),
+                    geo VARCHAR(255),
+                    avatar_72 TEXT,
+                    avatar_240 TEXT,
+                    avatar_640 TEXT,
+                    avatar_origin TEXT,
+                    is_frozen TINYINT(1) DEFAULT 0,
+                    is_resigned TINYINT(1) DEFAULT 0,
+                    is_activated TINYINT(1) DEFAULT 1,
+                    is_exited TINYINT(1) DEFAULT 0,
+                    is_unjoin TINYINT(1) DEFAULT 0,
+                    is_tenant_manager TINYINT(1) DEFAULT 0,
+                    department_ids TEXT,
+                    leader_user_id VARCHAR(255),
+                    dotted_line_leader_user_ids TEXT,
+                    job_level_id VARCHAR(255),
+                    job_family_id VARCHAR(255),
+                    join_time BIGINT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    last_api_call TIMESTAMP NULL,
+                    cache_expire_time TIMESTAMP NULL,
+                    UNIQUE KEY unique_user_tenant (open_id, tenant_key)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            ''')
+
+            # 同时添加群聊缓存表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS feishu_group_cache (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    chat_id VARCHAR(255) NOT NULL UNIQUE,
+                    name VARCHAR(255),
+                    description TEXT,
+                    owner_id VARCHAR(255),
+                    chat_mode VARCHAR(50),
+                    chat_type VARCHAR(50),
+                    chat_tag VARCHAR(50),
+                    member_count INT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    cache_expire_time TIMESTAMP NULL,
+                    INDEX idx_chat_id (chat_id),
+                    INDEX idx_cache_expire (cache_expire_time)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            ''')
+
+            conn.commit()
+            cursor.close()
         logger.info("[FeishuUserCache] 数据库初始化完成")
     
     def get_user_info(self, open_id: str, tenant_key: str) -> Optional[Dict[str, Any]]:
         """从缓存获取用户信息"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM feishu_user_cache 
-            WHERE open_id = %s AND tenant_key = %s
-            AND (cache_expire_time IS NULL OR cache_expire_time > NOW())
-        ''', (open_id, tenant_key))
-        
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with self.get_connection() as conn:
+            cursor = conn.cursor(pymysql.cursors.DictCursor)
+
+            cursor.execute('''
+                SELECT * FROM feishu_user_cache 
+                WHERE open_id = %s AND tenant_key = %s
+                AND (cache_expire_time IS NULL OR cache_expire_time > NOW())
+            ''', (open_id, tenant_key))
+
+            row = cursor.fetchone()
+            cursor.close()
         
         return row
     
     def save_user_info(self, user_data: Dict[str, Any], sender_info: Dict[str, Any]) -> bool:
         """保存用户信息到缓存"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # 提取用户信息
-            user = user_data.get('user', {})
-            avatar = user.get('avatar', {})
-            status = user.get('status', {})
-            
-            # 计算缓存过期时间（240小时后）
-            expire_time = datetime.now() + timedelta(hours=240)
-            
-            cursor.execute('''
-                INSERT INTO feishu_user_cache (
-                    open_id, union_id, user_id, tenant_key, sender_type, id_type,
-                    name, en_name, nickname, email, mobile, mobile_visible,
-                    gender, city, country, work_station, job_title, employee_no,
-                    employee_type, geo, avatar_72, avatar_240, avatar_640, avatar_origin,
-                    is_frozen, is_resigned, is_activated, is_exited, is_unjoin, is_tenant_manager,
-                    department_ids, leader_user_id, dotted_line_leader_user_ids,
-                    job_level_id, job_family_id, join_time, last_api_call, cache_expire_time
-                ) VALUES (
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-                )
-                ON DUPLICATE KEY UPDATE
-                    union_id = VALUES(union_id),
-                    user_id = VALUES(user_id),
-                    sender_type = VALUES(sender_type),
-                    id_type = VALUES(id_type),
-                    name = VALUES(name),
-                    en_name = VALUES(en_name),
-                    nickname = VALUES(nickname),
-                    email = VALUES(email),
-                    mobile = VALUES(mobile),
-                    mobile_visible = VALUES(mobile_visible),
-                    gender = VALUES(gender),
-                    city = VALUES(city),
-                    country = VALUES(country),
-                    work_station = VALUES(work_station),
-                    job_title = VALUES(job_title),
-                    employee_no = VALUES(employee_no),
-                    employee_type = VALUES(employee_type),
-                    geo = VALUES(geo),
-                    avatar_72 = VALUES(avatar_72),
-                    avatar_240 = VALUES(avatar_240),
-                    avatar_640 = VALUES(avatar_640),
-                    avatar_origin = VALUES(avatar_origin),
-                    is_frozen = VALUES(is_frozen),
-                    is_resigned = VALUES(is_resigned),
-                    is_activated = VALUES(is_activated),
-                    is_exited = VALUES(is_exited),
-                    is_unjoin = VALUES(is_unjoin),
-                    is_tenant_manager = VALUES(is_tenant_manager),
-                    department_ids = VALUES(department_ids),
-                    leader_user_id = VALUES(leader_user_id),
-                    dotted_line_leader_user_ids = VALUES(dotted_line_leader_user_ids),
-                    job_level_id = VALUES(job_level_id),
-                    job_family_id = VALUES(job_family_id),
-                    join_time = VALUES(join_time),
-                    last_api_call = VALUES(last_api_call),
-                    cache_expire_time = VALUES(cache_expire_time)
-            ''', (
-                user.get('open_id'), user.get('union_id'), user.get('user_id'),
-                sender_info.get('tenant_key'), sender_info.get('sender_type', 'user'),
-                sender_info.get('id_type', 'open_id'),
-                user.get('name'), user.get('en_name'), user.get('nickname'),
-                user.get('email'), user.get('mobile'), user.get('mobile_visible', False),
-                user.get('gender'), user.get('city'), user.get('country'),
-                user.get('work_station'), user.get('job_title'), user.get('employee_no'),
-                user.get('employee_type'), user.get('geo'),
-                avatar.get('avatar_72'), avatar.get('avatar_240'),
-                avatar.get('avatar_640'), avatar.get('avatar_origin'),
-                status.get('is_frozen', False), status.get('is_resigned', False),
-                status.get('is_activated', True), status.get('is_exited', False),
-                status.get('is_unjoin', False), user.get('is_tenant_manager', False),
-                json.dumps(user.get('department_ids', [])),
-                user.get('leader_user_id'),
-                json.dumps(user.get('dotted_line_leader_user_ids', [])),
-                user.get('job_level_id'), user.get('job_family_id'),
-                user.get('join_time'), datetime.now(), expire_time
-            ))
-            
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor(pymysql.cursors.DictCursor)
+
+                # 提取用户信息
+                user = user_data.get('user', {})
+                avatar = user.get('avatar', {})
+                status = user.get('status', {})
+
+                # 计算缓存过期时间（240小时后）
+                expire_time = datetime.now() + timedelta(hours=240)
+
+                cursor.execute('''
+                    INSERT INTO feishu_user_cache (
+                        open_id, union_id, user_id, tenant_key, sender_type, id_type,
+                        name, en_name, nickname, email, mobile, mobile_visible,
+                        gender, city, country, work_station, job_title, employee_no,
+                        employee_type, geo, avatar_72, avatar_240, avatar_640, avatar_origin,
+                        is_frozen, is_resigned, is_activated, is_exited, is_unjoin, is_tenant_manager,
+                        department_ids, leader_user_id, dotted_line_leader_user_ids,
+                        job_level_id, job_family_id, join_time, last_api_call, cache_expire_time
+                    ) VALUES (
+                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                    )
+                    ON DUPLICATE KEY UPDATE
+                        union_id = VALUES(union_id),
+                        user_id = VALUES(user_id),
+                        sender_type = VALUES(sender_type),
+                        id_type = VALUES(id_type),
+                        name = VALUES(name),
+                        en_name = VALUES(en_name),
+                        nickname = VALUES(nickname),
+                        email = VALUES(email),
+                        mobile = VALUES(mobile),
+                        mobile_visible = VALUES(mobile_visible),
+                        gender = VALUES(gender),
+                        city = VALUES(city),
+                        country = VALUES(country),
+                        work_station = VALUES(work_station),
+                        job_title = VALUES(job_title),
+                        employee_no = VALUES(employee_no),
+                        employee_type = VALUES(employee_type),
+                        geo = VALUES(geo),
+                        avatar_72 = VALUES(avatar_72),
+                        avatar_240 = VALUES(avatar_240),
+                        avatar_640 = VALUES(avatar_640),
+                        avatar_origin = VALUES(avatar_origin),
+                        is_frozen = VALUES(is_frozen),
+                        is_resigned = VALUES(is_resigned),
+                        is_activated = VALUES(is_activated),
+                        is_exited = VALUES(is_exited),
+                        is_unjoin = VALUES(is_unjoin),
+                        is_tenant_manager = VALUES(is_tenant_manager),
+                        department_ids = VALUES(department_ids),
+                        leader_user_id = VALUES(leader_user_id),
+                        dotted_line_leader_user_ids = VALUES(dotted_line_leader_user_ids),
+                        job_level_id = VALUES(job_level_id),
+                        job_family_id = VALUES(job_family_id),
+                        join_time = VALUES(join_time),
+                        last_api_call = VALUES(last_api_call),
+                        cache_expire_time = VALUES(cache_expire_time)
+                ''', (
+                    user.get('open_id'), user.get('union_id'), user.get('user_id'),
+                    sender_info.get('tenant_key'), sender_info.get('sender_type', 'user'),
+                    sender_info.get('id_type', 'open_id'),
+                    user.get('name'), user.get('en_name'), user.get('nickname'),
+                    user.get('email'), user.get('mobile'), user.get('mobile_visible', False),
+                    user.get('gender'), user.get('city'), user.get('country'),
+                    user.get('work_station'), user.get('job_title'), user.get('employee_no'),
+                    user.get('employee_type'), user.get('geo'),
+                    avatar.get('avatar_72'), avatar.get('avatar_240'),
+                    avatar.get('avatar_640'), avatar.get('avatar_origin'),
+                    status.get('is_frozen', False), status.get('is_resigned', False),
+                    status.get('is_activated', True), status.get('is_exited', False),
+                    status.get('is_unjoin', False), user.get('is_tenant_manager', False),
+                    json.dumps(user.get('department_ids', [])),
+                    user.get('leader_user_id'),
+                    json.dumps(user.get('dotted_line_leader_user_ids', [])),
+                    user.get('job_level_id'), user.get('job_family_id'),
+                    user.get('join_time'), datetime.now(), expire_time
+                ))
+
+                conn.commit()
             return True
             
         except Exception as e:
@@ -236,58 +269,56 @@ class FeishuUserCache:
     
     def get_group_info(self, chat_id: str) -> Optional[Dict[str, Any]]:
         """从缓存获取群聊信息"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM feishu_group_cache 
-            WHERE chat_id = %s
-            AND (cache_expire_time IS NULL OR cache_expire_time > NOW())
-        ''', (chat_id,))
-        
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with self.get_connection() as conn:
+            cursor = conn.cursor(pymysql.cursors.DictCursor)
+
+            cursor.execute('''
+                SELECT * FROM feishu_group_cache 
+                WHERE chat_id = %s
+                AND (cache_expire_time IS NULL OR cache_expire_time > NOW())
+            ''', (chat_id,))
+
+            row = cursor.fetchone()
+            cursor.close()
         
         return row
     
     def save_group_info(self, chat_id: str, group_data: Dict[str, Any]) -> bool:
         """保存群聊信息到缓存"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # 计算缓存过期时间（24小时后）
-            expire_time = datetime.now() + timedelta(hours=24)
-            
-            cursor.execute('''
-                INSERT INTO feishu_group_cache (
-                    chat_id, name, description, owner_id, chat_mode, chat_type, chat_tag, 
-                    member_count, cache_expire_time
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE
-                    name = VALUES(name),
-                    description = VALUES(description),
-                    owner_id = VALUES(owner_id),
-                    chat_mode = VALUES(chat_mode),
-                    chat_type = VALUES(chat_type),
-                    chat_tag = VALUES(chat_tag),
-                    member_count = VALUES(member_count),
-                    cache_expire_time = VALUES(cache_expire_time)
-            ''', (
-                chat_id,
-                group_data.get('name'),
-                group_data.get('description'),
-                group_data.get('owner_id'),
-                group_data.get('chat_mode'),
-                group_data.get('chat_type'),
-                group_data.get('chat_tag'),
-                group_data.get('user_count'),
-                expire_time
-            ))
-            
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor(pymysql.cursors.DictCursor)
+
+                # 计算缓存过期时间（24小时后）
+                expire_time = datetime.now() + timedelta(hours=24)
+
+                cursor.execute('''
+                    INSERT INTO feishu_group_cache (
+                        chat_id, name, description, owner_id, chat_mode, chat_type, chat_tag, 
+                        member_count, cache_expire_time
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        name = VALUES(name),
+                        description = VALUES(description),
+                        owner_id = VALUES(owner_id),
+                        chat_mode = VALUES(chat_mode),
+                        chat_type = VALUES(chat_type),
+                        chat_tag = VALUES(chat_tag),
+                        member_count = VALUES(member_count),
+                        cache_expire_time = VALUES(cache_expire_time)
+                ''', (
+                    chat_id,
+                    group_data.get('name'),
+                    group_data.get('description'),
+                    group_data.get('owner_id'),
+                    group_data.get('chat_mode'),
+                    group_data.get('chat_type'),
+                    group_data.get('chat_tag'),
+                    group_data.get('user_count'),
+                    expire_time
+                ))
+
+                conn.commit()
             return True
             
         except Exception as e:
@@ -296,25 +327,196 @@ class FeishuUserCache:
     
     def clean_expired_cache(self):
         """清理过期缓存"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 清理用户缓存
-        cursor.execute('''
-            DELETE FROM feishu_user_cache 
-            WHERE cache_expire_time IS NOT NULL AND cache_expire_time < NOW()
-        ''')
-        user_deleted = cursor.rowcount
-        
-        # 清理群聊缓存
-        cursor.execute('''
-            DELETE FROM feishu_group_cache 
-            WHERE cache_expire_time IS NOT NULL AND cache_expire_time < NOW()
-        ''')
-        group_deleted = cursor.rowcount
-        
-        conn.commit()
-        conn.close()
+        with self.get_connection() as conn:
+            cursor = conn.cursor(pymysql.cursors.DictCursor)
+
+            # 清理用户缓存
+            cursor.execute('''
+                DELETE FROM feishu_user_cache 
+                WHERE cache_expire_time IS NOT NULL AND cache_expire_time < NOW()
+            ''')
+            user_deleted = cursor.rowcount
+
+            # 清理群聊缓存
+            cursor.execute('''
+                DELETE FROM feishu_group_cache 
+                WHERE cache_expire_time IS NOT NULL AND cache_expire_time < NOW()
+            ''')
+            group_deleted = cursor.rowcount
+
+            conn.commit()
         
         if user_deleted > 0 or group_deleted > 0:
-            logger.info(f"[FeishuUserCache] Cleaned {user_deleted} expired user cache entries and {group_deleted} expired group cache entries")
\ No newline at end of file
+            logger.info(f"[FeishuUserCache] Cleaned {user_deleted} expired user cache entries and {group_deleted} expired group cache entries")
+
+    def get_user_name(self, open_id: str, tenant_key: str = "") -> Optional[str]:
+        """
+        获取用户显示名，依次查内存、MySQL和飞书API，获取失败返回None
+        """
+        key = (open_id, tenant_key or "")
+        name = self.user_names.get(key)
+        if name is not None:
+            return name
+        if key in self.missing_users:
+            return None
+        return self.flight.do(("user",) + key, self._load_user_name, open_id, tenant_key or "")
+
+    def get_group_name(self, chat_id: str, tenant_key: str = "") -> Optional[str]:
+        """
+        获取群名，依次查内存、MySQL和飞书API，首次见到的群在后台预取群成员的名字
+        """
+        name = self.group_names.get(chat_id)
+        if name is not None:
+            return name
+        if chat_id in self.missing_groups:
+            return None
+        return self.flight.do(("group", chat_id), self._load_group_name, chat_id, tenant_key or "")
+
+    def prefetch_users(self, open_ids: Iterable[str], tenant_key: str = ""):
+        """
+        批量加载多个用户（如合并转发消息的发送者），MySQL一次查询，未命中的通过批量接口获取
+        """
+        tenant_key = tenant_key or ""
+        missing = list(dict.fromkeys(
+            i for i in open_ids if i and (i, tenant_key) not in self.user_names and (i, tenant_key) not in self.missing_users
+        ))
+        if not missing:
+            return
+        if self.db_ready:
+            try:
+                for open_id, name in self._query_user_names(missing, tenant_key).items():
+                    self.user_names[(open_id, tenant_key)] = name
+            except Exception as e:
+                logger.warning(f"[FeishuUserCache] batch query users failed: {e}")
+            missing = [i for i in missing if (i, tenant_key) not in self.user_names]
+        for start in range(0, len(missing), USER_BATCH_SIZE):
+            for user in self._fetch_users(missing[start:start + USER_BATCH_SIZE]):
+                self._remember_user({"user": user}, tenant_key)
+        for open_id in missing:
+            if (open_id, tenant_key) not in self.user_names:
+                self.missing_users[(open_id, tenant_key)] = True
+
+    def _load_user_name(self, open_id, tenant_key):
+        if self.db_ready:
+            try:
+                row = self.get_user_info(open_id, tenant_key)
+                if row:
+                    name = _display_name(row)
+                    self.user_names[(open_id, tenant_key)] = name
+                    return name
+            except Exception as e:
+                logger.warning(f"[FeishuUserCache] query user {open_id} failed: {e}")
+        data = self._fetch_user(open_id)
+        name = self._remember_user(data, tenant_key) if data else None
+        if not name:
+            self.missing_users[(open_id, tenant_key)] = True
+        return name
+
+    def _remember_user(self, user_data, tenant_key):
+        user = user_data.get("user") or {}
+        name = _display_name(user)
+        if not user.get("open_id"):
+            return name
+        if self.db_ready:
+            self.save_user_info(user_data, {"tenant_key": tenant_key, "sender_type": "user", "id_type": "open_id"})
+        if name:
+            self.user_names[(user["open_id"], tenant_key)] = name
+        return name
+
+    def _load_group_name(self, chat_id, tenant_key):
+        if self.db_ready:
+            try:
+                row = self.get_group_info(chat_id)
+                if row:
+                    name = (row.get("name") or "").strip()
+                    self.group_names[chat_id] = name
+                    return name
+            except Exception as e:
+                logger.warning(f"[FeishuUserCache] query group {chat_id} failed: {e}")
+        data = self._fetch_group(chat_id)
+        if not data:
+            self.missing_groups[chat_id] = True
+            return None
+        if self.db_ready:
+            self.save_group_info(chat_id, data)
+        name = (data.get("name") or "").strip() or (data.get("description") or "").strip()
+        self.group_names[chat_id] = name
+        # 新群的成员名字一次性批量获取，之后群内消息的发送者直接命中内存
+        self.warm_executor.submit(self.warm_group_members, chat_id, tenant_key)
+        return name
+
+    def warm_group_members(self, chat_id, tenant_key=""):
+        """
+        分页获取群成员名字放入内存缓存
+        """
+        page_token = None
+        count = 0
+        while True:
+            params = {"member_id_type": "open_id", "page_size": GROUP_MEMBERS_PAGE_SIZE}
+            if page_token:
+                params["page_token"] = page_token
+            data = self._api_get(GROUP_MEMBERS_URL.format(chat_id), params, f"group members {chat_id}")
+            if not data:
+                break
+            for item in data.get("items") or []:
+                if item.get("member_id") and item.get("name"):
+                    self.user_names[(item["member_id"], item.get("tenant_key") or tenant_key or "")] = item["name"]
+                    count += 1
+            page_token = data.get("page_token")
+            if not data.get("has_more") or not page_token:
+                break
+        logger.debug(f"[FeishuUserCache] warmed {count} members of group {chat_id}")
+
+    def _query_user_names(self, open_ids, tenant_key) -> Dict[str, str]:
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor(pymysql.cursors.DictCursor)
+            placeholders = ",".join(["%s"] * len(open_ids))
+            cursor.execute(f'''
+                SELECT open_id, name, nickname, en_name FROM feishu_user_cache
+                WHERE tenant_key = %s AND open_id IN ({placeholders})
+                AND (cache_expire_time IS NULL OR cache_expire_time > NOW())
+            ''', [tenant_key] + list(open_ids))
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            conn.close()
+        return {row["open_id"]: _display_name(row) for row in rows}
+
+    def _fetch_user(self, open_id):
+        return self._api_get(USER_URL.format(open_id), None, f"user info {open_id}")
+
+    def _fetch_users(self, open_ids):
+        params = [("user_id_type", "open_id")] + [("user_ids", i) for i in open_ids]
+        data = self._api_get(USER_BATCH_URL, params, f"batch user info, count={len(open_ids)}")
+        return (data or {}).get("items") or []
+
+    def _fetch_group(self, chat_id):
+        return self._api_get(GROUP_URL.format(chat_id), None, f"group info {chat_id}")
+
+    def _api_get(self, url, params, desc):
+        try:
+            headers = {
+                "Authorization": f"Bearer {get_access_token()}",
+                "Content-Type": "application/json; charset=utf-8"
+            }
+            response = http_client.get(url=url, params=params, headers=headers)
+            if response.status_code != 200:
+                logger.warning(f"[FeiShu] HTTP error when getting {desc}: {response.status_code}")
+                return None
+            result = response.json()
+            if result.get("code") != 0:
+                logger.warning(f"[FeiShu] API error when getting {desc}: {result.get('msg')}")
+                return None
+            return result.get("data") or {}
+        except Exception as e:
+            logger.error(f"[FeiShu] Exception when getting {desc}: {e}")
+            return None
+
+
+def _display_name(user: Dict[str, Any]) -> str:
+    for key in ("name", "nickname", "en_name"):
+        value = (user.get(key) or "").strip()
+        if value:
+            return value
+    return ""
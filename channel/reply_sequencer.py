@@ -0,0 +1,46 @@
+import threading
+
+
+class ReplySequencer(object):
+    """
+    同一会话的多条消息并发处理时，按处理顺序依次放行回复
+    序号在消息开始处理时分配，回复前等待前面的消息处理完毕，超时后不再等待
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.next_seq = 0  # 下一个分配的序号
+        self.released = 0  # 小于该序号的消息都已处理完毕
+        self.finished = set()  # 已处理完毕但前面还有未完成消息的序号
+
+    def assign(self) -> int:
+        with self.cond:
+            seq = self.next_seq
+            self.next_seq += 1
+            return seq
+
+    def wait_turn(self, seq, timeout) -> bool:
+        """
+        等待序号在seq之前的消息处理完毕，超时返回False，此后不再等待这些消息
+        """
+        with self.cond:
+            if self.cond.wait_for(lambda: self.released >= seq, timeout):
+                return True
+            self._release_before(seq)
+            return False
+
+    def finish(self, seq):
+        with self.cond:
+            self.finished.add(seq)
+            self._release_before(self.released)
+            self.cond.notify_all()
+
+    def _release_before(self, seq):
+        self.released = max(self.released, seq)
+        while self.released in self.finished:
+            self.finished.discard(self.released)
+            self.released += 1
+        if self.finished:
+            # 超时放行后才完成的消息不再需要记录
+            self.finished = {s for s in self.finished if s >= self.released}
+        self.cond.notify_all()
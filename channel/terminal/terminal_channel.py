@@ -29,7 +29,36 @@ class TerminalMessage(ChatMessage):
 class TerminalChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
 
+    def build_reply_content(self, query, context: Context = None) -> Reply:
+        if not conf().get("terminal_stream_reply", True) or context is None or context.type != ContextType.TEXT:
+            return super().build_reply_content(query, context)
+        # 边生成边输出，不用等完整回复，回复前后缀在输出时加上
+        content = ""
+        stream = self.build_reply_stream(query, context)
+        try:
+            while True:
+                delta = next(stream)
+                if not content:
+                    print("\nBot:")
+                    print(conf().get("single_chat_reply_prefix") or "", end="")
+                print(delta, end="", flush=True)
+                content += delta
+        except StopIteration as e:
+            error_reply = e.value
+        if content:
+            print(conf().get("single_chat_reply_suffix") or "")
+        if error_reply is not None:
+            # 失败或非文本回复由生成器返回，已输出部分内容时也按普通回复发送，让用户看到错误
+            return error_reply
+        context["streamed"] = True
+        return Reply(ReplyType.TEXT, content)
+
     def send(self, reply: Reply, context: Context):
+        if context.get("streamed") and reply.type == ReplyType.TEXT:
+            # 回复内容已在生成时输出
+            print("\nUser:", end="")
+            sys.stdout.flush()
+            return
         print("\nBot:")
         if reply.type == ReplyType.IMAGE:
             from PIL import Image
@@ -42,11 +71,11 @@ class TerminalChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             import io
 
-            import requests
+            from common import http_client
             from PIL import Image
 
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
@@ -0,0 +1,63 @@
+"""
+消息触发规则的匹配器，按配置版本预先编译白名单、前缀和关键词，每条消息只需一次扫描
+"""
+
+import re
+from functools import lru_cache
+
+from common.aho_corasick import KeywordAutomaton
+from config import ConfigSnapshot, conf
+
+_matcher = None
+
+
+class TriggerMatcher(object):
+    def __init__(self, config: ConfigSnapshot):
+        self.version = config.version
+        group_name_white_list = config.group_name_white_list or ()
+        self.all_group = "ALL_GROUP" in group_name_white_list
+        self.group_names = frozenset(group_name_white_list)
+        self.group_name_keywords = KeywordAutomaton(config.group_name_keyword_white_list)
+        group_chat_in_one_session = config.group_chat_in_one_session or ()
+        self.all_group_in_one_session = "ALL_GROUP" in group_chat_in_one_session
+        self.one_session_groups = frozenset(group_chat_in_one_session)
+        self.nick_name_black_list = frozenset(config.nick_name_black_list or ())
+        self.group_chat_prefix = KeywordAutomaton(config.group_chat_prefix)
+        self.group_chat_keyword = KeywordAutomaton(config.group_chat_keyword)
+        self.single_chat_prefix = KeywordAutomaton(config.get("single_chat_prefix", [""]))
+        self.image_create_prefix = KeywordAutomaton(config.get("image_create_prefix", [""]))
+
+    def is_group_allowed(self, group_name) -> bool:
+        """群是否在白名单中（群名完全匹配、ALL_GROUP或包含白名单关键词）"""
+        return self.all_group or group_name in self.group_names or self.group_name_keywords.contains(group_name)
+
+    def is_group_in_one_session(self, group_name) -> bool:
+        """群内所有人是否共用一个会话"""
+        return self.all_group_in_one_session or group_name in self.one_session_groups
+
+    def is_blacklisted(self, nick_name) -> bool:
+        return bool(nick_name) and nick_name in self.nick_name_black_list
+
+
+def get_matcher(config: ConfigSnapshot = None) -> TriggerMatcher:
+    """
+    获取当前配置版本的匹配器，配置变化后重新构建
+    """
+    global _matcher
+    if config is None:
+        config = conf().snapshot()
+    matcher = _matcher
+    if matcher is None or matcher.version != config.version:
+        matcher = TriggerMatcher(config)
+        _matcher = matcher
+    return matcher
+
+
+@lru_cache(maxsize=1024)
+def mention_pattern(name):
+    """@昵称后跟空格的正则，按昵称缓存编译结果"""
+    return re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
+
+
+def strip_mention(content, name):
+    return mention_pattern(name).sub("", content)
@@ -9,7 +9,7 @@ import json
 import os
 import threading
 import time
-import requests
+from common import http_client
 
 from bridge.context import *
 from bridge.reply import *
@@ -112,7 +112,7 @@ class WechatChannel(ChatChannel):
 
     def __init__(self):
         super().__init__()
-        self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600))
+        self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600), max_entries=conf().get("received_msgs_max_entries"))
         self.auto_login_times = 0
 
     def startup(self):
@@ -238,7 +238,7 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
             logger.debug(f"[WX] start download image, img_url={img_url}")
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             size = 0
             for block in pic_res.iter_content(1024):
@@ -270,7 +270,7 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.VIDEO_URL:  # 新增视频URL回复类型
             video_url = reply.content
             logger.debug(f"[WX] start download video, video_url={video_url}")
-            video_res = requests.get(video_url, stream=True)
+            video_res = http_client.get(video_url, stream=True)
             video_storage = io.BytesIO()
             size = 0
             for block in video_res.iter_content(1024):
@@ -2,10 +2,12 @@
 import threading
 import time
 from wechatpy.enterprise import WeChatClient
+from common import http_client
 
 class WechatComAppClient(WeChatClient):
     def __init__(self, corp_id, secret, access_token=None, session=None, timeout=None, auto_retry=True):
         super(WechatComAppClient, self).__init__(corp_id, secret, access_token, session, timeout, auto_retry)
+        self._http = http_client.get_session()  # 复用全局连接池
         self.fetch_access_token_lock = threading.Lock()
         self._active_refresh()
         
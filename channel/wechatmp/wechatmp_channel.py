@@ -6,7 +6,7 @@ import os
 import threading
 import time
 
-import requests
+from common import http_client
 import web
 from wechatpy.crypto import WeChatCrypto
 from wechatpy.exceptions import WeChatClientException
@@ -108,7 +108,7 @@ class WechatMPChannel(ChatChannel):
 
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = http_client.get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -142,7 +142,7 @@ class WechatMPChannel(ChatChannel):
                 self.cache_dict[receiver].append(("image", media_id))
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
+                video_res = http_client.get(video_url, stream=True)
                 video_storage = io.BytesIO()
                 for block in video_res.iter_content(1024):
                     video_storage.write(block)
@@ -228,7 +228,7 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send voice to {}".format(receiver))
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = http_client.get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -260,7 +260,7 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
+                video_res = http_client.get(video_url, stream=True)
                 video_storage = io.BytesIO()
                 for block in video_res.iter_content(1024):
                     video_storage.write(block)
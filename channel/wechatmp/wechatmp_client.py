@@ -5,12 +5,14 @@ from wechatpy.client import WeChatClient
 from wechatpy.exceptions import APILimitedException
 
 from channel.wechatmp.common import *
+from common import http_client
 from common.log import logger
 
 
 class WechatMPClient(WeChatClient):
     def __init__(self, appid, secret, access_token=None, session=None, timeout=None, auto_retry=True):
         super(WechatMPClient, self).__init__(appid, secret, access_token, session, timeout, auto_retry)
+        self._http = http_client.get_session()  # 复用全局连接池
         self.fetch_access_token_lock = threading.Lock()
         self.clear_quota_lock = threading.Lock()
         self.last_clear_quota_time = -1
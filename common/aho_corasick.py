@@ -0,0 +1,82 @@
+from collections import deque
+
+
+class KeywordAutomaton(object):
+    """
+    Aho-Corasick自动机，一次扫描文本即可判断是否包含任意关键词，耗时与关键词数量无关
+    同一棵字典树也用于前缀匹配，结果与按列表顺序逐个startswith一致
+    """
+
+    def __init__(self, keywords):
+        self.keywords = tuple(keywords or ())
+        self.goto = [{}]  # 节点的转移表
+        self.fail = [0]  # 失配时跳转的节点
+        self.terminal = [None]  # 以该节点结尾的关键词在列表中的最小下标
+        self.matched = [False]  # 该节点或其失配链上是否有关键词结尾
+        for index, keyword in enumerate(self.keywords):
+            self._add(keyword, index)
+        self._build()
+
+    def __bool__(self):
+        return bool(self.keywords)
+
+    def _add(self, keyword, index):
+        node = 0
+        for ch in keyword:
+            next_node = self.goto[node].get(ch)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][ch] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.terminal.append(None)
+                self.matched.append(False)
+            node = next_node
+        if self.terminal[node] is None:
+            self.terminal[node] = index
+        self.matched[node] = True
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(ch, 0)
+                self.fail[child] = fail
+                self.matched[child] = self.matched[child] or self.matched[fail]
+                queue.append(child)
+
+    def contains(self, text) -> bool:
+        """
+        text中是否出现任意关键词
+        """
+        if self.matched[0]:
+            return True
+        goto, fail, matched = self.goto, self.fail, self.matched
+        node = 0
+        for ch in text or "":
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if matched[node]:
+                return True
+        return False
+
+    def match_prefix(self, text):
+        """
+        返回列表中第一个是text前缀的关键词，没有则返回None
+        """
+        goto, terminal = self.goto, self.terminal
+        node = 0
+        best = terminal[0]
+        for ch in text or "":
+            node = goto[node].get(ch)
+            if node is None:
+                break
+            index = terminal[node]
+            if index is not None and (best is None or index < best):
+                best = index
+        return None if best is None else self.keywords[best]
@@ -0,0 +1,111 @@
+"""
+协作式取消：消息处理时在当前线程绑定Context中的取消令牌，bot的重试循环和HTTP请求检查该令牌，
+重置会话时令牌被触发，HTTP客户端中断正在使用的连接，处理线程和连接池立即释放
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from common.log import logger
+
+_local = threading.local()
+
+
+class RequestCancelled(BaseException):
+    """
+    请求已被取消，继承BaseException以免被bot中的except Exception当作普通错误重试
+    """
+
+
+class CancellationToken(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.reason = None
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning("[Cancellation] callback error: {}".format(e))
+
+    def add_callback(self, callback):
+        """
+        注册取消时执行的回调，已取消时立即执行
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        """
+        移除尚未执行的回调，如请求结束后不再需要中断的连接
+        """
+        with self.lock:
+            try:
+                self.callbacks.remove(callback)
+            except ValueError:
+                pass
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise RequestCancelled(self.reason)
+
+    def wait(self, timeout) -> bool:
+        """
+        最多等待timeout秒，期间被取消时返回True
+        """
+        return self.event.wait(timeout)
+
+
+def current_token():
+    """
+    获取当前线程绑定的取消令牌，没有时返回None
+    """
+    return getattr(_local, "token", None)
+
+
+@contextmanager
+def bind(token: CancellationToken):
+    previous = current_token()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+def check():
+    """
+    当前线程的请求已被取消时抛出RequestCancelled
+    """
+    token = current_token()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def sleep(seconds):
+    """
+    用于重试等待的sleep，被取消时立即抛出RequestCancelled
+    """
+    token = current_token()
+    if token is None:
+        time.sleep(seconds)
+        return
+    if token.wait(seconds):
+        token.raise_if_cancelled()
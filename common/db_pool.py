@@ -0,0 +1,359 @@
+"""
+数据库连接池，会话持久化、插件和渠道共用，相同配置的数据库共享同一个连接池
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from common.log import logger
+from config import conf
+
+DEFAULT_POOL_CONFIG = {
+    "max_size": 8,  # 每个连接池的最大连接数
+    "timeout": 10,  # 等待空闲连接的超时时间（秒）
+    "check_idle_seconds": 30,  # 空闲超过该时间的连接在取出时检查是否存活
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(object):
+    """
+    连接代理，用法与原始连接一致，close()时归还连接池而不是真正关闭
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise AttributeError("connection already returned to pool")
+        return getattr(self._raw, name)
+
+    def close(self):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool._release(raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and self._raw is not None:
+            try:
+                self._raw.rollback()
+            except Exception:
+                # 回滚失败说明连接已不可用，直接丢弃
+                raw, self._raw = self._raw, None
+                self._pool._discard(raw)
+        self.close()
+        return False
+
+    def __del__(self):
+        # 调用方忘记close时也把连接还回池中
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool(object):
+    def __init__(self, name, creator, max_size=8, timeout=10, check_idle_seconds=30):
+        """
+        :param creator: 创建原始DB-API连接的函数
+        """
+        self.name = name
+        self.creator = creator
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_idle_seconds = check_idle_seconds
+        self.idle = deque()  # (连接, 归还时间)，后进先出以便多余连接自然空闲
+        self.size = 0
+        self.cond = threading.Condition()
+        self.checkouts = 0
+        self.created = 0
+        self.reconnects = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def connection(self) -> PooledConnection:
+        """
+        取出一个连接，使用完毕后调用close()或用with语句归还
+        """
+        start = time.time()
+        raw, idle_since = self._acquire()
+        wait_ms = (time.time() - start) * 1000
+        with self.cond:
+            self.checkouts += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        if raw is None:
+            raw = self._create()
+        elif time.time() - idle_since > self.check_idle_seconds and not self._is_alive(raw):
+            logger.info("[DBPool] {} connection lost, reconnecting".format(self.name))
+            self._close_raw(raw)
+            raw = self._create()
+            with self.cond:
+                self.reconnects += 1
+        return PooledConnection(self, raw)
+
+    def _acquire(self):
+        # 返回空闲连接，或在未达上限时占位返回None由调用方新建连接
+        deadline = time.time() + self.timeout
+        with self.cond:
+            while True:
+                if self.idle:
+                    return self.idle.pop()
+                if self.size < self.max_size:
+                    self.size += 1
+                    return None, 0
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout("[DBPool] {} no idle connection after {}s".format(self.name, self.timeout))
+                self.cond.wait(remaining)
+
+    def _create(self):
+        try:
+            raw = self.creator()
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.created += 1
+        return raw
+
+    def _release(self, raw):
+        if getattr(raw, "open", True) is False:
+            # pymysql连接已断开
+            self._discard(raw)
+            return
+        if _in_transaction(raw):
+            # 未提交的事务回滚掉，避免下一个使用者读到旧快照
+            try:
+                raw.rollback()
+            except Exception:
+                self._discard(raw)
+                return
+        with self.cond:
+            self.idle.append((raw, time.time()))
+            self.cond.notify()
+
+    def _discard(self, raw):
+        self._close_raw(raw)
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def _is_alive(self, raw):
+        try:
+            if hasattr(raw, "ping"):
+                raw.ping(reconnect=False)
+            else:
+                raw.cursor().execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def _close_raw(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.cond:
+            while self.idle:
+                raw, _ = self.idle.pop()
+                self._close_raw(raw)
+                self.size -= 1
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "created": self.created,
+                "reconnects": self.reconnects,
+                "avg_wait_ms": round(self.total_wait_ms / self.checkouts, 2) if self.checkouts else 0,
+                "max_wait_ms": round(self.max_wait_ms, 2),
+            }
+
+
+def _in_transaction(raw):
+    if hasattr(raw, "in_transaction"):
+        return raw.in_transaction
+    # pymysql: SERVER_STATUS_IN_TRANS
+    return bool(getattr(raw, "server_status", 1) & 1)
+
+
+def _pool_config() -> dict:
+    pool_config = dict(DEFAULT_POOL_CONFIG)
+    pool_config.update(conf().get("db_pool") or {})
+    return pool_config
+
+
+def _get_pool(key, name, creator) -> ConnectionPool:
+    pool = _pools.get(key)
+    if pool is not None:
+        return pool
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(name, creator, **_pool_config())
+            _pools[key] = pool
+            logger.info("[DBPool] connection pool created for {}".format(name))
+    return pool
+
+
+def get_mysql_pool(mysql_config: dict) -> ConnectionPool:
+    """
+    获取MySQL连接池，mysql_config为pymysql.connect的参数
+    """
+    params = dict(mysql_config)
+    params.setdefault("charset", "utf8mb4")
+    key = "mysql:" + json.dumps(params, sort_keys=True, default=str)
+    name = "mysql://{}:{}/{}".format(params.get("host"), params.get("port", 3306), params.get("database", ""))
+
+    def creator():
+        import pymysql
+        return pymysql.connect(**params)
+
+    return _get_pool(key, name, creator)
+
+
+def get_sqlite_pool(db_path: str) -> ConnectionPool:
+    """
+    获取SQLite连接池，连接已按tune_sqlite调优
+    """
+    return _get_pool("sqlite:" + db_path, "sqlite://" + db_path, lambda: connect_sqlite(db_path))
+
+
+def tune_sqlite(conn):
+    # WAL模式下读写互不阻塞，synchronous=NORMAL在WAL下只在检查点时fsync
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA foreign_keys=ON")
+
+
+def connect_sqlite(db_path: str, factory=sqlite3.Connection):
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False, factory=factory)
+    tune_sqlite(conn)
+    return conn
+
+
+class _FormatCursor(sqlite3.Cursor):
+    """支持%s占位符的游标，便于与MySQL共用SQL语句"""
+
+    def execute(self, sql, parameters=()):
+        return super().execute(_to_qmark(sql), parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return super().executemany(_to_qmark(sql), seq_of_parameters)
+
+
+class _FormatConnection(sqlite3.Connection):
+    def cursor(self, factory=_FormatCursor):
+        return super().cursor(factory)
+
+
+_qmark_cache = {}
+
+
+def _to_qmark(sql):
+    qmark_sql = _qmark_cache.get(sql)
+    if qmark_sql is None:
+        qmark_sql = sql.replace("%s", "?")
+        if len(_qmark_cache) < 1024:
+            _qmark_cache[sql] = qmark_sql
+    return qmark_sql
+
+
+class SQLiteDatabase(object):
+    """
+    SQLite单写多读：写操作串行使用同一个连接并在一个事务中提交，读操作使用线程独享的连接
+    """
+
+    def __init__(self, db_path, paramstyle="qmark"):
+        self.db_path = db_path
+        self.factory = _FormatConnection if paramstyle == "format" else sqlite3.Connection
+        self.writer = connect_sqlite(db_path, self.factory)
+        self.write_lock = threading.RLock()
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+
+    def reader(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = connect_sqlite(self.db_path, self.factory)
+            self.local.conn = conn
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+
+    @contextmanager
+    def read(self):
+        yield self.reader()
+
+    @contextmanager
+    def write(self):
+        with self.write_lock:
+            try:
+                yield self.writer
+                self.writer.commit()
+            except Exception:
+                self.writer.rollback()
+                raise
+
+    def close(self):
+        with self.write_lock:
+            self.writer.close()
+        with self.readers_lock:
+            for conn in self.readers:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self.readers.clear()
+
+
+_sqlite_databases = {}
+
+
+def get_sqlite_database(db_path: str, paramstyle="qmark") -> SQLiteDatabase:
+    key = (os.path.abspath(db_path), paramstyle)
+    with _pools_lock:
+        database = _sqlite_databases.get(key)
+        if database is None:
+            database = SQLiteDatabase(db_path, paramstyle)
+            _sqlite_databases[key] = database
+            logger.info("[DBPool] sqlite database opened: {}".format(db_path))
+    return database
+
+
+def get_stats() -> dict:
+    """
+    获取各连接池的连接数和等待耗时
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.name: pool.stats() for pool in pools}
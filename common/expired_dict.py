@@ -1,22 +1,86 @@
-from datetime import datetime, timedelta
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
+from common.log import logger
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+SWEEP_INTERVAL_SECONDS = 60
+
+_instances = weakref.WeakValueDictionary()  # id -> ExpiredDict
+_sweeper_lock = threading.Lock()
+_sweeper = None
+
+
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的字典，读写时刷新过期时间（遍历、in判断不刷新）
+    条目按过期时间先后保存在OrderedDict中，过期清理只需从头部弹出，均摊O(1)
+    设置max_entries后超出容量时淘汰最久未访问的条目
+    on_evict(key, value)在条目过期或被淘汰后调用，调用时不持有锁
+    """
+
+    def __init__(self, expires_in_seconds, max_entries=None, on_evict=None):
         self.expires_in_seconds = expires_in_seconds
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self._evicted = []  # 待回调的(key, value)
+        self._data = OrderedDict()  # key -> (value, expiry_time)，越靠前越早过期
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.expired_count = 0
+        self.evicted_count = 0
+        _register(self)
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > time.monotonic():
+                self.hits += 1
+                self._data[key] = (item[0], time.monotonic() + self.expires_in_seconds)
+                self._data.move_to_end(key)
+                return item[0]
+            self.misses += 1
+            if item is not None:
+                del self._data[key]
+                self.expired_count += 1
+                self._add_evicted(key, item[0])
+        self._notify_evicted()
+        raise KeyError("expired {}".format(key) if item else key)
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._lock:
+            now = time.monotonic()
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            self._expire(now)
+            if self.max_entries:
+                while len(self._data) > self.max_entries:
+                    evicted_key, (evicted_value, _) = self._data.popitem(last=False)
+                    self.evicted_count += 1
+                    self._add_evicted(evicted_key, evicted_value)
+        self._notify_evicted()
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[1] > time.monotonic()
+
+    def __len__(self):
+        with self._lock:
+            self._expire()
+            size = len(self._data)
+        self._notify_evicted()
+        return size
+
+    def __iter__(self):
+        return iter(self.keys())
 
     def get(self, key, default=None):
         try:
@@ -24,19 +88,101 @@ class ExpiredDict(dict):
         except KeyError:
             return default
 
-    def __contains__(self, key):
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
-
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        with self._lock:
+            self._expire()
+            result = list(self._data.keys())
+        self._notify_evicted()
+        return result
+
+    def values(self):
+        with self._lock:
+            self._expire()
+            result = [value for value, _ in self._data.values()]
+        self._notify_evicted()
+        return result
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        with self._lock:
+            self._expire()
+            result = [(key, value) for key, (value, _) in self._data.items()]
+        self._notify_evicted()
+        return result
 
-    def __iter__(self):
-        return self.keys().__iter__()
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def expire(self):
+        """
+        清理所有已过期条目，返回清理数量
+        """
+        with self._lock:
+            count = self._expire()
+        self._notify_evicted()
+        return count
+
+    def _expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        count = 0
+        while self._data:
+            key, (value, expiry_time) = next(iter(self._data.items()))
+            if expiry_time > now:
+                break
+            del self._data[key]
+            self._add_evicted(key, value)
+            count += 1
+        self.expired_count += count
+        return count
+
+    def _add_evicted(self, key, value):
+        if self.on_evict is not None:
+            self._evicted.append((key, value))
+
+    def _notify_evicted(self):
+        if not self._evicted:
+            return
+        with self._lock:
+            evicted, self._evicted = self._evicted, []
+        for key, value in evicted:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logger.warning("[ExpiredDict] on_evict failed for {}: {}".format(key, e))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired_count,
+                "evicted": self.evicted_count,
+            }
+
+    def __repr__(self):
+        return "ExpiredDict({})".format(dict(self.items()))
+
+
+def _register(expired_dict):
+    global _sweeper
+    _instances[id(expired_dict)] = expired_dict
+    if _sweeper is not None:
+        return
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep_forever, name="expired-dict-sweeper", daemon=True)
+            _sweeper.start()
+
+
+def _sweep_forever():
+    # 后台定期清理长时间无读写的字典，避免过期条目一直占用内存
+    while True:
+        time.sleep(SWEEP_INTERVAL_SECONDS)
+        for expired_dict in list(_instances.values()):
+            try:
+                expired_dict.expire()
+            except Exception as e:
+                logger.warning("[ExpiredDict] sweep failed: {}".format(e))
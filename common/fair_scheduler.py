@@ -0,0 +1,79 @@
+from collections import deque
+
+
+class _Flow(object):
+    __slots__ = ("items", "weight", "deficit")
+
+    def __init__(self, weight):
+        self.items = deque()
+        self.weight = weight
+        self.deficit = 0.0
+
+
+class DeficitRoundRobin(object):
+    """
+    两级加权差额轮询（DRR）：先在flow（如租户）之间按权重轮转，再在flow内部的条目（如session）之间轮转
+    权重为w的flow每轮最多取出w个条目，权重小于1时跨轮累积，非线程安全，由调用方加锁
+    """
+
+    def __init__(self):
+        self.flows = {}  # flow -> _Flow
+        self.active = deque()  # 有待调度条目的flow
+        self.members = {}  # item -> flow
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, item):
+        return item in self.members
+
+    def push(self, item, flow, weight=1):
+        """
+        加入待调度条目，同一条目只会排队一次，返回是否新加入
+        """
+        if item in self.members:
+            return False
+        f = self.flows.get(flow)
+        if f is None:
+            f = _Flow(weight)
+            self.flows[flow] = f
+            self.active.append(flow)
+        else:
+            f.weight = max(f.weight, weight)
+        f.items.append(item)
+        self.members[item] = flow
+        return True
+
+    def pop(self):
+        """
+        取出下一个条目，没有时返回None
+        """
+        while self.active:
+            flow = self.active[0]
+            f = self.flows[flow]
+            if f.deficit < 1:
+                f.deficit += f.weight
+                if f.deficit < 1:
+                    self.active.rotate(-1)
+                    continue
+            item = f.items.popleft()
+            f.deficit -= 1
+            del self.members[item]
+            if not f.items:
+                # flow空闲后不保留额度，避免空闲一段时间后突发占满
+                self.active.popleft()
+                del self.flows[flow]
+            elif f.deficit < 1:
+                self.active.rotate(-1)
+            return item
+        return None
+
+    def discard(self, item):
+        flow = self.members.pop(item, None)
+        if flow is None:
+            return
+        f = self.flows[flow]
+        f.items.remove(item)
+        if not f.items:
+            self.active.remove(flow)
+            del self.flows[flow]
@@ -0,0 +1,256 @@
+"""
+全局共享的HTTP客户端，所有bot和channel的出站请求复用同一组按host划分的keep-alive连接池
+"""
+
+import socket
+import threading
+import time
+from functools import partial
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from common import cancellation
+from common.log import logger
+from config import conf
+
+DEFAULT_HTTP_CONFIG = {
+    "pool_connections": 20,  # 缓存的host连接池数量
+    "pool_maxsize": 50,  # 每个host连接池的最大连接数
+    "connect_timeout": 5,  # 建立连接超时时间（秒）
+    "read_timeout": 180,  # 读取响应超时时间（秒）
+    "max_retries": 2,  # 连接失败的重试次数，已发出的请求不会重试，避免重复调用大模型
+    "backoff_factor": 0.5,  # 重试间隔系数
+}
+
+_lock = threading.Lock()
+_pooled = None  # 当前的_PooledSession
+_sdk_sessions = {}  # (proxy, 配置) -> 交给sdk长期持有的_SdkSession
+_config_version = None  # 创建连接池时的配置版本，版本不变时无需再比较配置
+_latency_stats = {}  # host -> [请求数, 总耗时ms, 最大耗时ms]
+
+
+class _PooledSession(object):
+    """
+    连接池及创建它的配置，配置变化后旧连接池在所有进行中的请求结束后才关闭
+    """
+
+    def __init__(self, session: requests.Session, http_config: dict):
+        self.session = session
+        self.config = http_config
+        self.users = 0  # 正在使用该连接池的请求数
+        self.retired = False
+
+
+class _SdkSession(requests.Session):
+    """
+    交给sdk长期持有的Session：sdk按自己的会话有效期调用close()，连接池由本模块管理，忽略该调用
+    """
+
+    def close(self):
+        pass
+
+
+class _CancellablePoolMixin(object):
+    """
+    连接从池中取出时注册到当前线程的取消令牌，会话被重置时直接中断该连接，阻塞的读取立即返回
+    """
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        token = cancellation.current_token()
+        if token is not None:
+            abort = partial(_abort_connection, conn)
+            conn.cancel_binding = (token, abort)
+            token.add_callback(abort)
+        return conn
+
+    def _put_conn(self, conn):
+        binding = getattr(conn, "cancel_binding", None)
+        if binding is not None:
+            conn.cancel_binding = None
+            binding[0].remove_callback(binding[1])
+        super()._put_conn(conn)
+
+
+class _CancellableHTTPConnectionPool(_CancellablePoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CancellableHTTPSConnectionPool(_CancellablePoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _CancellableAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CancellableHTTPConnectionPool,
+            "https": _CancellableHTTPSConnectionPool,
+        }
+
+
+def _abort_connection(conn):
+    # 在取消线程中调用，shutdown会唤醒阻塞在该socket上的读写，连接随后被urllib3丢弃
+    sock = getattr(conn, "sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _http_config() -> dict:
+    http_config = dict(DEFAULT_HTTP_CONFIG)
+    http_config.update(conf().get("http_client") or {})
+    return http_config
+
+
+def _build_session(http_config: dict, session_cls=requests.Session) -> requests.Session:
+    retries = Retry(
+        total=http_config["max_retries"],
+        connect=http_config["max_retries"],
+        read=0,
+        backoff_factor=http_config["backoff_factor"],
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),
+        raise_on_status=False,
+    )
+    adapter = _CancellableAdapter(
+        pool_connections=http_config["pool_connections"],
+        pool_maxsize=http_config["pool_maxsize"],
+        max_retries=retries,
+    )
+    session = session_cls()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _current_pooled() -> _PooledSession:
+    # 持有_lock时调用，配置变化后创建新连接池，旧连接池没有进行中的请求时立即关闭
+    global _pooled, _config_version
+    config_version = conf().version
+    if _pooled is not None and _config_version == config_version:
+        return _pooled
+    http_config = _http_config()
+    if _pooled is None or _pooled.config != http_config:
+        old_pooled = _pooled
+        _pooled = _PooledSession(_build_session(http_config), http_config)
+        logger.info("[HttpClient] connection pool created, config={}".format(http_config))
+        if old_pooled is not None:
+            old_pooled.retired = True
+            if old_pooled.users == 0:
+                old_pooled.session.close()
+    _config_version = config_version
+    return _pooled
+
+
+def get_session() -> requests.Session:
+    """
+    获取共享的requests.Session，配置变化后重建连接池
+    长期持有该Session的调用方（如sdk）在配置变化后继续使用旧连接池
+    """
+    with _lock:
+        return _current_pooled().session
+
+
+def get_sdk_session(proxy=None) -> requests.Session:
+    """
+    获取交给sdk（如openai.requestssession）使用的Session，与全局连接池配置相同，proxy写入session.proxies
+    sdk会直接使用该Session并传入session.proxies，关闭由sdk发起时不生效，相同代理和配置的sdk共用一个
+    """
+    http_config = _http_config()
+    key = (proxy or "", tuple(sorted(http_config.items())))
+    with _lock:
+        session = _sdk_sessions.get(key)
+        if session is None:
+            session = _build_session(http_config, _SdkSession)
+            if proxy:
+                session.proxies = {"http": proxy, "https": proxy}
+            _sdk_sessions[key] = session
+        return session
+
+
+def _acquire() -> _PooledSession:
+    """
+    获取当前连接池及其配置，使用期间连接池不会被关闭，用完后调用_release
+    """
+    with _lock:
+        pooled = _current_pooled()
+        pooled.users += 1
+        return pooled
+
+
+def _release(pooled: _PooledSession):
+    with _lock:
+        pooled.users -= 1
+        close = pooled.retired and pooled.users == 0
+    if close:
+        pooled.session.close()
+
+
+def request(method, url, **kwargs) -> requests.Response:
+    pooled = _acquire()
+    try:
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (pooled.config["connect_timeout"], pooled.config["read_timeout"])
+        start = time.time()
+        cancellation.check()
+        try:
+            return pooled.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            # 会话被重置时连接被中断，抛出RequestCancelled而不是网络错误，避免bot重试
+            cancellation.check()
+            raise
+        finally:
+            _record_latency(urlparse(url).netloc, (time.time() - start) * 1000)
+    finally:
+        # 流式响应返回后仍在读取，关闭连接池只会关闭空闲连接，不影响已取出的连接
+        _release(pooled)
+
+
+def get(url, params=None, **kwargs) -> requests.Response:
+    return request("GET", url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs) -> requests.Response:
+    return request("POST", url, data=data, json=json, **kwargs)
+
+
+def _record_latency(host, cost_ms):
+    with _lock:
+        stat = _latency_stats.setdefault(host, [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += cost_ms
+        stat[2] = max(stat[2], cost_ms)
+
+
+def get_stats() -> dict:
+    """
+    获取各host的连接池命中情况和请求耗时
+    :return: {host: {"requests", "new_connections", "pool_hits", "avg_latency_ms", "max_latency_ms"}}
+    """
+    stats = {}
+    pooled = _pooled
+    if pooled is not None:
+        pool_manager = pooled.session.get_adapter("https://").poolmanager
+        for key in list(pool_manager.pools.keys()):
+            pool = pool_manager.pools.get(key)
+            if pool is None:
+                continue
+            host = pool.host if pool.port in (None, 80, 443) else "{}:{}".format(pool.host, pool.port)
+            stat = stats.setdefault(host, {"requests": 0, "new_connections": 0, "pool_hits": 0})
+            stat["requests"] += pool.num_requests
+            stat["new_connections"] += pool.num_connections
+            stat["pool_hits"] += max(pool.num_requests - pool.num_connections, 0)
+    with _lock:
+        for host, (count, total_ms, max_ms) in _latency_stats.items():
+            stat = stats.setdefault(host, {"requests": 0, "new_connections": 0, "pool_hits": 0})
+            stat["avg_latency_ms"] = round(total_ms / count, 1) if count else 0
+            stat["max_latency_ms"] = round(max_ms, 1)
+    return stats
@@ -0,0 +1,43 @@
+import threading
+
+
+class _Call(object):
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    合并同一key的并发调用：第一个调用方执行fn，其余调用方等待并共享其结果或异常
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> _Call
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.done.set()
@@ -0,0 +1,51 @@
+"""
+解析OpenAI兼容接口的SSE流式响应
+"""
+
+import json
+
+from common import cancellation
+from common.log import logger
+
+
+def iter_events(response):
+    """
+    逐个返回SSE响应中data行解析出的json对象，遇到[DONE]结束
+    """
+    # chunk_size=None时按服务端发送的分块读取，不会等凑满缓冲区才返回
+    lines = response.iter_lines(chunk_size=None)
+    while True:
+        try:
+            line = next(lines)
+        except StopIteration:
+            return
+        except Exception:
+            # 会话被重置时连接被中断，读取失败的原因是取消
+            cancellation.check()
+            raise
+        # 会话被重置时停止读取
+        cancellation.check()
+        if not line:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        try:
+            yield json.loads(data)
+        except json.JSONDecodeError:
+            logger.debug("[SSE] skip invalid line: {}".format(line))
+
+
+def iter_chat_deltas(response):
+    """
+    逐段返回chat completions流式响应中的文本增量
+    """
+    for event in iter_events(response):
+        choices = event.get("choices") or [{}]
+        delta = (choices[0].get("delta") or {}).get("content")
+        if delta:
+            yield delta
@@ -3,25 +3,51 @@ import time
 import config
 from common.log import logger
 
+TIME_REGEX = re.compile(r"^([01]?[0-9]|2[0-4])(:)([0-5][0-9])$")
+# 如果以 #reconf 或者  #更新配置  结尾, 非服务时间可以修改开始/结束时间并重载配置
+RECONF_PATTERN = re.compile(r"^.*#(?:reconf|更新配置)$")
 
-def time_checker(f):
-    def _time_checker(self, *args, **kwargs):
-        _config = config.conf()
-        chat_time_module = _config.get("chat_time_module", False)
+_service_time = (None, None)  # (配置版本, 服务时间)
 
-        if chat_time_module:
-            chat_start_time = _config.get("chat_start_time", "00:00")
-            chat_stop_time = _config.get("chat_stop_time", "24:00")
 
-            time_regex = re.compile(r"^([01]?[0-9]|2[0-4])(:)([0-5][0-9])$")
+def _get_service_time(_config):
+    """
+    按配置版本缓存解析后的服务时间
+    :return: None表示未开启时间模块，False表示时间格式错误，否则为(开始分钟数, 结束分钟数)
+    """
+    global _service_time
+    version, service_time = _service_time
+    if version == _config.version:
+        return service_time
+    service_time = None
+    if _config.get("chat_time_module", False):
+        chat_start_time = _config.get("chat_start_time", "00:00")
+        chat_stop_time = _config.get("chat_stop_time", "24:00")
+        start_match = TIME_REGEX.match(chat_start_time)
+        stop_match = TIME_REGEX.match(chat_stop_time)
+        if start_match and stop_match:
+            service_time = (
+                int(start_match.group(1)) * 60 + int(start_match.group(3)),
+                int(stop_match.group(1)) * 60 + int(stop_match.group(3)),
+            )
+        else:
+            service_time = False
+    _service_time = (_config.version, service_time)
+    return service_time
+
+
+def time_checker(f):
+    def _time_checker(self, *args, **kwargs):
+        service_time = _get_service_time(config.conf())
 
-            if not (time_regex.match(chat_start_time) and time_regex.match(chat_stop_time)):
+        if service_time is not None:
+            if service_time is False:
                 logger.warning("时间格式不正确，请在config.json中修改CHAT_START_TIME/CHAT_STOP_TIME。")
                 return None
 
-            now_time = time.strptime(time.strftime("%H:%M"), "%H:%M")
-            chat_start_time = time.strptime(chat_start_time, "%H:%M")
-            chat_stop_time = time.strptime(chat_stop_time, "%H:%M")
+            now = time.localtime()
+            now_time = now.tm_hour * 60 + now.tm_min
+            chat_start_time, chat_stop_time = service_time
             # 结束时间小于开始时间，跨天了
             if chat_stop_time < chat_start_time and (chat_start_time <= now_time or now_time <= chat_stop_time):
                 f(self, *args, **kwargs)
@@ -29,9 +55,7 @@ def time_checker(f):
             elif chat_start_time < chat_stop_time and chat_start_time <= now_time <= chat_stop_time:
                 f(self, *args, **kwargs)
             else:
-                # 定义匹配规则，如果以 #reconf 或者  #更新配置  结尾, 非服务时间可以修改开始/结束时间并重载配置
-                pattern = re.compile(r"^.*#(?:reconf|更新配置)$")
-                if args and pattern.match(args[0].content):
+                if args and RECONF_PATTERN.match(args[0].content):
                     f(self, *args, **kwargs)
                 else:
                     logger.info("非服务时间内，不接受访问")
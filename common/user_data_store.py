@@ -0,0 +1,123 @@
+"""
+用户数据存储，每个用户的数据单独保存在SQLite中，首次访问时才从数据库读取，修改时立即写入
+"""
+
+import json
+import os
+import pickle
+import threading
+
+from common.db_pool import get_sqlite_database
+from common.expired_dict import ExpiredDict
+from common.log import logger
+
+CACHE_EXPIRES_SECONDS = 3600
+CACHE_MAX_ENTRIES = 10000
+
+
+class UserData(dict):
+    """
+    单个用户的数据，用法与dict一致，修改后立即写入存储
+    """
+
+    def __init__(self, store, user, data=None):
+        super().__init__(data or {})
+        self._store = store
+        self._user = user
+
+    def _persist(self):
+        self._store.put(self._user, dict(self))
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._persist()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._persist()
+
+    def pop(self, key, *default):
+        existed = key in self
+        value = super().pop(key, *default)
+        if existed:
+            self._persist()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._persist()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._persist()
+
+    def clear(self):
+        super().clear()
+        self._persist()
+
+
+class UserDataStore(object):
+    def __init__(self, db_path, legacy_path=None):
+        self.database = get_sqlite_database(db_path)
+        self.cache = ExpiredDict(CACHE_EXPIRES_SECONDS, max_entries=CACHE_MAX_ENTRIES)
+        self.lock = threading.Lock()
+        with self.database.write() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS user_datas (
+                    user TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+        if legacy_path and os.path.exists(legacy_path):
+            self._import_legacy(legacy_path)
+
+    def get(self, user) -> UserData:
+        user_data = self.cache.get(user)
+        if user_data is not None:
+            return user_data
+        with self.lock:
+            # 加锁后再查一次，避免并发时同一用户生成两个对象，其中一个的修改被覆盖
+            user_data = self.cache.get(user)
+            if user_data is None:
+                row = self.database.reader().execute("SELECT data FROM user_datas WHERE user = ?", (user,)).fetchone()
+                user_data = UserData(self, user, json.loads(row[0]) if row else None)
+                self.cache[user] = user_data
+        return user_data
+
+    def put(self, user, data: dict):
+        with self.database.write() as conn:
+            if data:
+                conn.execute(
+                    """
+                    INSERT INTO user_datas (user, data) VALUES (?, ?)
+                    ON CONFLICT(user) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+                    """,
+                    (user, json.dumps(data, ensure_ascii=False)),
+                )
+            else:
+                conn.execute("DELETE FROM user_datas WHERE user = ?", (user,))
+
+    def _import_legacy(self, legacy_path):
+        # 旧版本把全部用户数据pickle到一个文件中，导入一次后改名保留
+        try:
+            with open(legacy_path, "rb") as f:
+                user_datas = pickle.load(f)
+            with self.database.write() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO user_datas (user, data) VALUES (?, ?)",
+                    [(user, json.dumps(data, ensure_ascii=False)) for user, data in user_datas.items() if data],
+                )
+            os.replace(legacy_path, legacy_path + ".migrated")
+            logger.info("[UserDataStore] imported {} users from {}".format(len(user_datas), legacy_path))
+        except Exception as e:
+            logger.warning("[UserDataStore] import {} failed: {}".format(legacy_path, e))
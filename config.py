@@ -3,8 +3,9 @@
 import json
 import logging
 import os
-import pickle
 import copy
+import threading
+import types
 
 from common.log import logger
 
@@ -48,11 +49,25 @@ available_setting = {
     "azure_openai_dalle_deployment_id":"", # [可选] azure openai 用于回复图片的资源 deployment id，默认使用 text_to_image
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
-    "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1时并发处理，回复仍按消息顺序发送
+    "reply_order_timeout_seconds": 60,  # 并发处理时回复等待前面消息的最长时间，超时后直接发送
+    "coalesce_window_ms": 0,  # 同一会话在该时间窗口内连续发送的文本消息合并为一条处理，0为不合并
+    "max_queued_per_session": 20,  # 每个会话最多排队的消息数，0为不限制，#开头的管理命令不受限制
+    "max_queued_total": 2000,  # 所有会话排队的消息总数上限，0为不限制
+    "overload_policy": "busy_reply",  # 超过排队上限时的处理方式: busy_reply回复繁忙提示, drop直接丢弃
+    "overload_reply": "当前消息较多，请稍后再试",  # 繁忙提示
+    "max_queue_age_seconds": 300,  # 消息排队超过该时间后丢弃不再处理，0为不限制
+    # 线程池按租户和会话加权轮询调度，租户取自消息的tenant_id/vip_code，priority_classes为各优先级的权重
+    # admin为#开头的管理命令，vip为带vip_code的消息，也可以由插件在context中设置priority指定优先级
+    "fair_scheduling": {
+        "priority_classes": {"admin": 8, "vip": 4, "normal": 1},
+    },
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "max_sessions": 0,  # 内存中保留的最大会话数，超出时淘汰最久未使用的会话，0表示不限制
+    "received_msgs_max_entries": 50000,  # 消息去重缓存的最大条目数
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
@@ -148,6 +163,18 @@ available_setting = {
     "feishu_app_secret": "",  # 飞书机器人APP secret
     "feishu_token": "",  # 飞书 verification token
     "feishu_bot_name": "",  # 飞书机器人的名字
+    "feishu_token_refresh_ahead": 1200,  # tenant_access_token过期前多少秒在后台刷新，需小于1800
+    "terminal_stream_reply": True,  # 命令行通道是否边生成边输出回复
+    "feishu_stream_reply": False,  # 是否流式回复：先发送卡片，再随模型输出逐步更新卡片内容
+    "feishu_stream_interval_ms": 500,  # 流式回复更新卡片的最小间隔，同一消息的更新接口限频5次/秒
+    "feishu_stream_placeholder": "思考中...",  # 流式回复卡片在首个字到达前显示的内容
+    "feishu_event_workers": 4,  # 处理飞书消息事件的后台线程数，回调收到事件后立即返回
+    "feishu_event_queue_size": 1000,  # 每个后台线程的事件队列长度，队列满时回调返回失败由飞书重推
+    "feishu_profile_cache": {  # 飞书用户名和群名的内存缓存，在MySQL缓存之前
+        "expires_in_seconds": 3600,
+        "max_entries": 20000,
+        "negative_expires_in_seconds": 300,  # 获取失败或名字为空的用户和群，在该时间内不再重复查询
+    },
     # 钉钉配置
     "dingtalk_client_id": "",  # 钉钉机器人Client ID 
     "dingtalk_client_secret": "",  # 钉钉机器人Client Secret
@@ -185,7 +212,7 @@ available_setting = {
     "web_port": 9899,
     # 数据库配置 - 用于持久化会话管理
     "database": {
-        "type": "sqlite",  # 数据库类型，支持 sqlite, mysql, postgresql
+        "type": "sqlite",  # 数据库类型，支持 sqlite, mysql
         "host": "localhost",  # 数据库主机地址
         "port": 3306,  # 数据库端口
         "username": "",  # 数据库用户名
@@ -193,23 +220,81 @@ available_setting = {
         "database_name": "chatbotx",  # 数据库名称
         "sqlite_path": "data/chatbotx.db"  # SQLite数据库文件路径
     },
+    # 出站HTTP连接池配置，所有bot和channel共享
+    "http_client": {
+        "pool_connections": 20,  # 缓存的host连接池数量
+        "pool_maxsize": 50,  # 每个host连接池的最大连接数
+        "connect_timeout": 5,  # 建立连接超时时间（秒）
+        "read_timeout": 180,  # 未指定超时的请求读取响应的超时时间（秒）
+        "max_retries": 2,  # 连接失败时的重试次数
+        "backoff_factor": 0.5  # 重试间隔系数
+    },
+    # 数据库连接池配置，会话持久化和插件共享
+    "db_pool": {
+        "max_size": 8,  # 每个连接池的最大连接数
+        "timeout": 10,  # 等待空闲连接的超时时间（秒）
+        "check_idle_seconds": 30,  # 空闲超过该时间的连接在取出时检查是否存活
+    },
     "session_persistence": {
         "enabled": False,  # 是否启用会话持久化
         "max_sessions_per_user": 10,  # 每个用户最大会话数
-        "auto_save_interval": 60  # 自动保存间隔（秒）
+        "max_active_sessions": 10000,  # 内存中保留的活跃会话数，超出时淘汰最久未使用的会话
+        "auto_save_interval": 60,  # 自动保存间隔（秒）
+        "write_mode": "async",  # async: 后台批量写入；sync: 每次收发消息时同步写入
+        "flush_batch_size": 50,  # 异步模式下累计多少次变更立即写入
+        "max_pending_writes": 1000,  # 异步模式下积压变更超过该值时在当前线程同步写入
     },
 }
 
 
+def _freeze(value):
+    # 快照中的列表转为tuple、dict转为只读映射，防止调用方修改共享的配置
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+class ConfigSnapshot(object):
+    """
+    配置的只读快照，available_setting中的每个配置项都是一个属性，未配置的为None
+    同一版本的配置共用一个快照，热路径上读取配置只需属性访问
+    """
+
+    def __init__(self, values: dict, version: int):
+        for key in available_setting:
+            object.__setattr__(self, key, _freeze(values.get(key)))
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "_keys", frozenset(values.keys()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("config snapshot is read-only")
+
+    def get(self, key, default=None):
+        """与Config.get一致，未配置时返回default"""
+        if key not in self._keys:
+            return default
+        return getattr(self, key)
+
+
 class Config(dict):
     def __init__(self, d=None):
         super().__init__()
+        # 每次修改配置时版本号加一，依赖配置的缓存可以通过版本号判断是否需要重建
+        self.version = 0
+        self.lock = threading.RLock()
+        self.subscribers = []
+        self._snapshot = None
         if d is None:
             d = {}
         for k, v in d.items():
             self[k] = v
-        # user_datas: 用户数据，key为用户名，value为用户数据，也是dict
-        self.user_datas = {}
+        # 用户数据存储，首次访问用户数据时才打开
+        self.user_data_store = None
+        self.user_data_lock = threading.Lock()
 
     def __getitem__(self, key):
         if key not in available_setting:
@@ -219,40 +304,110 @@ class Config(dict):
     def __setitem__(self, key, value):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
-        return super().__setitem__(key, value)
+        with self.lock:
+            super().__setitem__(key, value)
+            self.version += 1
+        self._notify()
+
+    def __delitem__(self, key):
+        with self.lock:
+            super().__delitem__(key)
+            self.version += 1
+        self._notify()
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError as e:
-            return default
-        except Exception as e:
-            raise e
+        if key not in available_setting:
+            raise Exception("key {} not in available_setting".format(key))
+        return super().get(key, default)
+
+    def update(self, values=None, **kwargs):
+        """
+        批量修改配置，所有修改一次生效，只产生一个新版本
+        """
+        values = dict(values or {}, **kwargs)
+        for key in values:
+            if key not in available_setting:
+                raise Exception("key {} not in available_setting".format(key))
+        with self.lock:
+            super().update(values)
+            self.version += 1
+        self._notify()
+
+    def replace(self, values: dict):
+        """
+        用values整体替换当前配置，重新加载配置文件时使用
+        """
+        for key in values:
+            if key not in available_setting:
+                raise Exception("key {} not in available_setting".format(key))
+        with self.lock:
+            super().clear()
+            super().update(values)
+            self.version += 1
+        self._notify()
+
+    def snapshot(self) -> ConfigSnapshot:
+        """
+        获取当前版本配置的只读快照
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self.version:
+            return snapshot
+        with self.lock:
+            if self._snapshot is None or self._snapshot.version != self.version:
+                self._snapshot = ConfigSnapshot(self, self.version)
+            return self._snapshot
+
+    def subscribe(self, callback):
+        """
+        订阅配置变化，配置修改后以新快照调用callback(snapshot)
+        """
+        with self.lock:
+            self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def _notify(self):
+        if not self.subscribers:
+            return
+        snapshot = self.snapshot()
+        for callback in list(self.subscribers):
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logger.warning("[Config] config subscriber failed: {}".format(e))
 
     # Make sure to return a dictionary to ensure atomic
     def get_user_data(self, user) -> dict:
-        if self.user_datas.get(user) is None:
-            self.user_datas[user] = {}
-        return self.user_datas[user]
+        """
+        获取用户数据，返回的dict修改后立即持久化
+        """
+        return self._get_user_data_store().get(user)
+
+    def _get_user_data_store(self):
+        if self.user_data_store is None:
+            with self.user_data_lock:
+                if self.user_data_store is None:
+                    from common.user_data_store import UserDataStore
+
+                    data_dir = get_appdata_dir()
+                    self.user_data_store = UserDataStore(
+                        os.path.join(data_dir, "user_datas.db"), legacy_path=os.path.join(data_dir, "user_datas.pkl")
+                    )
+                    logger.info("[Config] User data store opened.")
+        return self.user_data_store
 
     def load_user_datas(self):
-        try:
-            with open(os.path.join(get_appdata_dir(), "user_datas.pkl"), "rb") as f:
-                self.user_datas = pickle.load(f)
-                logger.info("[Config] User datas loaded.")
-        except FileNotFoundError as e:
-            logger.info("[Config] User datas file not found, ignore.")
-        except Exception as e:
-            logger.info("[Config] User datas error: {}".format(e))
-            self.user_datas = {}
+        # 用户数据在首次访问时按用户读取，这里只丢弃已打开的存储，下次访问时按新的appdata_dir重新打开
+        self.user_data_store = None
 
     def save_user_datas(self):
-        try:
-            with open(os.path.join(get_appdata_dir(), "user_datas.pkl"), "wb") as f:
-                pickle.dump(self.user_datas, f)
-                logger.info("[Config] User datas saved.")
-        except Exception as e:
-            logger.info("[Config] User datas error: {}".format(e))
+        # 用户数据修改时已写入，无需在退出时保存
+        pass
 
 
 config = Config()
@@ -270,7 +425,7 @@ def drag_sensitive(config):
             return json.dumps(conf_dict_copy, indent=4)
 
         elif isinstance(config, dict):
-            config_copy = copy.deepcopy(config)
+            config_copy = copy.deepcopy(dict(config))
             for key in config:
                 if "key" in key or "secret" in key:
                     if isinstance(config_copy[key], str):
@@ -283,7 +438,6 @@ def drag_sensitive(config):
 
 
 def load_config():
-    global config
     config_path = "./config.json"
     if not os.path.exists(config_path):
         logger.info("配置文件不存在，将使用config-template.json模板")
@@ -293,7 +447,7 @@ def load_config():
     logger.debug("[INIT] config str: {}".format(drag_sensitive(config_str)))
 
     # 将json字符串反序列化为dict类型
-    config = Config(json.loads(config_str))
+    values = json.loads(config_str)
 
     # override config with environment variables.
     # Some online deployment platforms (e.g. Railway) deploy project from github directly. So you shouldn't put your secrets like api key in a config file, instead use environment variables to override the default config.
@@ -302,14 +456,21 @@ def load_config():
         if name in available_setting:
             logger.info("[INIT] override config by environ args: {}={}".format(name, value))
             try:
-                config[name] = eval(value)
+                values[name] = eval(value)
             except:
                 if value == "false":
-                    config[name] = False
+                    values[name] = False
                 elif value == "true":
-                    config[name] = True
+                    values[name] = True
                 else:
-                    config[name] = value
+                    values[name] = value
+
+    if os.path.exists("chatrule.txt"):
+        values['character_desc'] = read_file("chatrule.txt")
+        logger.info("[INIT] load chatrule.txt: {}".format(values['character_desc']))
+
+    # 原地替换配置，所有修改一次生效，订阅者只收到一次通知
+    config.replace(values)
 
     if config.get("debug", False):
         logger.setLevel(logging.DEBUG)
@@ -317,11 +478,6 @@ def load_config():
 
     logger.info("[INIT] load config: {}".format(drag_sensitive(config)))
 
-
-    if os.path.exists("chatrule.txt"):
-        config['character_desc'] = read_file("chatrule.txt")
-        logger.info("[INIT] load chatrule.txt: {}".format(config['character_desc']))
-
     config.load_user_datas()
 
 
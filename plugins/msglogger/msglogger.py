@@ -10,6 +10,7 @@ import plugins
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from channel.chat_message import ChatMessage
+from common.db_pool import connect_sqlite, get_mysql_pool, get_sqlite_pool
 from common.log import logger
 from plugins import *
 from config import conf
@@ -49,6 +50,14 @@ class MsgLogger(Plugin):
                 
                 # 初始化MySQL数据库
                 self._init_mysql_db()
+                self.pool = get_mysql_pool({
+                    "host": self.mysql_config["host"],
+                    "port": self.mysql_config["port"],
+                    "user": self.mysql_config["user"],
+                    "password": self.mysql_config["password"],
+                    "database": self.mysql_config["database"],
+                    "charset": "utf8mb4",
+                })
             else:
                 # SQLite配置
                 self.db_path = self.config.get("db_path", "message_logs.db")
@@ -57,6 +66,7 @@ class MsgLogger(Plugin):
                     
                 # 初始化SQLite数据库
                 self._init_sqlite_db()
+                self.pool = get_sqlite_pool(self.db_path)
             
             # 注册事件处理函数
             self.handlers[Event.ON_RECEIVE_MESSAGE] = self.on_receive_message
@@ -72,7 +82,7 @@ class MsgLogger(Plugin):
     
     def _init_sqlite_db(self):
         """初始化SQLite数据库表结构"""
-        conn = sqlite3.connect(self.db_path)
+        conn = connect_sqlite(self.db_path)
         cursor = conn.cursor()
         
         # 创建消息表，添加话题相关字段和AI回复触发标记
@@ -191,15 +201,12 @@ class MsgLogger(Plugin):
             raise
     
     def _get_mysql_connection(self):
-        """获取MySQL连接"""
-        return pymysql.connect(
-            host=self.mysql_config["host"],
-            port=self.mysql_config["port"],
-            user=self.mysql_config["user"],
-            password=self.mysql_config["password"],
-            database=self.mysql_config["database"],
-            charset='utf8mb4'
-        )
+        """从连接池获取MySQL连接，close()时归还连接池"""
+        return self.pool.connection()
+
+    def _get_sqlite_connection(self):
+        """从连接池获取SQLite连接，close()时归还连接池"""
+        return self.pool.connection()
     
     def on_receive_message(self, e_context: EventContext):
         """记录接收到的消息"""
@@ -288,7 +295,7 @@ class MsgLogger(Plugin):
                     context["db_msg_id"] = msg_id
             else:
                 # 使用SQLite记录
-                conn = sqlite3.connect(self.db_path)
+                conn = self._get_sqlite_connection()
                 cursor = conn.cursor()
                 
                 cursor.execute(
@@ -373,7 +380,7 @@ class MsgLogger(Plugin):
                     cursor = conn.cursor()
                     cursor.execute("UPDATE feishu_messages SET ai_replied = %s WHERE id = %s", (True, msg_id))
                 else:
-                    conn = sqlite3.connect(self.db_path)
+                    conn = self._get_sqlite_connection()
                     cursor = conn.cursor()
                     cursor.execute("UPDATE feishu_messages SET ai_replied = ? WHERE id = ?", (True, msg_id))
                 
@@ -401,7 +408,7 @@ class MsgLogger(Plugin):
                 )
             else:
                 # 使用SQLite记录
-                conn = sqlite3.connect(self.db_path)
+                conn = self._get_sqlite_connection()
                 cursor = conn.cursor()
                 
                 cursor.execute(
@@ -9,6 +9,7 @@ from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
+from common.db_pool import get_mysql_pool
 from common.log import logger
 from config import conf
 from plugins import *
@@ -99,25 +100,27 @@ class RoleX(Plugin):
     def test_db_connection(self):
         """测试数据库连接"""
         try:
-            connection = pymysql.connect(**self.db_config)
+            connection = self.get_db_connection()
+            if connection is None:
+                raise Exception("无法获取数据库连接")
             if connection.open:
-                connection.close()
                 logger.info("[RoleX] 数据库连接测试成功")
+            connection.close()
         except Exception as e:
             logger.error(f"[RoleX] 数据库连接失败: {e}")
             raise e
 
     def get_db_connection(self):
-        """获取数据库连接"""
+        """从连接池获取数据库连接，close()时归还连接池"""
         try:
-            return pymysql.connect(
-                host=self.db_config["host"],
-                port=self.db_config["port"],
-                user=self.db_config["user"],
-                password=self.db_config["password"],
-                database=self.db_config["database"],
-                charset='utf8mb4'
-            )
+            return get_mysql_pool({
+                "host": self.db_config["host"],
+                "port": self.db_config["port"],
+                "user": self.db_config["user"],
+                "password": self.db_config["password"],
+                "database": self.db_config["database"],
+                "charset": "utf8mb4",
+            }).connection()
         except Exception as e:
             logger.error(f"[RoleX] 获取数据库连接失败: {e}")
             return None